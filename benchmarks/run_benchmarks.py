@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+    Benchmarks of the pure-python stages of the pipeline and of the
+    workflow graph construction, run on a synthetic BIDS dataset.
+    FreeSurfer and FSL are not needed.
+
+    Usage
+    -----
+    python benchmarks/run_benchmarks.py                    # compare with baseline.json
+    python benchmarks/run_benchmarks.py --save-baseline    # record a new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'petpipeline'))
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import make_dataset
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline hot paths")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"),
+                        help="Baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--output", default=None,
+                        help="Write the results as json to this file")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed repetitions per benchmark")
+    parser.add_argument("--matrix", type=int, nargs=3, default=[96, 96, 64],
+                        help="PET matrix size")
+    parser.add_argument("--frames", type=int, default=30,
+                        help="Number of PET frames")
+    parser.add_argument("--subjects", type=int, default=200,
+                        help="Number of subjects of the workflow-build dataset")
+    parser.add_argument("--sessions", type=int, default=3,
+                        help="Number of sessions per subject of the workflow-build dataset")
+    parser.add_argument("--time-tolerance", type=float, default=1.5,
+                        help="Allowed slowdown factor before reporting a regression")
+    parser.add_argument("--memory-tolerance", type=float, default=1.25,
+                        help="Allowed peak memory growth factor before reporting a regression")
+    parser.add_argument("--min-time", type=float, default=0.01,
+                        help="Slowdowns smaller than this many seconds are ignored as noise")
+    return parser.parse_args(args)
+
+
+def measure(function, repeat):
+    """
+        Time a callable and record the peak of python / numpy
+        allocations during one call
+
+        Parameters
+        ----------
+        function : callable
+            benchmark body
+        repeat : int
+            number of timed calls, the fastest one is kept
+
+        Returns
+        -------
+        result : dict
+            'time_s' (fastest wall time) and 'peak_mb'
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'time_s': min(timings), 'peak_mb': peak / 2.**20}
+
+
+def make_pipeline(experiment_dir):
+    """
+        Build a PETPipeline for a synthetic experiment directory,
+        using the defaults of petpipeline/config.yaml
+    """
+    import main
+    from PETPipeline import PETPipeline
+
+    config = main.parse_yaml(os.path.join(BENCH_DIR, '..', 'petpipeline', 'config.yaml'))
+    config['environment'].update(experiment_dir=experiment_dir, data_dir='rawdata/',
+                                 working_dir='working_dir/', output_dir='derivatives/')
+    for directory in ['derivatives/pvc', 'derivatives/km', 'derivatives/km2', 'freesurfer']:
+        os.makedirs(os.path.join(experiment_dir, directory), exist_ok=True)
+    return PETPipeline(**main.load_configs(config))
+
+
+def run_benchmarks(args, work_dir):
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+    from utils import compute_weighted_average, compute_average, create_mid_frame_dat, combine_
+
+    # single acquisition with a realistic matrix for the image stages
+    image_root = os.path.join(work_dir, 'images', 'rawdata')
+    make_dataset(image_root, n_subjects=1, n_sessions=1, pet_shape=tuple(args.matrix),
+                 n_frames=args.frames)
+    pet_dir = os.path.join(image_root, 'sub-001', 'ses-01', 'pet')
+    pet_file = os.path.join(pet_dir, 'sub-001_ses-01_pet.nii.gz')
+    json_file = os.path.join(pet_dir, 'sub-001_ses-01_pet.json')
+
+    # many small acquisitions, with missing sessions, for the graph stages
+    graph_dir = os.path.join(work_dir, 'graph')
+    make_dataset(os.path.join(graph_dir, 'rawdata'), n_subjects=args.subjects,
+                 n_sessions=args.sessions, pet_shape=(2, 2, 2), n_frames=args.frames,
+                 anat_shape=(2, 2, 2), session_fraction=0.5)
+
+    os.chdir(work_dir)
+    time_file = create_mid_frame_dat(json_file)
+    k2p_file = os.path.join(work_dir, 'k2prime.dat')
+    with open(k2p_file, 'w') as f:
+        f.write('0.05\n')
+
+    def build_workflow():
+        pipeline = make_pipeline(graph_dir)
+        pipeline.PETWorkflow()
+        return pipeline
+
+    def expand_workflow():
+        workflow = build_workflow().preprocessing_workflow
+        generate_expanded_graph(workflow._create_flat_graph())
+
+    benchmarks = {'compute_weighted_average': lambda: compute_weighted_average(pet_file, json_file),
+                  'compute_average': lambda: compute_average(pet_file),
+                  'create_mid_frame_dat': lambda: create_mid_frame_dat(json_file),
+                  'combine_': lambda: combine_(time_file, time_file, k2p_file),
+                  'workflow_build': build_workflow,
+                  'workflow_expand': expand_workflow}
+
+    results = {}
+    for name, function in benchmarks.items():
+        try:
+            results[name] = measure(function, args.repeat)
+        except Exception as exc:
+            results[name] = {'error': '%s: %s' % (type(exc).__name__, exc)}
+        print("%-26s %s" % (name, format_result(results[name])))
+    return results
+
+
+def format_result(result):
+    if 'error' in result:
+        return 'FAILED (%s)' % result['error']
+    return '%10.4f s %10.1f MB' % (result['time_s'], result['peak_mb'])
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, min_time=0.):
+    """
+        Compare benchmark results with a stored baseline
+
+        Returns
+        -------
+        regressions : list of str
+            description of every benchmark that failed, got slower
+            or used more memory than the tolerances allow
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if 'error' in result:
+            regressions.append('%s failed: %s' % (name, result['error']))
+            continue
+        reference = baseline.get(name)
+        if not reference or 'error' in reference:
+            continue
+        if result['time_s'] > reference['time_s'] * time_tolerance and \
+           result['time_s'] - reference['time_s'] > min_time:
+            regressions.append('%s: %.4f s vs baseline %.4f s'
+                               % (name, result['time_s'], reference['time_s']))
+        if result['peak_mb'] > reference['peak_mb'] * memory_tolerance:
+            regressions.append('%s: %.1f MB vs baseline %.1f MB'
+                               % (name, result['peak_mb'], reference['peak_mb']))
+    return regressions
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='petpipeline_bench_')
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline found at %s, run with --save-baseline first" % args.baseline)
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance,
+                          args.min_time)
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
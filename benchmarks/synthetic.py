@@ -0,0 +1,99 @@
+import os
+import json
+
+import numpy as np
+import nibabel as nib
+
+
+def frame_schedule(n_frames, first_duration=30., growth=1.15):
+    """
+        Typical dynamic PET framing: short frames at the start,
+        growing geometrically towards the end of the scan
+
+        Parameters
+        ----------
+        n_frames : int
+            number of frames
+        first_duration : float
+            duration of the first frame in seconds
+        growth : float
+            ratio between consecutive frame durations
+
+        Returns
+        -------
+        (starts, durations) : (list of float, list of float)
+            'FrameTimesStart' and 'FrameDuration' in seconds
+    """
+    durations = np.round(first_duration * growth ** np.arange(n_frames))
+    starts = np.concatenate([[0.], np.cumsum(durations)[:-1]])
+    return starts.tolist(), durations.tolist()
+
+
+def make_dataset(root, n_subjects=2, n_sessions=2, pet_shape=(64, 64, 48), n_frames=24,
+                 anat_shape=(64, 64, 64), session_fraction=1., seed=0):
+    """
+        Write a synthetic BIDS dataset with a T1w image, a 4D PET
+        series and its json sidecar for every acquisition
+
+        Parameters
+        ----------
+        root : str
+            path of the dataset to create
+        n_subjects : int
+            number of subjects
+        n_sessions : int
+            number of sessions per subject
+        pet_shape : tuple of int
+            matrix size of the PET frames
+        n_frames : int
+            number of PET frames
+        anat_shape : tuple of int
+            matrix size of the T1w images
+        session_fraction : float
+            fraction of (subject, session) pairs that are acquired,
+            the first session of a subject is always present
+        seed : int
+            seed of the random generator
+
+        Returns
+        -------
+        acquisitions : list of (str, str)
+            (subject_id, session_id) pairs written
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'synthetic', 'BIDSVersion': '1.7.0'}, f)
+
+    starts, durations = frame_schedule(n_frames)
+    mid_times = np.array(starts) + np.array(durations) / 2.
+    # smooth uptake curve, scaled per voxel
+    curve = (1 - np.exp(-mid_times / 120.)) * np.exp(-mid_times / 4000.)
+    affine = np.diag([2., 2., 2., 1.])
+
+    acquisitions = []
+    for sub in range(1, n_subjects + 1):
+        for ses in range(1, n_sessions + 1):
+            if ses > 1 and rng.random() >= session_fraction:
+                continue
+            subject_id, session_id = '%03d' % sub, '%02d' % ses
+            prefix = 'sub-%s_ses-%s' % (subject_id, session_id)
+            ses_dir = os.path.join(root, 'sub-' + subject_id, 'ses-' + session_id)
+            os.makedirs(os.path.join(ses_dir, 'anat'), exist_ok=True)
+            os.makedirs(os.path.join(ses_dir, 'pet'), exist_ok=True)
+
+            anat = rng.random(anat_shape, dtype=np.float32) * 100
+            nib.Nifti1Image(anat, np.eye(4)).to_filename(
+                os.path.join(ses_dir, 'anat', prefix + '_T1w.nii.gz'))
+
+            uptake = rng.random(pet_shape, dtype=np.float32)
+            pet = uptake[..., np.newaxis] * curve.astype(np.float32) * 1000
+            nib.Nifti1Image(pet, affine).to_filename(
+                os.path.join(ses_dir, 'pet', prefix + '_pet.nii.gz'))
+            with open(os.path.join(ses_dir, 'pet', prefix + '_pet.json'), 'w') as f:
+                json.dump({'FrameTimesStart': starts,
+                           'FrameDuration': durations,
+                           'TracerName': 'synthetic',
+                           'Units': 'Bq/mL'}, f, indent=2)
+            acquisitions.append((subject_id, session_id))
+    return acquisitions
@@ -1,53 +1,90 @@
 import os
-import glob
-
-import nibabel as nib
 
 # Input 
-import bids
-from bids import BIDSLayout, BIDSValidator
-from nipype.interfaces.freesurfer.model import SegStatsReconAllInputSpec
+from bidsindex import BIDSIndex, pet_runs, write_inputs, select_anat, select_pet
 
-bids.config.set_option('extension_initial_dot', True) #suppress bids warning
+# Nipype, FSL and FreeSurfer (and the nodes importing numpy / nibabel) are
+# only imported once a workflow is built or run, so that the CLI, config
+# validation and 'plan' start without them
 
-from nipype.interfaces.io import SelectFiles
+# Helper functions
+from utils import assert_dir, \
+                  create_mid_frame_dat, \
+                  compute_weighted_average, \
+                  combine_file_paths, \
+                  combine_, \
+                  first_anatomical, \
+                  image_extension, \
+                  compress_image, \
+                  select_variant
 
-# Nipype 
-import nibabel as nib
-from nipype import Node, Function
-from nipype.pipeline import Workflow
+from reconall_cache import cached_reconall
 
-# FSL for Motion Correction
-from nipype.interfaces import fsl
+# Frame-parallel motion correction
+from motion_correction import parallel_motion_correction
 
-# IdentityInterface for mappings
-from nipype.interfaces.utility import IdentityInterface
+# Derivative manifests for incremental re-execution
+from manifest import MANIFEST_SECTIONS, manifest_file, is_stale, tool_versions, write_manifest
 
-# DataSink for storing outputs
-from nipype.interfaces.io import DataSink
+# Deterministic partitioning of the acquisitions across processes
+from sharding import shard_label, shard_acquisitions, sharded_tables, write_marker, concatenate_tables
+                  
 
-# Free Surfer for ReconAll
-from nipype.interfaces.freesurfer import ReconAll
+from config import _PVCEngineConfig, \
+                   _SchedulerConfig, \
+                   _ReconAllCacheConfig, \
+                   _KineticModellingConfig, \
+                   _ParallelMotionCorrectionConfig, \
+                   _ProfilingConfig, \
+                   _IncrementalConfig, \
+                   _ImageFormatConfig, \
+                   _DataSinkConfig, \
+                   _CleanupConfig, \
+                   _RetryConfig, \
+                   _PreflightConfig, \
+                   _ResultsStoreConfig, \
+                   _SweepConfig
 
-# PET Surfer for Delineation of Volumes of Interest, Partial Volume Correction, Kinetic Modelling
-from nipype.interfaces.freesurfer import petsurfer
 
-# MRICoreg for Coregistration
-from nipype.interfaces.freesurfer import MRICoreg
+# Nipype execution plugins for each scheduler backend
+_PLUGINS = {'serial': 'Linear',
+            'multiproc': 'MultiProc',
+            'pool': 'LegacyMultiProc'}
 
-# Helper functions
-from utils import assert_dir, \
-                  create_mid_frame_dat, \
-                  compute_weighted_average, \
-                  combine_file_paths, \
-                  combine_
-                  
+# Default resource estimates per node, used by the scheduler to pack
+# light python nodes around the heavy FreeSurfer / FSL ones
+_NODE_RESOURCES = {'select_anat': {'n_procs': 1, 'mem_gb': 0.1},
+                   'select_pet': {'n_procs': 1, 'mem_gb': 0.1},
+                   'mapsubjects': {'n_procs': 1, 'mem_gb': 0.1},
+                   'motion_correction': {'n_procs': 1, 'mem_gb': 4},
+                   'time_weighted_average': {'n_procs': 1, 'mem_gb': 1},
+                   'coregistration': {'n_procs': 1, 'mem_gb': 2},
+                   'reconall': {'n_procs': 1, 'mem_gb': 3},
+                   'gtmseg': {'n_procs': 1, 'mem_gb': 3},
+                   'partial_volume_correction': {'n_procs': 1, 'mem_gb': 6},
+                   'midframes': {'n_procs': 1, 'mem_gb': 0.1},
+                   'kinetic_modelling': {'n_procs': 1, 'mem_gb': 2},
+                   'kinetic_modelling_': {'n_procs': 1, 'mem_gb': 2},
+                   'cohort_kinetic_modelling': {'n_procs': 1, 'mem_gb': 4},
+                   'compress_outputs': {'n_procs': 1, 'mem_gb': 0.5},
+                   'datasink': {'n_procs': 1, 'mem_gb': 0.2}}
+
+# Resource estimate for nodes not listed above
+_DEFAULT_RESOURCES = {'n_procs': 1, 'mem_gb': 0.2}
+
+# DataSink folder mapping: _session_id_<ses>_subject_id_<sub> -> sub-<sub>/ses-<ses>,
+# then _run_<run> -> <run>, dropped for single-run sessions
+_DATASINK_SUBSTITUTIONS = [(r'_session_id_([^/]+)_subject_id_([^/]+)', r'sub-\2/ses-\1'),
+                           (r'/_run_(?=/)', ''),
+                           (r'/_run_([^/]+)', r'/\1')]
 
-from config import _EnvConfig, \
-                   _ReconAllConfig, \
-                   _MotionCorrectionConfig, \
-                   _PartialVolumeCorrectionConfig, \
-                   _CoregistrationConfig
+# Per-acquisition nodes run once per variant of a parameter sweep
+_SWEPT_NODES = ['create_subjects_dir_pvc', 'partial_volume_correction', 'create_subjects_dir_km',
+                'kinetic_modelling', 'create_subjects_dir_km2', 'kinetic_modelling_',
+                'combine_outputs', 'combine_', 'merge_runs']
+
+# Per-acquisition nodes run once per session, the others once per PET run
+_SESSION_NODES = ['select_anat', 'reconall', 'mapsubjects', 'gtmseg', 'manifest', 'merge_runs']
 
 
 class PETPipeline:
@@ -56,12 +93,23 @@ class PETPipeline:
 
         self.__dict__.update(kwargs)
 
-        # inititalize workflow
-        self.preprocessing_workflow = Workflow(name='preprocessing')        
-        self.preprocessing_workflow.base_dir = os.path.join(self.env_config.experiment_dir, 
-                                                            self.env_config.working_dir)
+        # working dir of the workflow
+        self.base_dir = os.path.join(self.env_config.experiment_dir, self.env_config.working_dir)
+
+        # shard (index, count) of the acquisitions processed by this run
+        self.shard = getattr(self, 'shard', None)
+        self.shard_strategy = getattr(self, 'shard_strategy', 'hash')
+        if self.shard:
+            self.base_dir = os.path.join(self.base_dir, shard_label(*self.shard))
+
+        # folder of the run-wide reports (preflight, failures, profiling)
+        # of a single-acquisition run, e.g. a watch worker
+        self.output_label = getattr(self, 'output_label', None)
         # data path
-        self.data_path = self.env_config.data_dir
+        self.data_path = os.path.join(self.env_config.experiment_dir, self.env_config.data_dir)
+
+        # persistent index of the BIDS dataset
+        self.index_file = os.path.join(self.env_config.experiment_dir, 'bids_index.json')
 
         # create derivatives
         self.derivatives = os.path.join(self.env_config.experiment_dir, 'derivatives')
@@ -82,84 +130,219 @@ class PETPipeline:
         # create km2_dir
         self.km2_dir = os.path.join(self.derivatives,'km2')
         assert_dir(self.km2_dir)
+
+        # manifests of the derivatives of each acquisition
+        self.manifest_dir = os.path.join(self.derivatives, 'manifests')
+
+        # completion markers of sharded runs
+        self.shard_dir = os.path.join(self.derivatives, 'shards')
+
+        # memory factors of the nodes rerun after running out of memory
+        self.mem_factors = {}
         
 
-    def PETWorkflow(self):
+    def PETWorkflow(self, acquisitions=None):
 
         """
             Create a workflow for PET preprocessing.
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs to process, by default
+                those selected by select_acquisitions
         """
+        from nipype import Node, JoinNode, Function
+        from nipype.pipeline import Workflow
+
+        # FSL for Motion Correction
+        from nipype.interfaces import fsl
+
+        # IdentityInterface for mappings
+        from nipype.interfaces.utility import IdentityInterface
+
+        # DataSink for storing outputs, linking instead of copying when possible
+        from datasink import LinkingDataSink
+
+        # Free Surfer for ReconAll
+        from nipype.interfaces.freesurfer import ReconAll
+
+        # PET Surfer for Delineation of Volumes of Interest, Partial Volume Correction, Kinetic Modelling
+        from nipype.interfaces.freesurfer import petsurfer
+
+        # MRICoreg for Coregistration
+        from nipype.interfaces.freesurfer import MRICoreg
+
+        # Native kinetic modelling engine
+        from kinetics import native_mrtm, native_mrtm2, cohort_kinetic_modelling
+
+        # Native partial volume correction engine
+        from gtm import native_gtmpvc
+
+        # inititalize workflow
+        self.preprocessing_workflow = Workflow(name='preprocessing')        
+        self.preprocessing_workflow.base_dir = self.base_dir
+
+        # format of the images written inside the working dir
+        image_format_config = getattr(self, 'image_format_config', _ImageFormatConfig())
+        image_ext = image_extension(image_format_config.intermediate)
 
         # 1. Motion Correction
-        motion_correction = Node(fsl.MCFLIRT(
-                                             **self.motion_correction_config.__dict__), 
-                                              name="motion_correction")
+        parallel_motion_correction_config = getattr(self, 'parallel_motion_correction_config', 
+                                                    _ParallelMotionCorrectionConfig())
+        if parallel_motion_correction_config.enabled:
+            # frame chunks registered to the time weighted average in parallel
+            motion_correction = Node(Function(
+                                        input_names=['in_file', 'json_file', 'mcflirt_args', 
+                                                     'n_chunks', 'n_procs', 'output_type'],
+                                        output_names=['out_file', 'par_file', 'mat_file'],
+                                        function=parallel_motion_correction),
+                                        name="motion_correction",
+                                        **dict(self.node_resources("motion_correction"),
+                                               n_procs=parallel_motion_correction_config.n_procs))
+            motion_correction.inputs.mcflirt_args = dict(self.motion_correction_config.__dict__)
+            motion_correction.inputs.n_chunks = parallel_motion_correction_config.n_chunks
+            motion_correction.inputs.n_procs = parallel_motion_correction_config.n_procs
+            motion_correction.inputs.output_type = image_format_config.intermediate
+        else:
+            mcflirt_args = dict(output_type=image_format_config.intermediate)
+            mcflirt_args.update(self.motion_correction_config.__dict__)
+            motion_correction = Node(fsl.MCFLIRT(
+                                                 **mcflirt_args), 
+                                                  name="motion_correction",
+                                                  **self.node_resources("motion_correction"))
 
 
         # time weighted average
         time_weighted_average = Node(Function(
-                                        input_names=["in_file", "json_file"], 
+                                        input_names=["in_file", "json_file", "out_ext"], 
                                         output_names=["out_file"], 
                                         function=compute_weighted_average), 
-                                        name="time_weighted_average")
+                                        name="time_weighted_average",
+                                        **self.node_resources("time_weighted_average"))
+        time_weighted_average.inputs.out_ext = image_ext
                                     
         
         # 2. Co-Registration
         coregistration = Node(MRICoreg(
                                 **self.coregistration_config.__dict__,
                                 subjects_dir=self.freesurfer_dir),
-                                name="coregistration")
+                                name="coregistration",
+                                **self.node_resources("coregistration"))
 
         # 3.a. Delineation of Volumes of Interest: Run Reconall for all subjects
-        reconall = Node(ReconAll(
-                            directive='all', 
-                            subjects_dir=self.freesurfer_dir),
-                            name="reconall")
+        reconall_cache_config = getattr(self, 'reconall_cache_config', _ReconAllCacheConfig())
+        if reconall_cache_config.enabled:
+            # content-addressed cache keyed on the T1w and the recon-all config
+            reconall = Node(Function(
+                                input_names=['T1_files', 'subject_id', 'session_id', 'subjects_dir',
+                                             'reconall_args', 'share_across_sessions', 'adopt_legacy'],
+                                output_names=['subject_id', 'subjects_dir', 'T1'],
+                                function=cached_reconall),
+                                name="reconall",
+                                **self.node_resources("reconall"))
+            reconall_args = dict(self.reconall_config.__dict__)
+            if reconall.n_procs > 1:
+                reconall_args['openmp'] = reconall.n_procs
+            reconall.inputs.reconall_args = reconall_args
+            reconall.inputs.subjects_dir = self.freesurfer_dir
+            reconall.inputs.share_across_sessions = reconall_cache_config.share_across_sessions
+            reconall.inputs.adopt_legacy = reconall_cache_config.adopt_legacy
+        else:
+            reconall = Node(ReconAll(
+                                directive='all', 
+                                subjects_dir=self.freesurfer_dir),
+                                name="reconall",
+                                **self.node_resources("reconall"))
+            if reconall.n_procs > 1:
+                reconall.inputs.openmp = reconall.n_procs
 
         # 3.b. Delineation of Volumes of Interest: Pet Surfer GTMSeg
         gtmseg = Node(petsurfer.GTMSeg(
                         subjects_dir=self.freesurfer_dir),
-                        name="gtmseg")
+                        name="gtmseg",
+                        **self.node_resources("gtmseg"))
   
 
         mapsubjects = Node(Function(
                             input_names=['session_id','subject_id'], 
                             output_names=['subject_id'], 
-                            function=self.map_subjects), name="mapsubjects")
+                            function=self.map_subjects), name="mapsubjects",
+                                                         **self.node_resources("mapsubjects"))
 
         create_subjects_dir_pvc = Node(Function(
-                                        input_names=['directory','session_id','subject_id'],
+                                        input_names=['directory','session_id','subject_id','variant','run'],
                                         output_names=['directory'], 
                                         function = self.create_subjects_dir
-                                       ),name= "create_subjects_dir_pvc")
+                                       ),name="create_subjects_dir_pvc",
+                                         **self.node_resources("create_subjects_dir_pvc"))
         create_subjects_dir_pvc.inputs.directory = self.pvc_dir
 
+        # parameter sweep: variants of the partial volume correction options
+        variants = getattr(self, 'sweep_config', _SweepConfig()).variants()
+        swept = sorted(next(iter(variants.values()))) if variants else []
+
         # 4. Partial Volume Correction 
-        partial_volume_correction = Node(petsurfer.GTMPVC(
-                                            **self.pvc_config.__dict__,
-                                            subjects_dir=self.freesurfer_dir),
-                                            name="partial_volume_correction")
+        pvc_engine_config = getattr(self, 'pvc_engine_config', _PVCEngineConfig())
+        if pvc_engine_config.backend == 'native':
+            # in-process ROI-level GTM, same outputs as GTMPVC
+            partial_volume_correction = Node(Function(
+                                                input_names=['in_file', 'segmentation', 'reg_file', 'pvc_dir',
+                                                             'psf', 'km_ref', 'km_hb', 'cache_dir'],
+                                                output_names=['ref_file', 'hb_nifti', 'gtm_file', 'gtm_stats'],
+                                                function=native_gtmpvc),
+                                                name="partial_volume_correction",
+                                                **self.node_resources("partial_volume_correction"))
+            for key in ['psf', 'km_ref', 'km_hb']:
+                if key not in swept:
+                    setattr(partial_volume_correction.inputs, key, getattr(self.pvc_config, key))
+            if pvc_engine_config.cache:
+                partial_volume_correction.inputs.cache_dir = os.path.join(self.freesurfer_dir, '.gtm_cache')
+        else:
+            partial_volume_correction = Node(petsurfer.GTMPVC(
+                                                **{key: value for key, value in self.pvc_config.__dict__.items()
+                                                   if key not in swept},
+                                                subjects_dir=self.freesurfer_dir),
+                                                name="partial_volume_correction",
+                                                **self.node_resources("partial_volume_correction"))
         
         # 5. a. Kinetic Modelling using MRTM
         midframes = Node(Function(
                             input_names=['json_file'], 
                             output_names=['time_file'], 
-                            function=create_mid_frame_dat), name="midframes")
+                            function=create_mid_frame_dat), name="midframes",
+                                                            **self.node_resources("midframes"))
 
         
         combine_outputs = Node(Function (input_names=["time_file","ref_file"],
                                         output_names = ["input_to_mrtm"],
                                         function = combine_file_paths),
-                                        name="combine_outputs")
+                                        name="combine_outputs",
+                                        **self.node_resources("combine_outputs"))
 
         
         create_subjects_dir_km = Node(Function(
-                                        input_names=['directory','session_id','subject_id'],
+                                        input_names=['directory','session_id','subject_id','variant','run'],
                                         output_names=['directory'], 
                                         function = self.create_subjects_dir
-                                       ),name= "create_subjects_dir_km")
+                                       ),name="create_subjects_dir_km",
+                                         **self.node_resources("create_subjects_dir_km"))
         create_subjects_dir_km.inputs.directory = self.km_dir
-        kinetic_modelling = Node(petsurfer.MRTM(subjects_dir=self.freesurfer_dir),name="kinetic_modelling")
+        kinetic_modelling_config = getattr(self, 'kinetic_modelling_config', _KineticModellingConfig())
+        if kinetic_modelling_config.backend == 'native':
+            # in-process batched least-squares fit
+            kinetic_modelling = Node(Function(
+                                        input_names=['in_file', 'time_file', 'ref_file', 
+                                                     'glm_dir', 'chunk_size'],
+                                        output_names=['glm_dir', 'k2p_file', 'bp_file'],
+                                        function=native_mrtm),
+                                        name="kinetic_modelling",
+                                        **self.node_resources("kinetic_modelling"))
+            kinetic_modelling.inputs.chunk_size = kinetic_modelling_config.chunk_size
+        else:
+            kinetic_modelling = Node(petsurfer.MRTM(subjects_dir=self.freesurfer_dir),
+                                     name="kinetic_modelling",
+                                     **self.node_resources("kinetic_modelling"))
 
 
         # 5. b. Kinetic Modelling using MRTM2
@@ -167,83 +350,622 @@ class PETPipeline:
         combine_outputs_ = Node(Function(input_names=["time_file","ref_file", "k2p_file"],
                                         output_names = ["input_to_mrtm2"],
                                         function = combine_),
-                                        name="combine_")
+                                        name="combine_",
+                                        **self.node_resources("combine_"))
 
         create_subjects_dir_km2 = Node(Function(
-                                        input_names=['directory','session_id','subject_id'],
+                                        input_names=['directory','session_id','subject_id','variant','run'],
                                         output_names=['directory'], 
                                         function = self.create_subjects_dir
-                                       ),name= "create_subjects_dir_km2")
+                                       ),name="create_subjects_dir_km2",
+                                         **self.node_resources("create_subjects_dir_km2"))
         create_subjects_dir_km2.inputs.directory = self.km2_dir
-        kinetic_modelling_ = Node(petsurfer.MRTM2(subjects_dir=self.freesurfer_dir),name="kinetic_modelling_")
+        if kinetic_modelling_config.backend == 'native':
+            kinetic_modelling_ = Node(Function(
+                                        input_names=['in_file', 'time_file', 'ref_file', 
+                                                     'k2p_file', 'glm_dir', 'chunk_size'],
+                                        output_names=['glm_dir', 'bp_file'],
+                                        function=native_mrtm2),
+                                        name="kinetic_modelling_",
+                                        **self.node_resources("kinetic_modelling_"))
+            kinetic_modelling_.inputs.chunk_size = kinetic_modelling_config.chunk_size
+        else:
+            kinetic_modelling_ = Node(petsurfer.MRTM2(subjects_dir=self.freesurfer_dir),
+                                      name="kinetic_modelling_",
+                                      **self.node_resources("kinetic_modelling_"))
 
 
 
         # Streamline Input Output
-        layout = BIDSLayout(self.data_path)
         infosource = Node(IdentityInterface(
                             fields=['subject_id','session_id']),
-                            name="infosource")
-        infosource.iterables = [('subject_id', layout.get_subjects()), ('session_id', layout.get_sessions())]
+                            name="infosource",
+                            **self.node_resources("infosource"))
+        incremental_config = getattr(self, 'incremental_config', _IncrementalConfig())
+        if acquisitions is None:
+            acquisitions = self.select_acquisitions()
+        self.acquisitions = acquisitions
+        infosource.iterables = [('subject_id', [subject for subject, _ in acquisitions]), 
+                                ('session_id', [session for _, session in acquisitions])]
+        infosource.synchronize = True
+
+        # PET runs of every acquisition, processed in parallel below the
+        # shared anatomical stages (recon-all, gtmseg) of their session
+        runsource = Node(IdentityInterface(
+                            fields=['subject_id', 'session_id', 'run']),
+                            name="runsource",
+                            **self.node_resources("runsource"))
+        runsource.itersource = ('infosource', ['subject_id', 'session_id'])
+        runsource.iterables = [('run', self.acquisition_runs(acquisitions))]
 
+        # input files resolved once from the persistent BIDS index, one
+        # small file per acquisition; the select nodes always rerun to
+        # read it, the nodes below them stay cached while the paths
+        # they return are unchanged
+        inputs_dir = self.acquisition_inputs(acquisitions)
+        selectanat = Node(Function(
+                            input_names=['subject_id', 'session_id', 'inputs_dir'],
+                            output_names=['anat'],
+                            function=select_anat),
+                            name="select_anat",
+                            overwrite=True,
+                            **self.node_resources("select_anat"))
+        selectanat.inputs.inputs_dir = inputs_dir
 
-        templates = {'anat': 'sub-{subject_id}/ses-{session_id}/anat/*_T1w.[n]*', 
-                    'pet': r'sub-{subject_id}/ses-{session_id}/pet/*_pet.[n]*', 
-                    'json': 'sub-{subject_id}/ses-{session_id}/pet/*_pet.json'}
-           
-        selectfiles = Node(SelectFiles(templates, 
-                                       base_directory=os.path.join(self.env_config.experiment_dir,self.env_config.data_dir)), 
-                          name="select_files")
+        selectfiles = Node(Function(
+                            input_names=['subject_id', 'session_id', 'run', 'inputs_dir'],
+                            output_names=['pet', 'json'],
+                            function=select_pet),
+                            name="select_pet",
+                            overwrite=True,
+                            **self.node_resources("select_pet"))
+        selectfiles.inputs.inputs_dir = inputs_dir
 
         
-        datasink = Node(DataSink(base_directory=self.derivatives), name="datasink")
+        # multi-threaded compression of the images handed to the datasink
+        compress_outputs = Node(Function(
+                                    input_names=['in_file', 'level', 'n_threads'],
+                                    output_names=['out_file'],
+                                    function=compress_image),
+                                    name="compress_outputs",
+                                    **dict(self.node_resources("compress_outputs"),
+                                           n_procs=image_format_config.n_threads))
+        compress_outputs.inputs.level = image_format_config.compress_level
+        compress_outputs.inputs.n_threads = image_format_config.n_threads
 
-       
-        substitutions = [('_subject_id_', 'sub-')]
-        subjFolders = [('_session_id_%ssub-%s' % (ses, sub), 'sub-%s/ses-%s' %(sub,ses))
-                        for ses in layout.get_sessions()
-                        for sub in layout.get_subjects()]
-        substitutions.extend(subjFolders)
-        datasink.inputs.substitutions = substitutions
+        datasink_config = getattr(self, 'datasink_config', _DataSinkConfig())
+        datasink = Node(LinkingDataSink(base_directory=self.derivatives,
+                                        link_mode=datasink_config.link_mode), 
+                        name="datasink",
+                        **self.node_resources("datasink"))
+
+        # nipype iterable folders to the BIDS layout, one pattern for any cohort size
+        datasink.inputs.regexp_substitutions = _DATASINK_SUBSTITUTIONS
 
         
 
         self.preprocessing_workflow.connect([
-                                                (infosource, selectfiles, [('subject_id', 'subject_id'),('session_id', 'session_id')]), 
-                                                (infosource, mapsubjects, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (infosource, selectanat, [('subject_id', 'subject_id'),('session_id', 'session_id')]), 
+                                                (infosource, runsource, [('subject_id', 'subject_id'),('session_id', 'session_id')]), 
+                                                (runsource, selectfiles, [('subject_id', 'subject_id'),('session_id', 'session_id'),('run', 'run')]), 
                                                 (selectfiles, motion_correction, [('pet', 'in_file')]), 
                                                 (motion_correction, time_weighted_average, [('out_file','in_file')]),
-                                                (motion_correction, datasink, [('out_file', 'motion_correction')]),
                                                 (selectfiles, time_weighted_average, [('json', 'json_file')]),
-                                                (selectfiles, reconall, [('anat','T1_files')]),
-                                                (mapsubjects, reconall, [('subject_id','subject_id')]),
                                                 (reconall, gtmseg, [('subject_id','subject_id')]),
                                                 (reconall, coregistration, [('subject_id','subject_id')]),
                                                 (time_weighted_average, coregistration, [('out_file','source_file')]),
                                                 (reconall, coregistration, [('T1','reference_file')]),
                                                 (motion_correction, partial_volume_correction, [('out_file','in_file')]),
-                                                (infosource, create_subjects_dir_pvc, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (runsource, create_subjects_dir_pvc, [('subject_id', 'subject_id'),('session_id', 'session_id'),('run', 'run')]),
                                                 (gtmseg, partial_volume_correction, [('gtm_file','segmentation')]),
                                                 (coregistration, datasink, [('out_lta_file', 'coregistration')]),
                                                 (coregistration, partial_volume_correction, [('out_lta_file','reg_file')]),
                                                 (create_subjects_dir_pvc,partial_volume_correction, [('directory','pvc_dir')]),
-                                                (partial_volume_correction, combine_outputs, [('ref_file','ref_file')]),
                                                 (selectfiles,midframes, [('json','json_file')]),
-                                                (midframes, combine_outputs, [('time_file','time_file')]),
-                                                (combine_outputs, kinetic_modelling ,[('input_to_mrtm', 'mrtm1')]),
-                                                (infosource, create_subjects_dir_km, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (runsource, create_subjects_dir_km, [('subject_id', 'subject_id'),('session_id', 'session_id'),('run', 'run')]),
                                                 (create_subjects_dir_km, kinetic_modelling ,[('directory', 'glm_dir')]),
                                                 (partial_volume_correction, kinetic_modelling ,[('hb_nifti','in_file')]),
+                                                (runsource, create_subjects_dir_km2, [('subject_id', 'subject_id'),('session_id', 'session_id'),('run', 'run')]),
+                                                (create_subjects_dir_km2, kinetic_modelling_ ,[('directory', 'glm_dir')]),
+                                                (partial_volume_correction, kinetic_modelling_ ,[('hb_nifti','in_file')]),
+                                                ])
+
+        if incremental_config.enabled:
+            # record inputs, config and tool versions once all runs are complete
+            manifest = JoinNode(Function(
+                                input_names=['subject_id', 'session_id', 'anat', 'pet', 'json_file',
+                                             'configs', 'manifest_dir', 'datasink_out',
+                                             'kinetic_modelling_out'],
+                                output_names=['manifest'],
+                                function=write_manifest),
+                                joinsource="runsource",
+                                joinfield=['pet', 'json_file', 'datasink_out', 'kinetic_modelling_out'],
+                                name="manifest",
+                                **self.node_resources("manifest"))
+            manifest.inputs.configs = self.manifest_configs()
+            manifest.inputs.manifest_dir = self.manifest_dir
+
+            self.preprocessing_workflow.connect([
+                                                (infosource, manifest, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (selectanat, manifest, [('anat', 'anat')]),
+                                                (selectfiles, manifest, [('pet', 'pet'),('json', 'json_file')]),
+                                                (datasink, manifest, [('out_file', 'datasink_out')]),
+                                                ])
+            if variants:
+                # one manifest per acquisition, once every variant is complete
+                merge_variants = JoinNode(IdentityInterface(
+                                        fields=['kinetic_modelling_out']),
+                                        joinsource="sweepsource",
+                                        joinfield=['kinetic_modelling_out'],
+                                        name="merge_variants",
+                                        **self.node_resources("merge_variants"))
+                self.preprocessing_workflow.connect([
+                                                (kinetic_modelling_, merge_variants, [('glm_dir', 'kinetic_modelling_out')]),
+                                                (merge_variants, manifest, [('kinetic_modelling_out', 'kinetic_modelling_out')]),
+                                                ])
+            else:
+                self.preprocessing_workflow.connect([
+                                                (kinetic_modelling_, manifest, [('glm_dir', 'kinetic_modelling_out')]),
+                                                ])
+
+        if image_ext == '.nii':
+            self.preprocessing_workflow.connect([
+                                                (motion_correction, compress_outputs, [('out_file', 'in_file')]),
+                                                (compress_outputs, datasink, [('out_file', 'motion_correction')]),
+                                                ])
+        else:
+            self.preprocessing_workflow.connect([
+                                                (motion_correction, datasink, [('out_file', 'motion_correction')]),
+                                                ])
+
+        if parallel_motion_correction_config.enabled or getattr(self.motion_correction_config, 'save_plots', False):
+            # motion parameters, summarized in the results store
+            self.preprocessing_workflow.connect([
+                                                (motion_correction, datasink, [('par_file', 'motion_correction.@par')]),
+                                                ])
+
+        if parallel_motion_correction_config.enabled:
+            self.preprocessing_workflow.connect([
+                                                (selectfiles, motion_correction, [('json', 'json_file')]),
+                                                ])
+
+        if kinetic_modelling_config.cohort:
+            # 5. c. Cohort-level ROI kinetic modelling, joined over all acquisitions
+            # the runs of each acquisition are joined first, then the acquisitions
+            merge_runs = JoinNode(IdentityInterface(
+                                    fields=['run', 'gtm_file', 'gtm_stats', 'ref_file', 'hb_file', 'time_file']),
+                                    joinsource="runsource",
+                                    joinfield=['run', 'gtm_file', 'gtm_stats', 'ref_file', 'hb_file', 'time_file'],
+                                    name="merge_runs",
+                                    **self.node_resources("merge_runs"))
+
+            cohort_kinetic_modelling_ = JoinNode(Function(
+                                        input_names=['subject_id', 'session_id', 'gtm_file', 'gtm_stats',
+                                                     'ref_file', 'hb_file', 'time_file', 'out_dir',
+                                                     'chunk_size', 'variant', 'run'],
+                                        output_names=['out_file'],
+                                        function=cohort_kinetic_modelling),
+                                        joinsource="infosource",
+                                        joinfield=['subject_id', 'session_id', 'gtm_file', 'gtm_stats',
+                                                   'ref_file', 'hb_file', 'time_file', 'run'],
+                                        name="cohort_kinetic_modelling",
+                                        **self.node_resources("cohort_kinetic_modelling"))
+            cohort_kinetic_modelling_.inputs.out_dir = self.cohort_dir()
+            cohort_kinetic_modelling_.inputs.chunk_size = kinetic_modelling_config.chunk_size
+
+            self.preprocessing_workflow.connect([
+                                                (infosource, cohort_kinetic_modelling_, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (runsource, merge_runs, [('run', 'run')]),
+                                                (partial_volume_correction, merge_runs, [('gtm_file','gtm_file'),
+                                                                                         ('gtm_stats','gtm_stats'),
+                                                                                         ('ref_file','ref_file'),
+                                                                                         ('hb_nifti','hb_file')]),
+                                                (midframes, merge_runs, [('time_file','time_file')]),
+                                                (merge_runs, cohort_kinetic_modelling_, [('run', 'run'),
+                                                                                         ('gtm_file','gtm_file'),
+                                                                                         ('gtm_stats','gtm_stats'),
+                                                                                         ('ref_file','ref_file'),
+                                                                                         ('hb_file','hb_file'),
+                                                                                         ('time_file','time_file')]),
+                                                ])
+
+        if variants:
+            # only partial volume correction and the nodes below it run per variant,
+            # upstream results are shared
+            sweepsource = Node(IdentityInterface(
+                                fields=['variant']),
+                                name="sweepsource",
+                                **self.node_resources("sweepsource"))
+            sweepsource.iterables = ('variant', sorted(variants))
+
+            sweep_parameters = Node(Function(
+                                        input_names=['variant', 'variants', 'keys'],
+                                        output_names=swept,
+                                        function=select_variant),
+                                        name="sweep_parameters",
+                                        **self.node_resources("sweep_parameters"))
+            sweep_parameters.inputs.variants = variants
+            sweep_parameters.inputs.keys = swept
+
+            self.preprocessing_workflow.connect([
+                                                (sweepsource, sweep_parameters, [('variant', 'variant')]),
+                                                (sweep_parameters, partial_volume_correction, [(key, key) for key in swept]),
+                                                (sweepsource, create_subjects_dir_pvc, [('variant', 'variant')]),
+                                                (sweepsource, create_subjects_dir_km, [('variant', 'variant')]),
+                                                (sweepsource, create_subjects_dir_km2, [('variant', 'variant')]),
+                                                ])
+            if kinetic_modelling_config.cohort:
+                self.preprocessing_workflow.connect([
+                                                (sweepsource, cohort_kinetic_modelling_, [('variant', 'variant')]),
+                                                ])
+
+        if kinetic_modelling_config.backend == 'native':
+            self.preprocessing_workflow.connect([
+                                                (midframes, kinetic_modelling, [('time_file','time_file')]),
+                                                (partial_volume_correction, kinetic_modelling, [('ref_file','ref_file')]),
+                                                (kinetic_modelling, kinetic_modelling_, [('k2p_file','k2p_file')]),
+                                                (midframes, kinetic_modelling_, [('time_file','time_file')]),
+                                                (partial_volume_correction, kinetic_modelling_, [('ref_file','ref_file')]),
+                                                ])
+        else:
+            self.preprocessing_workflow.connect([
+                                                (partial_volume_correction, combine_outputs, [('ref_file','ref_file')]),
+                                                (midframes, combine_outputs, [('time_file','time_file')]),
+                                                (combine_outputs, kinetic_modelling ,[('input_to_mrtm', 'mrtm1')]),
                                                 (kinetic_modelling, combine_outputs_, [('k2p','k2p_file')]),
                                                 (midframes, combine_outputs_, [('time_file','time_file')]),
                                                 (partial_volume_correction, combine_outputs_, [('ref_file','ref_file')]),
                                                 (combine_outputs_, kinetic_modelling_, [('input_to_mrtm2','mrtm2')]),
-                                                (infosource, create_subjects_dir_km2, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
-                                                (create_subjects_dir_km2, kinetic_modelling_ ,[('directory', 'glm_dir')]),
-                                                (partial_volume_correction, kinetic_modelling_ ,[('hb_nifti','in_file')]),
                                                 ])
-    
-    def create_subjects_dir(directory, session_id, subject_id):
+
+        if self.shares_anatomical():
+            # one T1w for every session of the subject
+            self.preprocessing_workflow.connect([
+                                                (selectanat, reconall, [(('anat', first_anatomical),'T1_files')]),
+                                                ])
+        else:
+            self.preprocessing_workflow.connect([
+                                                (selectanat, reconall, [('anat','T1_files')]),
+                                                ])
+
+        if reconall_cache_config.enabled:
+            self.preprocessing_workflow.connect([
+                                                (infosource, reconall, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                ])
+        else:
+            self.preprocessing_workflow.connect([
+                                                (infosource, mapsubjects, [('subject_id', 'subject_id'),('session_id', 'session_id')]),
+                                                (mapsubjects, reconall, [('subject_id','subject_id')]),
+                                                ])
+
+    def bids_index(self):
+        """
+            Load the persistent BIDS index of the data directory
+            and refresh it for folders modified since the last run
+
+            Returns
+            -------
+            index : BIDSIndex
+                up to date index of the dataset
+        """
+        index = BIDSIndex(self.data_path, self.index_file)
+        if index.refresh():
+            index.save()
+        return index
+
+    def get_acquisitions(self):
+        """
+            List the (subject, session) pairs that actually 
+            have PET data in the BIDS dataset
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                sorted (subject_id, session_id) pairs
+        """
+        return self.bids_index().acquisitions()
+
+    def acquisition_runs(self, acquisitions):
+        """
+            PET runs of every acquisition, see bidsindex.pet_runs
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+
+            Returns
+            -------
+            runs : dict
+                mapping of (subject_id, session_id) to its run labels
+        """
+        index = self.bids_index()
+        return {(subject_id, session_id): index.runs(subject_id, session_id)
+                for subject_id, session_id in acquisitions}
+
+    def shares_anatomical(self):
+        """
+            Whether recon-all runs once per subject on the T1w of its
+            first session, only through the recon-all cache
+        """
+        reconall_cache_config = getattr(self, 'reconall_cache_config', _ReconAllCacheConfig())
+        return reconall_cache_config.enabled and reconall_cache_config.share_across_sessions
+
+    def acquisition_inputs(self, acquisitions):
+        """
+            Resolve the input files of every acquisition from the BIDS
+            index and write them for the select_anat and select_pet
+            nodes, see bidsindex.write_inputs
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+
+            Returns
+            -------
+            inputs_dir : str
+                directory of the per-acquisition input files, holding
+                the T1w images (of every session of the subject when
+                the anatomical is shared across sessions) and the 
+                (pet, json) of every run
+        """
+        index = self.bids_index()
+        anat_all_sessions = self.shares_anatomical()
+        inputs_dir = os.path.join(self.base_dir, 'inputs')
+        for subject_id, session_id in acquisitions:
+            write_inputs(inputs_dir, subject_id, session_id,
+                         index.files(subject_id, None if anat_all_sessions else session_id)['anat'],
+                         pet_runs(index.files(subject_id, session_id)))
+        return inputs_dir
+
+    def select_acquisitions(self, report=True):
+        """
+            Acquisitions processed by this run: the discovered pairs,
+            restricted to the shard and, for incremental runs, to 
+            those whose manifest is missing or stale
+
+            Parameters
+            ----------
+            report : bool
+                write the preflight report, see preflight
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+        """
+        acquisitions = self.get_acquisitions()
+        if self.shard:
+            acquisitions = self.shard_of(acquisitions)
+        if getattr(self, 'incremental_config', _IncrementalConfig()).enabled:
+            # only acquisitions whose manifest is missing or stale
+            acquisitions = self.stale_acquisitions(acquisitions)
+        return self.preflight(acquisitions, report=report)
+
+    def preflight(self, acquisitions, policy=None, report=True):
+        """
+            Validate the inputs of acquisitions from their NIfTI
+            headers and json sidecars, before anything is run, and
+            write the report to derivatives/<report_dir>
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+            policy : str
+                'exclude' or 'fail', by default the configured one
+            report : bool
+                write the report, False for a dry run (see plan)
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                the valid pairs
+
+            Raises
+            ------
+            ValueError
+                for invalid acquisitions with the 'fail' policy
+        """
+        preflight_config = getattr(self, 'preflight_config', _PreflightConfig())
+        policy = policy or preflight_config.policy
+        if policy not in ('exclude', 'fail'):
+            raise ValueError("Unknown preflight policy '%s', expected 'exclude' or 'fail'" % policy)
+        if not preflight_config.enabled or not acquisitions:
+            return acquisitions
+
+        from preflight import validate_acquisitions, write_report
+        problems = validate_acquisitions(self.bids_index(), acquisitions,
+                                         self.shares_anatomical(),
+                                         preflight_config.n_workers)
+        details = ''
+        if report:
+            details = ', see %s' % write_report(problems, len(acquisitions), policy,
+                                                 self.shard_output_dir(preflight_config.report_dir))
+        if not problems:
+            return acquisitions
+
+        for (subject_id, session_id), found in sorted(problems.items()):
+            print("Invalid sub-%s ses-%s: %s" % (subject_id, session_id, '; '.join(found)))
+        if policy == 'fail':
+            raise ValueError("%d of %d acquisitions failed validation%s"
+                             % (len(problems), len(acquisitions), details))
+        print("Excluded %d of %d acquisitions%s" % (len(problems), len(acquisitions), details))
+        return [acquisition for acquisition in acquisitions if acquisition not in problems]
+
+    def shard_of(self, acquisitions):
+        """
+            Select the acquisitions of this run's shard, balancing
+            on the size of the PET data for the 'balanced' strategy
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                all discovered (subject_id, session_id) pairs
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                pairs assigned to the shard
+        """
+        costs = self.pet_sizes(acquisitions) if self.shard_strategy == 'balanced' else None
+        return shard_acquisitions(acquisitions, *self.shard, strategy=self.shard_strategy, costs=costs)
+
+    def pet_sizes(self, acquisitions):
+        """
+            Size in bytes of the PET data of each acquisition, used 
+            as an estimate of its cost
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+
+            Returns
+            -------
+            sizes : dict
+                mapping of each pair to the size of its PET files
+        """
+        index = self.bids_index()
+        return {(subject_id, session_id): float(sum(os.path.getsize(path) for path in
+                                                index.files(subject_id, session_id)['pet']))
+                for subject_id, session_id in acquisitions}
+
+    def shard_output_dir(self, name):
+        """
+            Derivatives sub-directory of an output shared by all
+            acquisitions, with one folder per shard when sharded
+            (or per output label) so that concurrent runs do not 
+            overwrite each other
+        """
+        if self.output_label:
+            return os.path.join(self.derivatives, name, self.output_label)
+        if self.shard:
+            return os.path.join(self.derivatives, name, shard_label(*self.shard))
+        return os.path.join(self.derivatives, name)
+
+    def cohort_dir(self):
+        """
+            Output directory of the cohort kinetic modelling table,
+            with one folder per wave when the run is split in waves
+        """
+        if getattr(self, 'wave', None) is not None:
+            return os.path.join(self.shard_output_dir('km_cohort'), 'wave-%02d' % self.wave)
+        return self.shard_output_dir('km_cohort')
+
+    def next_wave(self, acquisitions):
+        """
+            Acquisitions of the next wave of a disk-budget limited
+            run: as many as fit the budget given the current size 
+            of the working dir (at least one)
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                pairs still to process
+
+            Returns
+            -------
+            wave : list of (str, str)
+                pairs to process next
+        """
+        from cleanup import directory_size, plan_waves
+
+        cleanup_config = getattr(self, 'cleanup_config', _CleanupConfig())
+        if cleanup_config.disk_budget_gb is None:
+            return list(acquisitions)
+
+        costs = {acquisition: size * cleanup_config.branch_factor
+                 for acquisition, size in self.pet_sizes(acquisitions).items()}
+        used = directory_size(self.base_dir) if os.path.isdir(self.base_dir) else 0.
+        return plan_waves(acquisitions, costs, cleanup_config.disk_budget_gb * 2.**30, used)[0]
+
+    def manifest_configs(self):
+        """
+            Config sections the derivatives of an acquisition
+            depend on, as recorded in its manifest
+
+            Returns
+            -------
+            configs : dict
+                mapping of section name to config values
+        """
+        configs = {'motion_correction': self.motion_correction_config,
+                   'parallel_motion_correction': getattr(self, 'parallel_motion_correction_config',
+                                                         _ParallelMotionCorrectionConfig()),
+                   'coregistration': self.coregistration_config,
+                   'reconall': self.reconall_config,
+                   'partial_volume_correction': self.pvc_config,
+                   'kinetic_modelling': getattr(self, 'kinetic_modelling_config', 
+                                                _KineticModellingConfig()),
+                   'image_format': getattr(self, 'image_format_config', _ImageFormatConfig())}
+        configs = {section: dict(configs[section].__dict__) for section in MANIFEST_SECTIONS}
+        sweep_config = getattr(self, 'sweep_config', _SweepConfig())
+        if sweep_config.variants():
+            configs['sweep'] = dict(sweep_config.__dict__)
+        pvc_engine_config = getattr(self, 'pvc_engine_config', _PVCEngineConfig())
+        if pvc_engine_config.backend != 'petsurfer':
+            configs['pvc_engine'] = dict(pvc_engine_config.__dict__)
+        return configs
+
+    def stale_acquisitions(self, acquisitions):
+        """
+            Filter acquisitions down to those whose derivative 
+            manifest is missing or out of date
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                pairs that need to be (re)processed
+        """
+        index = self.bids_index()
+        configs = self.manifest_configs()
+        versions = tool_versions()
+        # the anatomical inputs recorded by the manifest are those of select_anat
+        anat_all_sessions = self.shares_anatomical()
+        stale = []
+        for subject_id, session_id in acquisitions:
+            inputs = index.files(subject_id, session_id)
+            if anat_all_sessions:
+                inputs['anat'] = index.files(subject_id)['anat']
+            if is_stale(manifest_file(self.manifest_dir, subject_id, session_id), inputs, configs, versions):
+                stale.append((subject_id, session_id))
+        return stale
+
+    def node_resources(self, name):
+        """
+            Estimated number of threads ('n_procs') and memory 
+            ('mem_gb') of a node, combining the defaults with the 
+            per-node overrides of the scheduler config
+
+            Parameters
+            ----------
+            name : str
+                name of the node
+
+            Returns
+            -------
+            resources : dict
+                keyword arguments 'n_procs' and 'mem_gb' for Node
+        """
+        scheduler_config = getattr(self, 'scheduler_config', _SchedulerConfig())
+
+        resources = dict(_NODE_RESOURCES.get(name, _DEFAULT_RESOURCES))
+        resources.update(scheduler_config.resources.get(name, {}))
+        if name in getattr(self, 'mem_factors', {}):
+            # a node may not ask for more than the whole budget
+            resources['mem_gb'] = resources['mem_gb'] * self.mem_factors[name]
+            if scheduler_config.memory_gb is not None:
+                resources['mem_gb'] = min(resources['mem_gb'], scheduler_config.memory_gb)
+        return resources
+
+    def create_subjects_dir(directory, session_id, subject_id, variant='', run=''):
         """
             Map session ids and subject ids to 
             correcsponding directories for 
@@ -255,6 +977,12 @@ class PETPipeline:
                 session identifier
             subject_id : str 
                 unique subject identifier 
+            variant : str
+                label of the parameter sweep variant, prefixed to
+                the directory when given
+            run : str
+                label of the PET run, a sub-directory of the session 
+                when given
 
             Returns
             -------
@@ -266,7 +994,7 @@ class PETPipeline:
         import os
 
         dir_name = "sub-" +  subject_id + "/" + "ses-" + session_id
-        dir_path = os.path.join(directory,dir_name)
+        dir_path = os.path.join(directory, variant, dir_name, run)
         Path(dir_path).mkdir(parents=True, exist_ok=True)
         return os.path.abspath(dir_path)
             
@@ -291,6 +1019,413 @@ class PETPipeline:
         """
         return (session_id + "_" + subject_id)
     
+    def plugin_settings(self):
+        """
+            Translate the scheduler config into a nipype 
+            execution plugin and its arguments
+
+            Returns
+            -------
+            (plugin, plugin_args) : (str, dict)
+                name of the nipype plugin and its arguments
+        """
+        scheduler_config = getattr(self, 'scheduler_config', _SchedulerConfig())
+
+        if scheduler_config.backend not in _PLUGINS:
+            raise ValueError("Unknown scheduler backend '%s', expected one of %s"
+                             % (scheduler_config.backend, sorted(_PLUGINS)))
+
+        if scheduler_config.policy not in ('fifo', 'critical_path'):
+            raise ValueError("Unknown scheduler policy '%s', expected 'fifo' or 'critical_path'"
+                             % scheduler_config.policy)
+        if scheduler_config.policy == 'critical_path' and scheduler_config.backend != 'multiproc':
+            raise ValueError("The critical_path policy requires the 'multiproc' backend")
+
+        plugin = _PLUGINS[scheduler_config.backend]
+        plugin_args = {}
+        if plugin != 'Linear':
+            plugin_args['n_procs'] = scheduler_config.n_procs
+            if scheduler_config.memory_gb is not None:
+                plugin_args['memory_gb'] = scheduler_config.memory_gb
+        if scheduler_config.policy == 'critical_path':
+            # runtimes of the last profiled run, overridden by the configured estimates
+            from scheduling import load_estimates
+            profiling_config = getattr(self, 'profiling_config', _ProfilingConfig())
+            history = os.path.join(self.derivatives, profiling_config.out_dir, 'node_profile.tsv')
+            plugin_args['estimates'] = load_estimates(history if scheduler_config.history else None,
+                                                      scheduler_config.estimates)
+        return plugin, plugin_args
+
+    def runner(self, plugin, plugin_args):
+        """
+            Plugin handed to Workflow.run: the name of a nipype 
+            plugin, or a plugin instance for the critical path policy
+
+            Parameters
+            ----------
+            plugin : str
+                name of the nipype plugin
+            plugin_args : dict
+                complete plugin arguments, including callbacks
+        """
+        if 'estimates' in plugin_args:
+            from scheduling import CriticalPathPlugin
+            return CriticalPathPlugin(plugin_args=plugin_args)
+        return plugin
+
+    def validate_configs(self):
+        """
+            Check every config section without building the workflow
+
+            Raises
+            ------
+            ValueError, TraitError
+                for unknown options or invalid values
+        """
+        for interface_config in [self.motion_correction_config,
+                                 self.coregistration_config,
+                                 self.reconall_config]:
+            interface_config.validate()
+
+        self.plugin_settings()
+        kinetic_modelling_config = getattr(self, 'kinetic_modelling_config', _KineticModellingConfig())
+        if kinetic_modelling_config.backend not in ('petsurfer', 'native'):
+            raise ValueError("Unknown kinetic modelling backend '%s', expected 'petsurfer' or 'native'"
+                             % kinetic_modelling_config.backend)
+        pvc_engine_config = getattr(self, 'pvc_engine_config', _PVCEngineConfig())
+        if pvc_engine_config.backend not in ('petsurfer', 'native'):
+            raise ValueError("Unknown partial volume correction backend '%s', expected 'petsurfer' or 'native'"
+                             % pvc_engine_config.backend)
+        swept = set(getattr(self, 'sweep_config', _SweepConfig()).partial_volume_correction)
+        if pvc_engine_config.backend == 'native' and swept - {'psf', 'km_ref', 'km_hb'}:
+            raise ValueError("The native partial volume correction can only sweep psf, km_ref and km_hb, not %s"
+                             % ', '.join(sorted(swept - {'psf', 'km_ref', 'km_hb'})))
+
+    def branch_nodes(self):
+        """
+            Names of the nodes PETWorkflow runs once per acquisition
+            and once for the whole run, for the current configs
+
+            Returns
+            -------
+            (branch, joined) : (list of str, list of str)
+                per-acquisition nodes and nodes joined over all
+                acquisitions
+        """
+        kinetic_modelling_config = getattr(self, 'kinetic_modelling_config', _KineticModellingConfig())
+
+        branch = ['select_anat', 'select_pet', 'motion_correction', 'time_weighted_average', 'coregistration',
+                  'reconall', 'gtmseg', 'create_subjects_dir_pvc', 'partial_volume_correction',
+                  'midframes', 'create_subjects_dir_km', 'kinetic_modelling',
+                  'create_subjects_dir_km2', 'kinetic_modelling_', 'datasink']
+        if not getattr(self, 'reconall_cache_config', _ReconAllCacheConfig()).enabled:
+            branch.append('mapsubjects')
+        if kinetic_modelling_config.backend != 'native':
+            branch.extend(['combine_outputs', 'combine_'])
+        if getattr(self, 'image_format_config', _ImageFormatConfig()).intermediate == 'NIFTI':
+            branch.append('compress_outputs')
+        if getattr(self, 'incremental_config', _IncrementalConfig()).enabled:
+            branch.append('manifest')
+            if getattr(self, 'sweep_config', _SweepConfig()).variants():
+                branch.append('merge_variants')
+        if kinetic_modelling_config.cohort:
+            branch.append('merge_runs')
+
+        joined = ['cohort_kinetic_modelling'] if kinetic_modelling_config.cohort else []
+        return branch, joined
+
+    def plan(self):
+        """
+            Work a run would do, without building the workflow
+
+            Returns
+            -------
+            plan : dict
+                'discovered' and 'acquisitions' (pairs that would be
+                processed), their PET 'runs', 'branch_nodes', 
+                'joined_nodes', sweep 'variants' and the total number 
+                of 'node_runs'
+        """
+        self.validate_configs()
+        branch, joined = self.branch_nodes()
+        # a dry run: validate, but leave derivatives untouched
+        acquisitions = self.select_acquisitions(report=False)
+        variants = sorted(getattr(self, 'sweep_config', _SweepConfig()).variants())
+
+        n_variants = max(1, len(variants))
+        per_session = sum(n_variants if name in _SWEPT_NODES else 1 for name in branch if name in _SESSION_NODES)
+        per_run = sum(n_variants if name in _SWEPT_NODES else 1 for name in branch if name not in _SESSION_NODES)
+        runs = self.acquisition_runs(acquisitions)
+        node_runs = sum(per_session + len(runs[acquisition]) * per_run for acquisition in acquisitions)
+        if acquisitions:
+            # joined nodes run per variant, and so does the sweep_parameters node
+            node_runs += n_variants * len(joined) + len(variants)
+        return {'discovered': len(self.get_acquisitions()),
+                'acquisitions': acquisitions,
+                'runs': runs,
+                'branch_nodes': branch,
+                'joined_nodes': joined,
+                'variants': variants,
+                'node_runs': node_runs}
+
     def run(self):
+        if not self.shard:
+            self.execute()
+            return
+
+        try:
+            self.execute()
+        except BaseException:
+            write_marker(self.shard_dir, *self.shard, getattr(self, 'acquisitions', []), 'failed')
+            raise
+        write_marker(self.shard_dir, *self.shard, getattr(self, 'acquisitions', []), 'complete')
+
+    def execute(self):
+        if not getattr(self, 'acquisitions', True):
+            print("All acquisitions are up to date, nothing to run")
+            return
+
         self.preprocessing_workflow.write_graph(graph2use="flat")
-        self.preprocessing_workflow.run()
+        plugin, plugin_args = self.plugin_settings()
+
+        profiling_config = getattr(self, 'profiling_config', _ProfilingConfig())
+        cleanup_config = getattr(self, 'cleanup_config', _CleanupConfig())
+        retry_config = getattr(self, 'retry_config', _RetryConfig())
+
+        callbacks = []
+        if profiling_config.enabled:
+            # per-node wall time, cpu time, peak rss and i/o volume
+            from nipype import config as nipype_config
+            from profiling import NodeProfiler
+            nipype_config.enable_resource_monitor()
+            profiler = NodeProfiler()
+            callbacks.append(profiler)
+
+        acquisitions = self.acquisitions
+        remaining = list(acquisitions)
+        execgraphs = []
+        self.failures = {}
+        kept_rows = self.kept_cohort_rows()
+        try:
+            while remaining:
+                # new branches are admitted in waves that fit the disk budget
+                wave = self.next_wave(remaining) if cleanup_config.enabled else remaining
+                if len(wave) < len(acquisitions):
+                    self.wave = (getattr(self, 'wave', None) or 0) + 1
+                    self.PETWorkflow(wave)
+                remaining = remaining[len(wave):]
+                self.run_isolated(wave, plugin, plugin_args, callbacks, execgraphs)
+        finally:
+            self.acquisitions = acquisitions
+            self.failed = sorted(acquisition for acquisition, entry in self.failures.items()
+                                 if not entry['recovered'])
+            n_waves, self.wave = getattr(self, 'wave', None), None
+            if n_waves is not None:
+                self.merge_wave_tables(n_waves)
+            if kept_rows:
+                # the cohort fit only covered the acquisitions of this run
+                from kinetics import add_cohort_rows
+                for table, rows in kept_rows.items():
+                    add_cohort_rows(table, rows)
+            if n_waves is not None or kept_rows:
+                self.update_results([])
+            if retry_config.enabled:
+                from failures import write_summary
+                summary_file = write_summary(self.failures, len(acquisitions), retry_config.max_retries,
+                                             self.shard_output_dir(retry_config.report_dir))
+            if profiling_config.enabled:
+                import networkx as nx
+                from profiling import write_report
+                write_report(profiler.records, nx.compose_all(execgraphs) if execgraphs else None,
+                             self.shard_output_dir(profiling_config.out_dir))
+
+        if self.failed:
+            # the run (and a shard marker) must not look complete
+            raise RuntimeError("%d of %d acquisitions failed after %d retries (%s), see %s"
+                               % (len(self.failed), len(acquisitions), retry_config.max_retries,
+                                  ', '.join('sub-%s ses-%s' % acquisition for acquisition in self.failed),
+                                  summary_file))
+
+    def run_isolated(self, acquisitions, plugin, plugin_args, callbacks, execgraphs):
+        """
+            Run the current workflow, built for acquisitions. With
+            retries enabled, a failed node only stops its own 
+            acquisition: once the other branches have finished, the
+            workflow of the failed acquisitions is rebuilt and rerun
+            (their completed nodes are cached), with more memory for
+            the nodes that ran out of it. The failures are recorded
+            in self.failures
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs of the current workflow
+            plugin : str
+                name of the nipype plugin
+            plugin_args : dict
+                plugin arguments
+            callbacks : list
+                status callbacks of every run (e.g. the profiler)
+            execgraphs : list
+                executed graphs, appended to
+        """
+        from failures import FailureTracker
+
+        retry_config = getattr(self, 'retry_config', _RetryConfig())
+        kinetic_modelling_config = getattr(self, 'kinetic_modelling_config', _KineticModellingConfig())
+
+        plugin_args = dict(plugin_args)
+        attempt = 0
+        while True:
+            tracker = FailureTracker()
+            try:
+                self.run_workflow(plugin, plugin_args, callbacks + [tracker], execgraphs)
+                failed = {}
+            except Exception:
+                failed = tracker.failed()
+                # failures outside the acquisition branches (joins) are not isolated
+                if not retry_config.enabled or not failed or ('', '') in failed:
+                    raise
+
+            done = [acquisition for acquisition in acquisitions if acquisition not in failed]
+            for acquisition in done:
+                if acquisition in self.failures:
+                    self.failures[acquisition]['recovered'] = True
+            for (subject_id, session_id), nodes in failed.items():
+                entry = self.failures.setdefault((subject_id, session_id), {'attempts': [], 'recovered': False})
+                entry['attempts'].append(nodes)
+                print("Failed sub-%s ses-%s: %s" % (subject_id, session_id, '; '.join(
+                                                    '%s: %s' % (node['itername'], node['error']) for node in nodes)))
+
+            if failed and done and kinetic_modelling_config.cohort:
+                # the cohort join waits for every branch, run it for the completed ones
+                self.wave = (getattr(self, 'wave', None) or 0) + 1
+                self.PETWorkflow(done)
+                self.run_workflow(plugin, plugin_args, callbacks, execgraphs)
+            self.update_results(done)
+
+            if not failed or attempt >= retry_config.max_retries:
+                return
+            attempt += 1
+            acquisitions = [acquisition for acquisition in acquisitions if acquisition in failed]
+
+            out_of_memory = {node['node'] for nodes in failed.values() for node in nodes if node['out_of_memory']}
+            for name in out_of_memory:
+                self.mem_factors[name] = self.mem_factors.get(name, 1.) * retry_config.mem_factor
+            if out_of_memory and 'n_procs' in plugin_args:
+                # fewer branches next to the ones that ran out of memory
+                plugin_args['n_procs'] = max(1, int(plugin_args['n_procs'] * retry_config.procs_factor))
+            print("Retrying %d acquisitions (attempt %d of %d)" % (len(acquisitions), attempt,
+                                                                  retry_config.max_retries))
+            self.wave = (getattr(self, 'wave', None) or 0) + 1
+            self.PETWorkflow(acquisitions)
+
+    def run_workflow(self, plugin, plugin_args, callbacks, execgraphs):
+        """
+            Run the current workflow once, cleaning up consumed
+            intermediates when enabled
+
+            Parameters
+            ----------
+            plugin : str
+                name of the nipype plugin
+            plugin_args : dict
+                plugin arguments
+            callbacks : list
+                status callbacks
+            execgraphs : list
+                executed graphs, appended to
+        """
+        # consumed intermediates are deleted under a disk budget
+        from cleanup import CallbackChain, IntermediateCleaner
+
+        cleanup_config = getattr(self, 'cleanup_config', _CleanupConfig())
+        callbacks = list(callbacks)
+        if cleanup_config.enabled:
+            cleaner = IntermediateCleaner(self.preprocessing_workflow, cleanup_config.nodes,
+                                          cleanup_config.patterns, cleanup_config.archive_dir)
+            callbacks.append(cleaner)
+        plugin_args = dict(plugin_args)
+        if callbacks:
+            plugin_args['status_callback'] = CallbackChain(*callbacks)
+
+        execgraphs.append(self.preprocessing_workflow.run(plugin=self.runner(plugin, plugin_args),
+                                                          plugin_args=plugin_args))
+        if cleanup_config.enabled:
+            print("Cleaned up %.1f GB of intermediates" % (cleaner.freed / 2.**30))
+
+    def update_results(self, acquisitions):
+        """
+            Ingest the results of finished acquisitions, and the
+            cohort tables, into the columnar results store
+
+            Parameters
+            ----------
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs to check for new results
+
+            Returns
+            -------
+            units : list of str
+                acquisitions / cohort tables (re)ingested
+        """
+        results_store_config = getattr(self, 'results_store_config', _ResultsStoreConfig())
+        if not results_store_config.enabled:
+            return []
+
+        from results import ResultsStore
+        store = ResultsStore(os.path.join(self.derivatives, results_store_config.store_dir),
+                             results_store_config.compact_segments)
+        return store.update(self.derivatives, acquisitions)
+
+    def merge_wave_tables(self, n_waves):
+        """
+            Concatenate the cohort tables of the waves of a run,
+            wave-01 to wave-<n_waves>, for every sweep variant,
+            ignoring the parts left by earlier runs
+        """
+        for table in self.cohort_tables():
+            name = os.path.relpath(table, self.cohort_dir())
+            parts = [path for path in (os.path.join(self.cohort_dir(), 'wave-%02d' % wave, name)
+                                       for wave in range(1, n_waves + 1)) if os.path.isfile(path)]
+            if parts:
+                concatenate_tables(parts, table)
+
+    def cohort_tables(self):
+        """
+            Cohort tables of a run, one per sweep variant
+        """
+        variants = sorted(getattr(self, 'sweep_config', _SweepConfig()).variants()) or ['']
+        return [os.path.join(self.cohort_dir(), variant, 'cohort_mrtm.tsv') for variant in variants]
+
+    def sharded_tables(self):
+        """
+            Per-shard tables of a run for the merge step: the cohort
+            table of every sweep variant and the node profiles
+        """
+        return sharded_tables(getattr(self, 'sweep_config', _SweepConfig()).variants(),
+                              getattr(self, 'profiling_config', _ProfilingConfig()).out_dir)
+
+    def kept_cohort_rows(self):
+        """
+            Rows of the cohort tables for the acquisitions of this
+            run's shard that are not processed again (up to date in 
+            an incremental run), so that the tables keep covering the
+            whole cohort
+
+            Returns
+            -------
+            rows : dict
+                mapping of cohort table to the rows to keep
+        """
+        if not getattr(self, 'kinetic_modelling_config', _KineticModellingConfig()).cohort:
+            return {}
+        discovered = self.get_acquisitions()
+        if self.shard:
+            discovered = self.shard_of(discovered)
+        kept = set(discovered) - set(self.acquisitions)
+        if not kept:
+            return {}
+
+        from kinetics import read_cohort_rows
+        return {table: read_cohort_rows(table, kept) for table in self.cohort_tables()}
@@ -0,0 +1,318 @@
+import os
+import re
+import json
+import fnmatch
+
+# File patterns indexed per modality folder, matching the
+# templates previously handed to SelectFiles
+_PATTERNS = {'anat': ('anat', ['*_T1w.nii', '*_T1w.nii.gz']),
+             'pet': ('pet', ['*_pet.nii', '*_pet.nii.gz']),
+             'json': ('pet', ['*_pet.json'])}
+
+_INDEX_VERSION = 1
+
+
+class BIDSIndex:
+
+    """
+        A persistent, incrementally refreshed index of the
+        anatomical and PET files of a BIDS dataset.
+
+        The index is stored as json and records the mtime of every
+        subject, session and modality folder; on refresh only the
+        folders whose mtime changed are listed again, so startup cost
+        is a few stat calls per session instead of a full crawl.
+
+        Attributes
+        ----------
+        data_dir : str
+            Path to the BIDS dataset
+        index_file : str
+            Path to the json file holding the index
+    """
+
+    def __init__(self, data_dir, index_file):
+        self.data_dir = os.path.abspath(data_dir)
+        self.index_file = index_file
+        self._index = self._load()
+
+    def _load(self):
+        empty = {'version': _INDEX_VERSION, 'data_dir': self.data_dir, 'subjects': {}}
+        if not os.path.isfile(self.index_file):
+            return empty
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except ValueError:
+            return empty
+        if index.get('version') != _INDEX_VERSION or index.get('data_dir') != self.data_dir:
+            return empty
+        return index
+
+    def save(self):
+        """
+            Atomically write the index to disk
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        tmp_file = self.index_file + '.%d.tmp' % os.getpid()
+        with open(tmp_file, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _list_dirs(path, prefix):
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries
+                          if entry.name.startswith(prefix) and entry.is_dir())
+
+    def _scan_session(self, session_dir):
+        folders = {}
+        for key, (folder, patterns) in _PATTERNS.items():
+            folder_path = os.path.join(session_dir, folder)
+            if folder not in folders:
+                folders[folder] = sorted(os.listdir(folder_path)) if os.path.isdir(folder_path) else []
+        rel_dir = os.path.relpath(session_dir, self.data_dir)
+        return {key: [os.path.join(rel_dir, folder, name) for name in folders[folder]
+                      if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+                for key, (folder, patterns) in _PATTERNS.items()}
+
+    def refresh(self):
+        """
+            Bring the index up to date with the dataset, listing
+            only the folders whose mtime changed since the last refresh
+
+            Returns
+            -------
+            changed : list of (str, str)
+                (subject_id, session_id) pairs that were added,
+                modified or removed
+        """
+        changed = []
+        subjects = self._index['subjects']
+        current = set(self._list_dirs(self.data_dir, 'sub-'))
+
+        for sub_dir in set(subjects) - current:
+            changed.extend((sub_dir[4:], ses_dir[4:]) for ses_dir in subjects.pop(sub_dir)['sessions'])
+
+        for sub_dir in sorted(current):
+            sub_path = os.path.join(self.data_dir, sub_dir)
+            sub_entry = subjects.setdefault(sub_dir, {'mtime': None, 'sessions': {}})
+            sessions = sub_entry['sessions']
+
+            sub_mtime = self._mtime(sub_path)
+            if sub_mtime != sub_entry['mtime']:
+                ses_dirs = set(self._list_dirs(sub_path, 'ses-'))
+                for ses_dir in set(sessions) - ses_dirs:
+                    del sessions[ses_dir]
+                    changed.append((sub_dir[4:], ses_dir[4:]))
+                for ses_dir in ses_dirs - set(sessions):
+                    sessions[ses_dir] = {'mtimes': {}, 'files': {}}
+                sub_entry['mtime'] = sub_mtime
+
+            for ses_dir, ses_entry in sessions.items():
+                ses_path = os.path.join(sub_path, ses_dir)
+                mtimes = {folder: self._mtime(os.path.join(ses_path, folder))
+                          for folder in ['.', 'anat', 'pet']}
+                if mtimes != ses_entry['mtimes']:
+                    ses_entry['mtimes'] = mtimes
+                    ses_entry['files'] = self._scan_session(ses_path)
+                    changed.append((sub_dir[4:], ses_dir[4:]))
+        return changed
+
+    def acquisitions(self):
+        """
+            List the (subject, session) pairs that have PET data
+
+            Returns
+            -------
+            acquisitions : list of (str, str)
+                sorted (subject_id, session_id) pairs
+        """
+        return sorted((sub_dir[4:], ses_dir[4:])
+                      for sub_dir, sub_entry in self._index['subjects'].items()
+                      for ses_dir, ses_entry in sub_entry['sessions'].items()
+                      if ses_entry['files'].get('pet'))
+
+    def runs(self, subject_id, session_id):
+        """
+            Labels of the PET runs of an acquisition, see pet_runs
+
+            Returns
+            -------
+            runs : list of str
+                sorted run labels, [''] for a single-run session
+        """
+        return sorted(pet_runs(self.files(subject_id, session_id)))
+
+    def files(self, subject_id, session_id=None):
+        """
+            Absolute paths of the indexed files of an acquisition
+
+            Parameters
+            ----------
+            subject_id : str
+                unique subject identifier
+            session_id : str
+                session identifier, None for all sessions of the subject
+
+            Returns
+            -------
+            files : dict
+                mapping of 'anat', 'pet' and 'json' to sorted lists of paths
+        """
+        sessions = self._index['subjects'].get('sub-' + subject_id, {}).get('sessions', {})
+        if session_id is not None:
+            sessions = {ses_dir: ses_entry for ses_dir, ses_entry in sessions.items()
+                        if ses_dir == 'ses-' + session_id}
+        return {key: sorted(os.path.join(self.data_dir, path)
+                            for ses_entry in sessions.values()
+                            for path in ses_entry['files'].get(key, []))
+                for key in _PATTERNS}
+
+
+def run_label(path):
+    """
+        Label of a PET run: the BIDS entities of the file name
+        between the session and the suffix, e.g. 'trc-raclopride_run-1'
+        for sub-01_ses-a_trc-raclopride_run-1_pet.nii.gz
+    """
+    name = re.sub(r'_pet\.(nii\.gz|nii|json)$', '', os.path.basename(path))
+    return '_'.join(entity for entity in name.split('_')
+                    if not entity.startswith(('sub-', 'ses-')))
+
+
+def pet_runs(files):
+    """
+        Pair the PET images and sidecars of a session by run
+
+        Parameters
+        ----------
+        files : dict
+            'pet' and 'json' lists of paths, see BIDSIndex.files
+
+        Returns
+        -------
+        runs : dict
+            mapping of run label to (pet, json), json is None when
+            missing. A session with a single PET image has the run
+            label '', so its outputs keep the single-run layout
+    """
+    sidecars = {run_label(path): path for path in files['json']}
+    if len(files['pet']) == 1:
+        json_file = sidecars.get(run_label(files['pet'][0]))
+        if json_file is None and len(files['json']) == 1:
+            json_file = files['json'][0]
+        return {'': (files['pet'][0], json_file)}
+    return {run_label(path): (path, sidecars.get(run_label(path))) for path in files['pet']}
+
+
+def acquisition_key(subject_id, session_id):
+    return 'sub-%s_ses-%s' % (subject_id, session_id)
+
+
+def write_inputs(inputs_dir, subject_id, session_id, anat, runs):
+    """
+        Write the input files of one acquisition, as resolved from
+        the index, for its select_anat and select_pet nodes
+
+        Parameters
+        ----------
+        inputs_dir : str
+            directory of the per-acquisition input files
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+        anat : list of str
+            T1w image(s)
+        runs : dict
+            mapping of run label to (pet, json), see pet_runs
+
+        Returns
+        -------
+        inputs_file : str
+    """
+    os.makedirs(inputs_dir, exist_ok=True)
+    inputs_file = os.path.join(inputs_dir, acquisition_key(subject_id, session_id) + '.json')
+    tmp_file = inputs_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'w') as f:
+        json.dump({'anat': anat, 'runs': runs}, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, inputs_file)
+    return inputs_file
+
+
+def read_inputs(inputs_dir, subject_id, session_id):
+    """
+        Read the input files of one acquisition, see write_inputs
+    """
+    inputs_file = os.path.join(inputs_dir, acquisition_key(subject_id, session_id) + '.json')
+    if not os.path.isfile(inputs_file):
+        return {'anat': [], 'runs': {}}
+    with open(inputs_file, 'r') as f:
+        return json.load(f)
+
+
+def select_anat(subject_id, session_id, inputs_dir):
+    """
+        Select the anatomical image(s) of an acquisition from its
+        input file, written when the workflow is built
+
+        Parameters
+        ----------
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+        inputs_dir : str
+            directory of the per-acquisition input files
+
+        Returns
+        -------
+        anat : str or list of str
+            T1w image(s)
+    """
+    from bidsindex import read_inputs
+
+    anat = read_inputs(inputs_dir, subject_id, session_id)['anat']
+    if not anat:
+        raise IOError("No anat file indexed for sub-%s ses-%s" % (subject_id, session_id))
+    return anat[0] if len(anat) == 1 else anat
+
+
+def select_pet(subject_id, session_id, run, inputs_dir):
+    """
+        Select the PET image and sidecar of a run of an acquisition
+        from its input file, written when the workflow is built
+
+        Parameters
+        ----------
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+        run : str
+            run label, see pet_runs
+        inputs_dir : str
+            directory of the per-acquisition input files
+
+        Returns
+        -------
+        pet : str
+            4D PET image
+        json : str
+            PET json sidecar
+    """
+    from bidsindex import read_inputs
+
+    pet, json_file = read_inputs(inputs_dir, subject_id, session_id)['runs'].get(run, (None, None))
+    if pet is None or json_file is None:
+        raise IOError("No %s file indexed for sub-%s ses-%s run '%s'"
+                      % ('pet' if pet is None else 'json', subject_id, session_id, run))
+    return pet, json_file
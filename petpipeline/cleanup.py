@@ -0,0 +1,201 @@
+import os
+import glob
+import shutil
+import logging
+
+import networkx as nx
+
+from nipype.interfaces.utility import IdentityInterface
+
+from profiling import acquisition_of, run_of, variant_of
+
+logger = logging.getLogger('nipype.workflow')
+
+
+def directory_size(path):
+    """
+        Total size in bytes of the files below a directory
+    """
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names
+               if not os.path.islink(os.path.join(root, name)))
+
+
+def plan_waves(acquisitions, costs, budget, used=0.):
+    """
+        Split acquisitions into consecutive waves whose estimated
+        working dir footprint fits the disk budget
+
+        Parameters
+        ----------
+        acquisitions : list of (str, str)
+            (subject_id, session_id) pairs in processing order
+        costs : dict
+            estimated footprint (bytes) of each pair
+        budget : float
+            disk budget (bytes) of the working dir
+        used : float
+            bytes already used in the working dir
+
+        Returns
+        -------
+        waves : list of list of (str, str)
+            every wave holds at least one acquisition
+    """
+    waves, wave, load = [], [], 0.
+    for acquisition in acquisitions:
+        if wave and used + load + costs[acquisition] > budget:
+            waves.append(wave)
+            wave, load = [], 0.
+        wave.append(acquisition)
+        load += costs[acquisition]
+    if wave:
+        waves.append(wave)
+    return waves
+
+
+class CallbackChain:
+
+    """
+        Forward nipype status callbacks to several callbacks
+    """
+
+    def __init__(self, *callbacks):
+        self.callbacks = callbacks
+
+    def __call__(self, node, status):
+        for callback in self.callbacks:
+            callback(node, status)
+
+
+class IntermediateCleaner:
+
+    """
+        A nipype status callback deleting (or archiving) the image
+        files a node wrote to the working dir as soon as every node
+        consuming its outputs in the same acquisition run, and every
+        join node consuming it, has finished. Within a parameter sweep
+        a consumer below the sweep has finished once all its variants
+        have. Join nodes only passing outputs on (IdentityInterface)
+        are looked through. Files are kept when a consumer fails, so
+        failed branches can be inspected.
+
+        Derivatives are never touched: only files inside the node
+        output dirs of the working dir are removed, and outputs
+        linked into derivatives keep their own link. The result and
+        hash files of a cleaned node are removed with its images, so
+        a later run (retry, new sweep variant, incremental rebuild)
+        runs the node again instead of reusing paths to removed files.
+
+        Parameters
+        ----------
+        workflow : nipype Workflow
+            workflow whose (unexpanded) graph gives the consumers
+        nodes : list of str
+            names of the nodes whose outputs may be cleaned
+        patterns : list of str
+            glob patterns of the files removed from a node output dir
+        archive_dir : str
+            move the files below this directory instead of deleting them
+
+        Attributes
+        ----------
+        freed : int
+            bytes removed from the working dir
+    """
+
+    def __init__(self, workflow, nodes, patterns, archive_dir=None):
+        graph = workflow._graph
+        self.base_dir = workflow.base_dir
+        self.patterns = patterns
+        self.archive_dir = archive_dir
+        self.joins = {node.name: node.joinsource for node in graph.nodes() if hasattr(node, 'joinsource')}
+
+        # nodes expanded once per variant of a parameter sweep
+        self.swept, self.variants = set(), ['']
+        for node in graph.nodes():
+            if node.name == 'sweepsource':
+                self.swept = {descendant.name for descendant in nx.descendants(graph, node)}
+                # nodes below a join over the variants run once
+                for join in graph.nodes():
+                    if getattr(join, 'joinsource', None) == 'sweepsource':
+                        self.swept -= {join.name} | {below.name for below in nx.descendants(graph, join)}
+                self.variants = list(dict(node.iterables if isinstance(node.iterables, list)
+                                          else [node.iterables])['variant'])
+
+        def consumers(node):
+            for consumer in graph.successors(node):
+                if consumer.name in self.joins and isinstance(consumer.interface, IdentityInterface):
+                    yield from consumers(consumer)
+                else:
+                    yield consumer.name
+
+        self.consumers = {node.name: set(consumers(node)) for node in graph.nodes() if node.name in nodes}
+        self.producers = {}
+        for name, names in self.consumers.items():
+            for consumer in names:
+                self.producers.setdefault(consumer, set()).add(name)
+        self.finished = set()
+        self.pending = {}
+        self.freed = 0
+
+    def __call__(self, node, status):
+        if status != 'end':
+            return
+        branch = acquisition_of(node) + (run_of(node), variant_of(node))
+        self.finished.add((node.name, branch))
+        if node.name in self.consumers and self.consumers[node.name]:
+            self.pending[(node.name, branch)] = node.output_dir()
+
+        if node.name in self.joins:
+            candidates = list(self.pending)
+        else:
+            producers = self.producers.get(node.name, set())
+            candidates = [key for key in self.pending if key[0] in producers and key[1][:2] == branch[:2]]
+        for key in candidates:
+            if self.consumed(*key):
+                self.clean(self.pending.pop(key))
+
+    def consumed(self, name, branch):
+        """
+            Whether every consumer of a node output has finished
+        """
+        return all((consumer, key) in self.finished
+                   for consumer in self.consumers[name] for key in self.consumer_keys(consumer, branch))
+
+    def consumer_keys(self, consumer, branch):
+        """
+            Branches of the consumer node reading an output of the
+            (subject_id, session_id, run, variant) branch: one per
+            variant when the consumer is swept and the producer is not
+        """
+        subject_id, session_id, run, variant = branch
+        if self.joins.get(consumer) == 'runsource':
+            # joins over the runs of a session stay in the session branch
+            run = ''
+        elif consumer in self.joins:
+            subject_id, session_id, run = '', '', ''
+        variants = [variant] if variant or consumer not in self.swept else self.variants
+        return [(subject_id, session_id, run, label) for label in variants]
+
+    def clean(self, output_dir):
+        cleaned = False
+        for pattern in self.patterns:
+            for path in glob.glob(os.path.join(output_dir, pattern)):
+                if not os.path.isfile(path) or os.path.islink(path):
+                    continue
+                size = os.path.getsize(path)
+                if self.archive_dir:
+                    target = os.path.join(self.archive_dir, os.path.relpath(path, self.base_dir))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                else:
+                    os.remove(path)
+                self.freed += size
+                cleaned = True
+                logger.info("Cleaned up %s (%.1f MB)", path, size / 2.**20)
+        if cleaned:
+            # invalidate the nipype cache of the node
+            for path in glob.glob(os.path.join(output_dir, '_0x*.json')) + \
+                        glob.glob(os.path.join(output_dir, 'result_*.pklz')):
+                os.remove(path)
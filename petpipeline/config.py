@@ -1,8 +1,5 @@
-import os
-from dataclasses import dataclass
-from nipype.interfaces.fsl.preprocess import MCFLIRTInputSpec
-from nipype.interfaces.freesurfer.registration import MRICoregInputSpec
-from nipype.interfaces.freesurfer.preprocess import ReconAllInputSpec
+import itertools
+from dataclasses import dataclass, field
 
 @dataclass
 class _EnvConfig:
@@ -28,30 +25,90 @@ class _EnvConfig:
     working_dir: str
     output_dir: str
 
-class _MotionCorrectionConfig(MCFLIRTInputSpec):
+class _InterfaceConfig:
 
     """
-        A configuration class for motion correction,
-        extends from Nipype MCFlirtInputSpec
+        Base class of the configurations passed through to a 
+        nipype interface. The nipype input spec is only imported 
+        by validate(), so loading a config does not import nipype
+
+        Attributes
+        ----------
+        _spec : (str, str)
+            module and class name of the nipype input spec
     """
+
+    _spec = None
+
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+
+    def validate(self):
+        """
+            Check the options against the nipype input spec
+
+            Raises
+            ------
+            ValueError
+                for options that are not inputs of the interface
+            TraitError
+                for values the input spec does not accept
+        """
+        import importlib
+
+        module, name = self._spec
+        spec = getattr(importlib.import_module(module), name)()
+        unknown = sorted(set(self.__dict__) - set(spec.copyable_trait_names()))
+        if unknown:
+            raise ValueError("Unknown %s options: %s" % (name, ', '.join(unknown)))
+        spec.trait_set(**self.__dict__)
+
+class _MotionCorrectionConfig(_InterfaceConfig):
+
+    """
+        A configuration class for motion correction,
+        validated against Nipype MCFLIRTInputSpec
+    """
+
+    _spec = ('nipype.interfaces.fsl.preprocess', 'MCFLIRTInputSpec')
  
-class _CoregistrationConfig(MRICoregInputSpec):
+class _CoregistrationConfig(_InterfaceConfig):
     """
         A configuration class for coregistration,
-        extends from Nipype MRICoregInputSpec
+        validated against Nipype MRICoregInputSpec
     """
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
 
-class _ReconAllConfig(ReconAllInputSpec):
+    _spec = ('nipype.interfaces.freesurfer.registration', 'MRICoregInputSpec')
+
+class _ReconAllConfig(_InterfaceConfig):
     """
         A configuration class for recon-all,
-        extends from Nipype ReconAllInputSpec
+        validated against Nipype ReconAllInputSpec
     """
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+
+    _spec = ('nipype.interfaces.freesurfer.preprocess', 'ReconAllInputSpec')
+
+@dataclass
+class _ParallelMotionCorrectionConfig:
+
+    """
+        A configuration class for frame-parallel motion correction
+
+        Attributes
+        ----------
+        enabled : bool
+            Split the series into frame chunks registered in parallel
+            to the time weighted average, instead of a single MCFLIRT
+        n_chunks : int
+            Number of frame chunks
+        n_procs : int
+            Number of chunks registered at once
+
+    """
+
+    enabled: bool = False
+    n_chunks: int = 4
+    n_procs: int = 4
 
 @dataclass 
 class _PartialVolumeCorrectionConfig:
@@ -61,4 +118,384 @@ class _PartialVolumeCorrectionConfig:
     km_ref: list
     km_hb: list
     no_rescale: bool
-    save_input: bool
\ No newline at end of file
+    save_input: bool
+
+@dataclass
+class _PVCEngineConfig:
+
+    """
+        A configuration class for the partial volume correction engine
+
+        Attributes
+        ----------
+        backend : str
+            'petsurfer' runs mri_gtmpvc through petsurfer.GTMPVC, 
+            'native' solves the ROI-level GTM in-process (only the
+            psf, km_ref and km_hb options are used)
+        cache : bool
+            Keep the region spread matrix of each subject and PSF in
+            freesurfer/.gtm_cache, so later sessions and sweep 
+            variants only solve the GTM system
+
+    """
+
+    backend: str = 'petsurfer'
+    cache: bool = True
+
+@dataclass
+class _ReconAllCacheConfig:
+
+    """
+        A configuration class for the recon-all cache
+
+        Attributes
+        ----------
+        enabled : bool
+            Reuse recon-all outputs keyed on a hash of the T1w 
+            content and the recon-all config
+        share_across_sessions : bool
+            Use one anatomical per subject (from its first session)
+            and run recon-all once for all sessions (requires enabled)
+        adopt_legacy : bool
+            Reuse a completed '<session>_<subject>' directory of an 
+            earlier non-cached run as a cache hit. Its T1w is not 
+            checked, only enable it for subjects dirs known to match 
+            the dataset
+
+    """
+
+    enabled: bool = False
+    share_across_sessions: bool = False
+    adopt_legacy: bool = False
+
+@dataclass
+class _KineticModellingConfig:
+
+    """
+        A configuration class for kinetic modelling
+
+        Attributes
+        ----------
+        backend : str
+            'petsurfer' runs mri_glmfit through petsurfer.MRTM/MRTM2,
+            'native' fits both models in-process with numpy
+        chunk_size : int
+            Number of voxels / ROIs fitted per batch by the
+            native backend, bounds its memory use
+        cohort : bool
+            Also fit the GTM ROI TACs of all acquisitions together
+            in one pass and write derivatives/km_cohort/cohort_mrtm.tsv
+
+    """
+
+    backend: str = 'petsurfer'
+    chunk_size: int = 100000
+    cohort: bool = False
+
+@dataclass
+class _SchedulerConfig:
+
+    """
+        A configuration class for workflow execution
+
+        Attributes
+        ----------
+        backend : str
+            Execution backend: 'serial', 'multiproc' or 'pool'
+        n_procs : int
+            Total number of cores available to the workflow
+        memory_gb : float
+            Total memory budget (GB) available to the workflow
+        resources : dict
+            Per-node overrides of the default estimates, e.g.
+            {'reconall': {'n_procs': 4, 'mem_gb': 8}}
+        policy : str
+            'fifo' (nipype order) or 'critical_path': ready nodes with
+            the longest estimated remaining path (recon-all, gtmseg)
+            are dispatched first, multiproc backend only
+        estimates : dict
+            Per-node runtime estimates (seconds) for 'critical_path',
+            e.g. {'reconall': 21600}
+        history : bool
+            Estimate runtimes from the profile table of the last
+            profiled run when available
+
+    """
+
+    backend: str = 'serial'
+    n_procs: int = 1
+    memory_gb: float = None
+    resources: dict = field(default_factory=dict)
+    policy: str = 'fifo'
+    estimates: dict = field(default_factory=dict)
+    history: bool = True
+
+@dataclass
+class _ProfilingConfig:
+
+    """
+        A configuration class for per-node profiling
+
+        Attributes
+        ----------
+        enabled : bool
+            Turn on the nipype resource monitor and write a per-node
+            profile table and summary after the run
+        out_dir : str
+            Output directory (relative to derivatives)
+
+    """
+
+    enabled: bool = False
+    out_dir: str = 'profiling'
+
+@dataclass
+class _IncrementalConfig:
+
+    """
+        A configuration class for incremental re-execution
+
+        Attributes
+        ----------
+        enabled : bool
+            Write a manifest (input hashes, config sections, tool
+            versions) per acquisition under derivatives/manifests and
+            only build branches for acquisitions whose manifest is 
+            missing or stale, independently of the working dir
+
+    """
+
+    enabled: bool = False
+
+@dataclass
+class _ImageFormatConfig:
+
+    """
+        A configuration class for the image file format
+
+        Attributes
+        ----------
+        intermediate : str
+            'NIFTI' (uncompressed) or 'NIFTI_GZ' format of the images
+            written inside the working dir by FSL and python nodes
+        compress_level : int
+            gzip level of the images handed to the DataSink
+        n_threads : int
+            Number of threads compressing the images handed to the
+            DataSink (pigz when installed)
+
+    """
+
+    intermediate: str = 'NIFTI'
+    compress_level: int = 6
+    n_threads: int = 4
+
+@dataclass
+class _DataSinkConfig:
+
+    """
+        A configuration class for storing outputs in derivatives
+
+        Attributes
+        ----------
+        link_mode : str
+            'auto' (reflink, then hardlink), 'reflink', 'hardlink' or
+            'copy'. Files are copied when linking is not possible,
+            e.g. across filesystems
+
+    """
+
+    link_mode: str = 'auto'
+
+@dataclass
+class _CleanupConfig:
+
+    """
+        A configuration class for cleaning up intermediates during a run
+
+        Attributes
+        ----------
+        enabled : bool
+            Delete the image files of the listed nodes from the working
+            dir once every node consuming them has finished
+        nodes : list
+            Nodes whose outputs are cleaned up
+        patterns : list
+            Glob patterns of the files removed from a node output dir
+        archive_dir : str
+            Move the files below this directory instead of deleting them
+        disk_budget_gb : float
+            Working dir budget (GB); acquisitions are started in waves
+            whose estimated footprint fits the budget. None disables
+            the throttling
+        branch_factor : float
+            Estimated working dir footprint of an acquisition, as a 
+            multiple of the size of its PET data
+
+    """
+
+    enabled: bool = False
+    nodes: list = field(default_factory=lambda: ['motion_correction', 'time_weighted_average',
+                                                 'compress_outputs', 'partial_volume_correction'])
+    patterns: list = field(default_factory=lambda: ['*.nii', '*.nii.gz', '*.mgz'])
+    archive_dir: str = None
+    disk_budget_gb: float = None
+    branch_factor: float = 8.0
+
+@dataclass
+class _RetryConfig:
+
+    """
+        A configuration class for isolating failed acquisitions and
+        retrying them
+
+        Attributes
+        ----------
+        enabled : bool
+            Finish the run of the other acquisitions when nodes of an
+            acquisition fail, then rebuild and rerun the workflow of
+            the failed ones (their completed nodes are cached)
+        max_retries : int
+            Number of reruns of a failed acquisition
+        mem_factor : float
+            Factor applied to the memory estimate of a node for each
+            rerun after it ran out of memory
+        procs_factor : float
+            Factor applied to the cores of the scheduler for a rerun
+            after a node ran out of memory, so that fewer branches 
+            run next to each other
+        report_dir : str
+            Directory of the failure summary.json, relative to 
+            derivatives
+
+    """
+
+    enabled: bool = False
+    max_retries: int = 1
+    mem_factor: float = 1.5
+    procs_factor: float = 1.0
+    report_dir: str = 'failures'
+
+@dataclass
+class _PreflightConfig:
+
+    """
+        A configuration class for the pre-flight validation of the
+        selected acquisitions, from NIfTI headers and json sidecars
+
+        Attributes
+        ----------
+        enabled : bool
+            Check the T1w, PET image and frame timing of every 
+            selected acquisition before the workflow is built
+        policy : str
+            'exclude' drops the invalid acquisitions from the run,
+            'fail' stops the run before anything is executed
+        n_workers : int
+            Number of threads reading headers
+        report_dir : str
+            Directory of report.json, relative to derivatives
+
+    """
+
+    enabled: bool = False
+    policy: str = 'exclude'
+    n_workers: int = 8
+    report_dir: str = 'preflight'
+
+@dataclass
+class _ResultsStoreConfig:
+
+    """
+        A configuration class for the columnar results store
+
+        Attributes
+        ----------
+        enabled : bool
+            Collect the GTM ROI TACs, MRTM / MRTM2 estimates and 
+            motion summaries of every finished acquisition into
+            derivatives/<store_dir>
+        store_dir : str
+            Store directory, relative to derivatives
+        compact_segments : int
+            Number of incremental segments after which the store is
+            rewritten as a single segment
+
+    """
+
+    enabled: bool = False
+    store_dir: str = 'results_store'
+    compact_segments: int = 16
+
+@dataclass
+class _WatchConfig:
+
+    """
+        A configuration class for the watch-mode service
+
+        Attributes
+        ----------
+        state_file : str
+            Json file persisting the status of every acquisition
+            (relative to the experiment directory)
+        poll_s : float
+            Seconds between two polls of the data directory
+        settle_s : float
+            Seconds the files of an acquisition must stay unchanged
+            before it is processed
+        n_workers : int
+            Maximum number of acquisitions processed at once
+
+    """
+
+    state_file: str = 'watch_state.json'
+    poll_s: float = 60.
+    settle_s: float = 300.
+    n_workers: int = 2
+
+@dataclass
+class _SweepConfig:
+
+    """
+        A configuration class for parameter sweeps
+
+        Attributes
+        ----------
+        partial_volume_correction : dict
+            Lists of values per partial volume correction option, e.g.
+            {'psf': [4, 6, 8]}. Every combination is a variant; only
+            partial volume correction and kinetic modelling are run
+            per variant, into pvc/<variant>, km/<variant> and 
+            km2/<variant>
+
+    """
+
+    partial_volume_correction: dict = field(default_factory=dict)
+
+    def variants(self):
+        """
+            Variants of the sweep
+
+            Returns
+            -------
+            variants : dict
+                mapping of variant label (e.g. 'psf-4_km_ref-8.47') 
+                to the values of the swept options, empty without sweep
+        """
+        keys = sorted(self.partial_volume_correction)
+        if not keys:
+            return {}
+        variants = {}
+        for values in itertools.product(*[self.partial_volume_correction[key] for key in keys]):
+            label = '_'.join('%s-%s' % (key, _slug(value)) for key, value in zip(keys, values))
+            variants[label] = dict(zip(keys, values))
+        return variants
+
+def _slug(value):
+    """
+        Label of a swept value, lists joined with '+' and spaces
+        and slashes replaced so that it fits a folder name
+    """
+    if isinstance(value, (list, tuple)):
+        return '+'.join(_slug(item) for item in value)
+    return str(value).replace(' ', '.').replace('/', '.')
@@ -0,0 +1,134 @@
+import os
+import shutil
+import threading
+
+from nipype.interfaces.base import traits
+from nipype.interfaces import io as nio
+from nipype.interfaces.io import DataSink, DataSinkInputSpec, DataSinkOutputSpec
+from nipype.utils.filemanip import get_related_files
+
+# ioctl request of the Linux FICLONE call (copy-on-write clone of a file)
+_FICLONE = 0x40049409
+
+# Strategies tried in order for each link mode, copying is the fallback
+_STRATEGIES = {'auto': ['reflink', 'hardlink', 'copy'],
+               'reflink': ['reflink', 'copy'],
+               'hardlink': ['hardlink', 'copy'],
+               'copy': ['copy']}
+
+# nipype.interfaces.io.copyfile is swapped while a sink runs
+_PATCH_LOCK = threading.Lock()
+
+
+def reflink(src, dst):
+    """
+        Copy-on-write clone of src at dst (btrfs, XFS, ...),
+        raises OSError where the filesystem does not support it
+    """
+    import fcntl
+
+    try:
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+
+def place_file(src, dst, link_mode='auto'):
+    """
+        Make dst hold the content of src without copying it when
+        both are on the same filesystem
+
+        Parameters
+        ----------
+        src : str
+            source file in the working dir
+        dst : str
+            destination file in the derivatives dir
+        link_mode : str
+            'auto' (reflink, then hardlink), 'reflink', 'hardlink'
+            or 'copy'; every mode falls back to copying
+
+        Returns
+        -------
+        strategy : str
+            'reflink', 'hardlink' or 'copy'
+    """
+    if os.path.lexists(dst):
+        if 'hardlink' in _STRATEGIES[link_mode] and os.path.exists(dst) and os.path.samefile(src, dst):
+            return 'hardlink'
+        os.remove(dst)
+
+    same_device = os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+    for strategy in _STRATEGIES[link_mode]:
+        if strategy == 'copy':
+            shutil.copy2(src, dst)
+            return strategy
+        if not same_device:
+            continue
+        try:
+            if strategy == 'reflink':
+                reflink(src, dst)
+            else:
+                os.link(src, dst)
+            return strategy
+        except (OSError, ImportError):
+            continue
+
+
+class LinkingDataSinkInputSpec(DataSinkInputSpec):
+    link_mode = traits.Enum('auto', 'reflink', 'hardlink', 'copy', usedefault=True,
+                            desc="how files are placed in the base directory, "
+                                 "falling back to a copy across filesystems")
+
+
+class LinkingDataSinkOutputSpec(DataSinkOutputSpec):
+    strategies = traits.Dict(desc="strategy used for every stored file")
+
+
+class LinkingDataSink(DataSink):
+
+    """
+        DataSink that reflinks or hardlinks outputs into the base
+        directory instead of copying them. Destination paths,
+        including substitutions, are computed by DataSink; only the
+        final placement of each file is replaced.
+
+        The strategy used for every file is returned in the
+        'strategies' output and logged.
+    """
+
+    input_spec = LinkingDataSinkInputSpec
+    output_spec = LinkingDataSinkOutputSpec
+
+    def _list_outputs(self):
+        strategies = {}
+        link_mode = self.inputs.link_mode
+
+        def sink_file(originalfile, newfile, copy=False, create_new=False, hashmethod=None,
+                      use_hardlink=False, copy_related_files=True):
+            related = list(zip(get_related_files(originalfile), get_related_files(newfile))) \
+                      if copy_related_files else [(originalfile, newfile)]
+            for src, dst in related:
+                if os.path.isfile(src):
+                    strategies[dst] = place_file(src, dst, link_mode)
+                    nio.iflogger.debug("%s: %s %s", strategies[dst], src, dst)
+            return newfile
+
+        with _PATCH_LOCK:
+            copyfile = nio.copyfile
+            nio.copyfile = sink_file
+            try:
+                outputs = super(LinkingDataSink, self)._list_outputs()
+            finally:
+                nio.copyfile = copyfile
+
+        counts = {}
+        for strategy in strategies.values():
+            counts[strategy] = counts.get(strategy, 0) + 1
+        nio.iflogger.info("DataSink placed files by %s",
+                          ', '.join('%s: %d' % item for item in sorted(counts.items())) or 'none')
+        outputs['strategies'] = strategies
+        return outputs
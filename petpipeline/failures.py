@@ -0,0 +1,110 @@
+import os
+import re
+import json
+
+from profiling import acquisition_of, run_of
+
+# Signs of a node killed for lack of memory: python / C++ allocation
+# errors, the OOM killer (SIGKILL, exit code 137) and dead pool workers
+_OUT_OF_MEMORY = re.compile(r'MemoryError|Cannot allocate memory|[Oo]ut of memory|bad_alloc|'
+                            r'BrokenProcessPool|Killed|[Ee]xit code:? ?(137|-9)\b|[Rr]eturn code:? ?(137|-9)\b')
+
+
+def node_error(node):
+    """
+        Traceback of a failed node: set by the distributed plugins
+        after the status callback, otherwise saved in its result file
+    """
+    traceback = getattr(node, '_traceback', None)
+    if traceback is None:
+        try:
+            traceback = node.result.runtime.traceback
+        except Exception:
+            traceback = None
+    if isinstance(traceback, (list, tuple)):
+        traceback = ''.join(traceback)
+    return traceback or ''
+
+
+def is_out_of_memory(error):
+    """
+        Whether a node traceback shows it ran out of memory
+    """
+    return bool(_OUT_OF_MEMORY.search(error))
+
+
+class FailureTracker:
+
+    """
+        A nipype status callback recording the failed nodes of a
+        run by acquisition, so that the failed branches can be
+        retried on their own once the healthy ones have finished
+
+        Attributes
+        ----------
+        nodes : list of nipype Node
+            failed nodes, in order of failure
+    """
+
+    def __init__(self):
+        self.nodes = []
+
+    def __call__(self, node, status):
+        if status == 'exception':
+            self.nodes.append(node)
+
+    def failed(self):
+        """
+            Failed nodes by acquisition
+
+            Returns
+            -------
+            failed : dict
+                mapping of (subject_id, session_id) to a list of
+                dicts with the 'node', 'itername', 'run', the last
+                line of the 'error' and whether it is 'out_of_memory';
+                ('', '') holds the nodes outside the acquisition
+                branches (e.g. join nodes)
+        """
+        failed = {}
+        for node in self.nodes:
+            error = node_error(node)
+            lines = [line for line in error.splitlines() if line.strip()]
+            failed.setdefault(acquisition_of(node), []).append({'node': node.name,
+                                                                'itername': node.itername,
+                                                                'run': run_of(node),
+                                                                'error': lines[-1].strip() if lines else '',
+                                                                'out_of_memory': is_out_of_memory(error)})
+        return failed
+
+
+def write_summary(failures, n_acquisitions, max_retries, out_dir):
+    """
+        Write the failure summary of a run, summary.json in out_dir
+
+        Parameters
+        ----------
+        failures : dict
+            mapping of (subject_id, session_id) to the failed nodes
+            of every attempt (see FailureTracker.failed) and whether
+            the acquisition was 'recovered' by a retry
+        n_acquisitions : int
+            number of acquisitions of the run
+        max_retries : int
+            configured number of retries
+
+        Returns
+        -------
+        summary_file : str
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    summary_file = os.path.join(out_dir, 'summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump({'acquisitions': n_acquisitions,
+                   'failed': sum(not entry['recovered'] for entry in failures.values()),
+                   'recovered': sum(entry['recovered'] for entry in failures.values()),
+                   'max_retries': max_retries,
+                   'failures': [dict(entry, subject_id=subject_id, session_id=session_id)
+                                for (subject_id, session_id), entry in sorted(failures.items())]},
+                  f, indent=2)
+    return summary_file
@@ -0,0 +1,379 @@
+import os
+import hashlib
+
+import numpy as np
+
+# FWHM to standard deviation of a gaussian
+_FWHM_TO_SIGMA = 1. / (2. * np.sqrt(2. * np.log(2.)))
+
+# Spread values below this fraction of a region's maximum are dropped
+_SPREAD_EPS = 1e-4
+
+
+def read_lta(lta_file):
+    """
+        Read a FreeSurfer linear transform (LTA) as a RAS to RAS
+        matrix from the source (moving) to the destination volume
+
+        Parameters
+        ----------
+        lta_file : str
+            path to the .lta file
+
+        Returns
+        -------
+        ras2ras : ndarray, shape (4, 4)
+            source scanner RAS to destination scanner RAS
+    """
+    with open(lta_file, 'r') as f:
+        lines = [line.split('#')[0].strip() for line in f]
+    lines = [line for line in lines if line]
+
+    lta_type = None
+    volumes = {}
+    current = None
+    matrix = None
+    for index, line in enumerate(lines):
+        if line.startswith('type'):
+            lta_type = int(line.split('=')[1])
+        elif matrix is None and line.split() == ['1', '4', '4']:
+            matrix = np.array([[float(value) for value in lines[index + row].split()]
+                               for row in range(1, 5)])
+        elif line in ('src volume info', 'dst volume info'):
+            current = volumes.setdefault(line.split()[0], {})
+        elif current is not None and '=' in line:
+            key, value = [part.strip() for part in line.split('=', 1)]
+            current[key] = value
+
+    if matrix is None:
+        raise ValueError("No transform found in %s" % lta_file)
+    if lta_type == 1:
+        return matrix
+    if lta_type == 0:
+        # voxel to voxel: convert with the geometry of both volumes
+        return lta_vox2ras(volumes['dst']) @ matrix @ np.linalg.inv(lta_vox2ras(volumes['src']))
+    raise ValueError("Unsupported LTA type %s in %s" % (lta_type, lta_file))
+
+
+def lta_vox2ras(info):
+    """
+        Voxel to scanner RAS matrix of an LTA volume info block
+    """
+    dims = np.array(info['volume'].split(), dtype=float)
+    zooms = np.array(info['voxelsize'].split(), dtype=float)
+    mdc = np.column_stack([np.array(info[axis].split(), dtype=float)
+                           for axis in ('xras', 'yras', 'zras')]) * zooms
+    cras = np.array(info['cras'].split(), dtype=float)
+
+    vox2ras = np.eye(4)
+    vox2ras[:3, :3] = mdc
+    vox2ras[:3, 3] = cras - mdc @ (dims / 2.)
+    return vox2ras
+
+
+def read_ctab(ctab_file):
+    """
+        Segmentation id to name mapping of a FreeSurfer color table
+    """
+    names = {}
+    if ctab_file and os.path.isfile(ctab_file):
+        with open(ctab_file, 'r') as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) >= 2 and tokens[0].isdigit():
+                    names[int(tokens[0])] = tokens[1]
+    return names
+
+
+def region_fractions(seg_img, pet_shape, pet_affine, ras2ras, slab=16):
+    """
+        Fraction of every PET voxel occupied by every segmentation
+        label, by mapping each segmentation voxel centre into the
+        PET grid
+
+        Parameters
+        ----------
+        seg_img : nibabel image
+            segmentation in anatomical space
+        pet_shape : tuple
+            3D shape of the PET grid
+        pet_affine : ndarray, shape (4, 4)
+            voxel to scanner RAS matrix of the PET grid
+        ras2ras : ndarray, shape (4, 4)
+            PET scanner RAS to anatomical scanner RAS
+        slab : int
+            number of segmentation slices mapped at once
+
+        Returns
+        -------
+        fractions : scipy.sparse.csc_matrix, shape (n_voxels, n_regions)
+            partial volume fraction of every region in every PET voxel
+        segids : ndarray
+            segmentation id of every region (column)
+        nvox : ndarray
+            number of segmentation voxels of every region
+    """
+    from scipy import sparse
+
+    seg2pet = np.linalg.inv(pet_affine) @ np.linalg.inv(ras2ras) @ seg_img.affine
+    n_voxels = int(np.prod(pet_shape))
+
+    # segmentation ids, read slab by slab to bound memory
+    seg = seg_img.dataobj
+    segids = np.unique(np.concatenate([np.unique(np.asarray(seg[..., start:start + slab]))
+                                       for start in range(0, seg_img.shape[2], slab)]))
+    segids = segids[segids != 0].astype(int)
+    columns = np.full(segids.max() + 1 if segids.size else 1, -1, dtype=np.int64)
+    columns[segids] = np.arange(segids.size)
+
+    counts = sparse.csr_matrix((n_voxels, segids.size))
+    totals = np.zeros(n_voxels)
+    nvox = np.zeros(segids.size)
+    for start in range(0, seg_img.shape[2], slab):
+        labels = np.asarray(seg[..., start:start + slab]).astype(np.int64)
+        i, j, k = np.indices(labels.shape)
+        coords = np.stack([i.ravel(), j.ravel(), k.ravel() + start, np.ones(labels.size)])
+        pet_vox = np.rint(seg2pet[:3] @ coords).astype(np.int64)
+        inside = np.all((pet_vox >= 0) & (pet_vox < np.array(pet_shape)[:, np.newaxis]), axis=0)
+        index = np.ravel_multi_index(pet_vox[:, inside], pet_shape)
+        labels = labels.ravel()[inside]
+
+        totals += np.bincount(index, minlength=n_voxels)
+        labelled = labels != 0
+        region = columns[labels[labelled]]
+        nvox += np.bincount(region, minlength=segids.size)
+        counts = counts + sparse.csr_matrix((np.ones(region.size), (index[labelled], region)),
+                                            shape=(n_voxels, segids.size))
+
+    scale = sparse.diags(np.divide(1., totals, out=np.zeros_like(totals), where=totals > 0))
+    return (scale @ counts).tocsc(), segids, nvox
+
+
+def blur_columns(fractions, pet_shape, zooms, psf):
+    """
+        Blur every region map with the isotropic gaussian PSF of
+        the scanner, within the bounding box of the region
+
+        Parameters
+        ----------
+        fractions : scipy.sparse.csc_matrix, shape (n_voxels, n_regions)
+            region maps on the PET grid
+        pet_shape : tuple
+            3D shape of the PET grid
+        zooms : tuple
+            voxel size (mm) of the PET grid
+        psf : float
+            FWHM (mm) of the point spread function
+
+        Returns
+        -------
+        spread : scipy.sparse.csc_matrix, shape (n_voxels, n_regions)
+            region spread functions
+    """
+    from scipy import sparse
+    from scipy.ndimage import gaussian_filter
+
+    if not psf:
+        return fractions.tocsc()
+
+    sigma = float(psf) * _FWHM_TO_SIGMA / np.asarray(zooms, dtype=float)
+    pad = np.ceil(4 * sigma).astype(int)
+    rows, cols, values = [], [], []
+    for column in range(fractions.shape[1]):
+        voxels = fractions[:, column]
+        index = voxels.indices
+        if not index.size:
+            continue
+        coords = np.array(np.unravel_index(index, pet_shape))
+        low = np.maximum(coords.min(axis=1) - pad, 0)
+        high = np.minimum(coords.max(axis=1) + pad + 1, pet_shape)
+
+        block = np.zeros(high - low)
+        block[tuple(coords - low[:, np.newaxis])] = voxels.data
+        block = gaussian_filter(block, sigma, mode='constant')
+
+        keep = np.nonzero(block > _SPREAD_EPS * block.max())
+        rows.append(np.ravel_multi_index(tuple(np.array(keep) + low[:, np.newaxis]), pet_shape))
+        cols.append(np.full(keep[0].size, column))
+        values.append(block[keep])
+
+    if not values:
+        return sparse.csc_matrix(fractions.shape)
+    return sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=fractions.shape)
+
+
+def spread_digest(segmentation, reg_file, pet_shape, pet_affine, psf):
+    """
+        Cache key of a region spread matrix: segmentation file,
+        registration, PET geometry and PSF
+    """
+    stat = os.stat(segmentation)
+    sha = hashlib.sha256()
+    sha.update(('%s %d %d' % (os.path.abspath(segmentation), stat.st_size, stat.st_mtime_ns)).encode())
+    with open(reg_file, 'rb') as f:
+        sha.update(f.read())
+    sha.update(np.asarray(pet_shape, dtype=np.int64).tobytes())
+    sha.update(np.round(np.asarray(pet_affine, dtype=np.float64), 6).tobytes())
+    sha.update(str(float(psf)).encode())
+    return sha.hexdigest()
+
+
+def region_spread(segmentation, reg_file, pet_shape, pet_affine, zooms, psf, cache_dir=None):
+    """
+        Sparse region spread matrix of a subject, cached per
+        subject, PSF, registration and PET geometry
+
+        Returns
+        -------
+        (spread, segids, nvox) :
+            see region_fractions and blur_columns
+    """
+    import nibabel as nib
+    from scipy import sparse
+
+    cache_file = None
+    if cache_dir:
+        subject = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(segmentation))))
+        digest = spread_digest(segmentation, reg_file, pet_shape, pet_affine, psf)
+        cache_file = os.path.join(cache_dir, '%s_psf%s_%s.npz' % (subject, psf, digest[:12]))
+        if os.path.isfile(cache_file):
+            cached = np.load(cache_file)
+            spread = sparse.csc_matrix((cached['data'], cached['indices'], cached['indptr']),
+                                       shape=tuple(cached['shape']))
+            return spread, cached['segids'], cached['nvox']
+
+    fractions, segids, nvox = region_fractions(nib.load(segmentation), pet_shape, pet_affine,
+                                               read_lta(reg_file))
+    spread = blur_columns(fractions, pet_shape, zooms, psf)
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_file, data=spread.data, indices=spread.indices, indptr=spread.indptr,
+                 shape=np.array(spread.shape), segids=segids, nvox=nvox)
+        os.replace(tmp_file, cache_file)
+    return spread, segids, nvox
+
+
+def solve_gtm(spread, in_file, frames_per_chunk=8):
+    """
+        Solve the GTM system for all frames at once: the normal
+        equations X'X b = X'y share X'X, and X'y is accumulated
+        while streaming the frames
+
+        Parameters
+        ----------
+        spread : scipy.sparse.csc_matrix, shape (n_voxels, n_regions)
+            region spread matrix X
+        in_file : str
+            4D PET series on the grid of the spread matrix
+        frames_per_chunk : int
+            number of frames read from disk at a time
+
+        Returns
+        -------
+        tacs : ndarray, shape (n_regions, n_frames)
+            GTM corrected regional time activity curves
+    """
+    import nibabel as nib
+    from utils import iter_frame_chunks
+
+    img = nib.load(in_file, mmap=True, keep_file_open=True)
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+
+    rows = np.unique(spread.indices)
+    x = spread.tocsr()[rows]
+    xtx = (x.T @ x).toarray()
+    xty = np.zeros((spread.shape[1], n_frames))
+    for start, chunk in iter_frame_chunks(img, frames_per_chunk):
+        y = chunk.reshape(-1, chunk.shape[3])[rows]
+        xty[:, start:start + chunk.shape[3]] = x.T @ y
+
+    try:
+        return np.linalg.solve(xtx, xty)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(xtx) @ xty
+
+
+def region_mean(tacs, segids, nvox, labels):
+    """
+        Volume weighted mean TAC of a group of regions
+
+        Parameters
+        ----------
+        labels : list of str
+            segmentation ids, e.g. ['8 47'] as in the config
+    """
+    wanted = {int(segid) for group in labels for segid in str(group).split()}
+    selected = np.isin(segids, list(wanted))
+    if not selected.any():
+        raise ValueError("None of the regions %s are in the segmentation" % sorted(wanted))
+    weights = nvox[selected] / nvox[selected].sum()
+    return weights @ tacs[selected]
+
+
+def native_gtmpvc(in_file, segmentation, reg_file, pvc_dir, psf, km_ref, km_hb, cache_dir=None):
+    """
+        ROI-level geometric transfer matrix partial volume correction,
+        a replacement of mri_gtmpvc for pipelines that only need the
+        regional estimates and the MRTM reference / high-binding TACs
+
+        Parameters
+        ----------
+        in_file : str
+            motion corrected 4D PET series
+        segmentation : str
+            gtmseg segmentation (anatomical space)
+        reg_file : str
+            LTA registration from PET to anatomical space
+        pvc_dir : str
+            output directory
+        psf : float
+            FWHM (mm) of the scanner point spread function
+        km_ref : list of str
+            segmentation ids of the reference region
+        km_hb : list of str
+            segmentation ids of the high-binding region
+        cache_dir : str
+            directory caching the region spread matrices
+
+        Returns
+        -------
+        ref_file : str
+            reference TAC, km.ref.tac.dat
+        hb_nifti : str
+            high-binding TAC, km.hb.tac.nii.gz (1 x 1 x 1 x frames)
+        gtm_file : str
+            regional TACs, gtm.nii.gz (regions x 1 x 1 x frames)
+        gtm_stats : str
+            regions of gtm_file, gtm.stats.dat
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from gtm import region_spread, solve_gtm, region_mean, read_ctab
+
+    img = nib.load(in_file)
+    spread, segids, nvox = region_spread(segmentation, reg_file, img.shape[:3], img.affine,
+                                         img.header.get_zooms()[:3], psf, cache_dir)
+    tacs = solve_gtm(spread, in_file)
+
+    os.makedirs(pvc_dir, exist_ok=True)
+    ref_file = os.path.join(pvc_dir, 'km.ref.tac.dat')
+    np.savetxt(ref_file, region_mean(tacs, segids, nvox, km_ref), fmt='%g')
+
+    hb_nifti = os.path.join(pvc_dir, 'km.hb.tac.nii.gz')
+    hb = region_mean(tacs, segids, nvox, km_hb)
+    nib.Nifti1Image(hb.reshape(1, 1, 1, -1).astype(np.float32), np.eye(4)).to_filename(hb_nifti)
+
+    gtm_file = os.path.join(pvc_dir, 'gtm.nii.gz')
+    nib.Nifti1Image(tacs.reshape(len(segids), 1, 1, -1).astype(np.float32),
+                    np.eye(4)).to_filename(gtm_file)
+
+    names = read_ctab(os.path.join(os.path.dirname(segmentation), 'gtmseg.ctab'))
+    gtm_stats = os.path.join(pvc_dir, 'gtm.stats.dat')
+    with open(gtm_stats, 'w') as f:
+        for index, (segid, count) in enumerate(zip(segids, nvox)):
+            f.write('%3d %5d %-40s %10d\n' % (index + 1, segid, names.get(int(segid), 'region%d' % segid), count))
+    return ref_file, hb_nifti, gtm_file, gtm_stats
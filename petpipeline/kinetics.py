@@ -0,0 +1,488 @@
+import os
+
+import numpy as np
+
+
+def cumulative_integral(values, times):
+    """
+        Trapezoidal running integral of time activity curves,
+        starting from zero activity at time zero
+
+        Parameters
+        ----------
+        values : ndarray, shape (..., n_frames)
+            time activity curves
+        times : ndarray, shape (n_frames,)
+            frame mid-times
+
+        Returns
+        -------
+        integral : ndarray, shape (..., n_frames)
+            integral of the curves from 0 to each frame mid-time
+    """
+    times = np.concatenate([[0.], times])
+    padded = np.concatenate([np.zeros(values.shape[:-1] + (1,)), values], axis=-1)
+    steps = np.diff(times) * (padded[..., 1:] + padded[..., :-1]) / 2.
+    return np.cumsum(steps, axis=-1)
+
+
+def batched_lstsq(design, target):
+    """
+        Solve one small least-squares problem per row at once
+        through the normal equations
+
+        Parameters
+        ----------
+        design : ndarray, shape (n, n_frames, n_params)
+            design matrix of every row
+        target : ndarray, shape (n, n_frames)
+            time activity curve of every row
+
+        Returns
+        -------
+        beta : ndarray, shape (n, n_params)
+            least-squares estimates
+    """
+    xtx = np.einsum('ntp,ntq->npq', design, design)
+    xty = np.einsum('ntp,nt->np', design, target)
+    return np.einsum('npq,nq->np', np.linalg.pinv(xtx), xty)
+
+
+def mrtm(tacs, ref, times, chunk_size=100000):
+    """
+        Fit the three parameter multilinear reference tissue model
+        (MRTM, Ichise 2003) to many time activity curves at once
+
+            C(T) = g1 int(Cref) + g2 int(C) + g3 Cref(T)
+
+        Parameters
+        ----------
+        tacs : ndarray, shape (n, n_frames)
+            time activity curves (voxels or ROIs)
+        ref : ndarray, shape (n_frames,) or (n, n_frames)
+            reference region time activity curve, shared or per curve
+        times : ndarray, shape (n_frames,)
+            frame mid-times, k2p is in the inverse of their unit
+        chunk_size : int
+            number of curves fitted per batch, bounds memory use
+
+        Returns
+        -------
+        beta : ndarray, shape (n, 3)
+            model coefficients (g1, g2, g3)
+        bp : ndarray, shape (n,)
+            binding potential, -(g1 / g2 + 1)
+        k2p : ndarray, shape (n,)
+            reference region efflux rate, g1 / g3
+    """
+    tacs = np.asarray(tacs, dtype=np.float64)
+    ref = np.broadcast_to(np.asarray(ref, dtype=np.float64), tacs.shape)
+
+    beta = np.zeros((tacs.shape[0], 3))
+    for start in range(0, tacs.shape[0], chunk_size):
+        chunk = tacs[start:start + chunk_size]
+        ref_chunk = ref[start:start + chunk_size]
+        design = np.empty(chunk.shape + (3,))
+        design[..., 0] = cumulative_integral(ref_chunk, times)
+        design[..., 1] = cumulative_integral(chunk, times)
+        design[..., 2] = ref_chunk
+        beta[start:start + chunk_size] = batched_lstsq(design, chunk)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bp = np.nan_to_num(-(beta[:, 0] / beta[:, 1] + 1.))
+        k2p = np.nan_to_num(beta[:, 0] / beta[:, 2])
+    return beta, bp, k2p
+
+
+def mrtm2(tacs, ref, times, k2p, chunk_size=100000):
+    """
+        Fit the two parameter multilinear reference tissue model
+        (MRTM2, Ichise 2003) with a fixed k2' to many time activity
+        curves at once
+
+            C(T) = g1 (int(Cref) + Cref(T) / k2') + g2 int(C)
+
+        Parameters
+        ----------
+        tacs : ndarray, shape (n, n_frames)
+            time activity curves (voxels or ROIs)
+        ref : ndarray, shape (n_frames,) or (n, n_frames)
+            reference region time activity curve, shared or per curve
+        times : ndarray, shape (n_frames,)
+            frame mid-times, in the time unit of k2p
+        k2p : float or ndarray, shape (n,)
+            reference region efflux rate, usually estimated by MRTM
+        chunk_size : int
+            number of curves fitted per batch, bounds memory use
+
+        Returns
+        -------
+        beta : ndarray, shape (n, 2)
+            model coefficients (g1, g2), zero where k2p is zero or
+            not finite (e.g. a failed MRTM fit)
+        bp : ndarray, shape (n,)
+            binding potential, -(g1 / g2 + 1)
+    """
+    tacs = np.asarray(tacs, dtype=np.float64)
+    ref = np.broadcast_to(np.asarray(ref, dtype=np.float64), tacs.shape)
+    k2p = np.broadcast_to(np.asarray(k2p, dtype=np.float64), tacs.shape[:1])
+    valid = np.isfinite(k2p) & (k2p != 0)
+
+    beta = np.zeros((tacs.shape[0], 2))
+    for start in range(0, tacs.shape[0], chunk_size):
+        rows = np.flatnonzero(valid[start:start + chunk_size]) + start
+        if not len(rows):
+            continue
+        chunk = tacs[rows]
+        ref_chunk = ref[rows]
+        design = np.empty(chunk.shape + (2,))
+        design[..., 0] = cumulative_integral(ref_chunk, times) + ref_chunk / k2p[rows, np.newaxis]
+        design[..., 1] = cumulative_integral(chunk, times)
+        beta[rows] = batched_lstsq(design, chunk)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bp = np.nan_to_num(-(beta[:, 0] / beta[:, 1] + 1.))
+    return beta, bp
+
+
+def load_inputs(in_file, time_file, ref_file):
+    """
+        Read the inputs of a kinetic model fit in the formats
+        produced by midframes and mri_gtmpvc
+
+        Parameters
+        ----------
+        in_file : str
+            4D image of time activity curves (e.g. km.hb.tac.nii.gz)
+        time_file : str
+            text file of frame mid-times in seconds
+        ref_file : str
+            text file of the reference region time activity curve
+
+        Returns
+        -------
+        img : nibabel image
+            the input image
+        tacs : ndarray, shape (n_voxels, n_frames)
+            flattened time activity curves
+        ref : ndarray, shape (n_frames,)
+            reference curve
+        times : ndarray, shape (n_frames,)
+            frame mid-times in seconds, as passed to mri_glmfit, so
+            that k2' is in the same unit (1/s) for both backends
+    """
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    tacs = data.reshape(-1, data.shape[-1])
+    ref = np.loadtxt(ref_file, ndmin=1)
+    times = np.loadtxt(time_file, ndmin=1)
+    return img, tacs, ref, times
+
+
+def save_map(values, img, out_file):
+    """
+        Save per-voxel model outputs in the geometry of the input
+
+        Parameters
+        ----------
+        values : ndarray, shape (n_voxels,) or (n_voxels, k)
+            values to save
+        img : nibabel image
+            input image providing shape and affine
+        out_file : str
+            output file path
+    """
+    import nibabel as nib
+
+    shape = img.shape[:-1] + values.shape[1:]
+    nib.Nifti1Image(values.reshape(shape).astype(np.float32), img.affine).to_filename(out_file)
+
+
+def native_mrtm(in_file, time_file, ref_file, glm_dir, chunk_size=100000):
+    """
+        In-process replacement for petsurfer.MRTM, writing
+        beta, bp and k2prime into glm_dir like mri_glmfit --mrtm1
+
+        Parameters
+        ----------
+        in_file : str
+            4D image of time activity curves
+        time_file : str
+            text file of frame mid-times in seconds
+        ref_file : str
+            text file of the reference region time activity curve
+        glm_dir : str
+            output directory
+        chunk_size : int
+            number of curves fitted per batch
+
+        Returns
+        -------
+        glm_dir : str
+            output directory
+        k2p_file : str
+            text file with the mean k2' estimate
+        bp_file : str
+            binding potential image
+    """
+    import os
+    import numpy as np
+    from kinetics import load_inputs, save_map, mrtm
+
+    img, tacs, ref, times = load_inputs(in_file, time_file, ref_file)
+    beta, bp, k2p = mrtm(tacs, ref, times, chunk_size)
+
+    os.makedirs(glm_dir, exist_ok=True)
+    save_map(beta, img, os.path.join(glm_dir, 'beta.nii.gz'))
+    bp_file = os.path.join(glm_dir, 'bp.nii.gz')
+    save_map(bp, img, bp_file)
+    k2p_file = os.path.join(glm_dir, 'k2prime.dat')
+    np.savetxt(k2p_file, [np.mean(k2p[np.any(tacs != 0, axis=1)])], fmt='%g')
+    return os.path.abspath(glm_dir), os.path.abspath(k2p_file), os.path.abspath(bp_file)
+
+
+def native_mrtm2(in_file, time_file, ref_file, k2p_file, glm_dir, chunk_size=100000):
+    """
+        In-process replacement for petsurfer.MRTM2, writing
+        beta and bp into glm_dir like mri_glmfit --mrtm2
+
+        Parameters
+        ----------
+        in_file : str
+            4D image of time activity curves
+        time_file : str
+            text file of frame mid-times in seconds
+        ref_file : str
+            text file of the reference region time activity curve
+        k2p_file : str
+            text file with the k2' estimate written by native_mrtm
+        glm_dir : str
+            output directory
+        chunk_size : int
+            number of curves fitted per batch
+
+        Returns
+        -------
+        glm_dir : str
+            output directory
+        bp_file : str
+            binding potential image
+    """
+    import os
+    import numpy as np
+    from kinetics import load_inputs, save_map, mrtm2
+    from utils import extract_value_from_file
+
+    img, tacs, ref, times = load_inputs(in_file, time_file, ref_file)
+    k2p = extract_value_from_file(k2p_file)
+    if not np.isfinite(k2p) or k2p == 0:
+        raise ValueError("Invalid k2' estimate %g in %s" % (k2p, k2p_file))
+    beta, bp = mrtm2(tacs, ref, times, k2p, chunk_size)
+
+    os.makedirs(glm_dir, exist_ok=True)
+    save_map(beta, img, os.path.join(glm_dir, 'beta.nii.gz'))
+    bp_file = os.path.join(glm_dir, 'bp.nii.gz')
+    save_map(bp, img, bp_file)
+    return os.path.abspath(glm_dir), os.path.abspath(bp_file)
+
+
+def read_gtm_regions(gtm_stats, n_regions):
+    """
+        Read the segmentation id and name of every GTM region
+        from the gtm.stats.dat file written by mri_gtmpvc
+
+        Parameters
+        ----------
+        gtm_stats : str
+            path to gtm.stats.dat, may be None
+        n_regions : int
+            number of regions in the GTM TAC image
+
+        Returns
+        -------
+        regions : list of (int, str)
+            segmentation id and name of each region
+    """
+    regions = []
+    if gtm_stats and os.path.isfile(gtm_stats):
+        with open(gtm_stats, 'r') as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) >= 3 and tokens[0].isdigit() and tokens[1].isdigit():
+                    regions.append((int(tokens[1]), tokens[2]))
+    if len(regions) != n_regions:
+        regions = [(index, 'region%d' % index) for index in range(n_regions)]
+    return regions
+
+
+def cohort_kinetic_modelling(subject_id, session_id, gtm_file, gtm_stats, ref_file,
+                             hb_file, time_file, out_dir, chunk_size=100000, variant=None, run=None):
+    """
+        Fit MRTM and MRTM2 to the GTM ROI TACs of a whole cohort
+        in a single vectorized pass and write one cohort table.
+
+        Acquisitions sharing a frame schedule are stacked into one
+        array; k2' is estimated per acquisition with MRTM on its
+        high-binding TAC and fixed for the MRTM2 fit of every region.
+
+        Parameters
+        ----------
+        subject_id : list of str
+            subject identifier of every acquisition
+        session_id : list of str
+            session identifier of every acquisition
+        gtm_file : list of str
+            GTM ROI TACs (gtm.nii.gz) of every acquisition
+        gtm_stats : list of str
+            gtm.stats.dat of every acquisition
+        ref_file : list of str
+            reference TAC (km.ref.tac.dat) of every acquisition
+        hb_file : list of str
+            high-binding TAC (km.hb.tac.nii.gz) of every acquisition
+        time_file : list of str
+            frame mid-times in seconds of every acquisition
+        out_dir : str
+            output directory for the cohort table
+        chunk_size : int
+            number of curves fitted per batch
+        variant : str
+            label of the parameter sweep variant, the table is then
+            written to out_dir/<variant>
+        run : list of list of str
+            PET run labels of every acquisition; the file inputs are
+            then lists of the runs of every acquisition
+
+        Returns
+        -------
+        out_file : str
+            path to the cohort table (tsv)
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from kinetics import mrtm, mrtm2, read_gtm_regions
+
+    if run is None:
+        run = [''] * len(subject_id)
+    else:
+        # one entry per run of every acquisition
+        counts = [len(runs) for runs in run]
+        subject_id, session_id = [[value for value, count in zip(values, counts) for _ in range(count)]
+                                  for values in (subject_id, session_id)]
+        gtm_file, gtm_stats, ref_file, hb_file, time_file = [[value for runs in values for value in runs]
+                                                             for values in (gtm_file, gtm_stats, ref_file,
+                                                                            hb_file, time_file)]
+        run = [label for runs in run for label in runs]
+
+    acquisitions = []
+    for index in range(len(subject_id)):
+        tacs = np.asarray(nib.load(gtm_file[index]).dataobj, dtype=np.float64)
+        tacs = tacs.reshape(-1, tacs.shape[-1])
+        hb = np.asarray(nib.load(hb_file[index]).dataobj, dtype=np.float64)
+        hb = hb.reshape(-1, hb.shape[-1]).mean(axis=0)
+        acquisitions.append({'subject_id': subject_id[index],
+                             'session_id': session_id[index],
+                             'run': run[index],
+                             'tacs': tacs,
+                             'hb': hb,
+                             'ref': np.loadtxt(ref_file[index], ndmin=1),
+                             'times': np.loadtxt(time_file[index], ndmin=1),
+                             'regions': read_gtm_regions(gtm_stats[index], tacs.shape[0])})
+
+    # stack acquisitions that share a frame schedule
+    groups = {}
+    for acquisition in acquisitions:
+        groups.setdefault(tuple(np.round(acquisition['times'], 4)), []).append(acquisition)
+
+    rows = []
+    for group in groups.values():
+        times = group[0]['times']
+        refs = np.stack([acquisition['ref'] for acquisition in group])
+        _, _, k2p = mrtm(np.stack([acquisition['hb'] for acquisition in group]), refs, times)
+
+        n_regions = [acquisition['tacs'].shape[0] for acquisition in group]
+        tacs = np.concatenate([acquisition['tacs'] for acquisition in group])
+        roi_refs = np.repeat(refs, n_regions, axis=0)
+        roi_k2p = np.repeat(k2p, n_regions)
+        _, bp_mrtm, k2p_mrtm = mrtm(tacs, roi_refs, times, chunk_size)
+        _, bp_mrtm2 = mrtm2(tacs, roi_refs, times, roi_k2p, chunk_size)
+
+        row = 0
+        for acquisition, acquisition_k2p in zip(group, k2p):
+            for segid, name in acquisition['regions']:
+                rows.append((acquisition['subject_id'], acquisition['session_id'], acquisition['run'], segid, name,
+                             k2p_mrtm[row], bp_mrtm[row], acquisition_k2p, bp_mrtm2[row]))
+                row += 1
+
+    if variant:
+        out_dir = os.path.join(out_dir, variant)
+    os.makedirs(out_dir, exist_ok=True)
+    out_file = os.path.join(out_dir, 'cohort_mrtm.tsv')
+    with open(out_file, 'w') as f:
+        f.write('subject_id\tsession_id\trun\tsegid\tregion\tmrtm_k2p\tmrtm_bp\tmrtm2_k2p\tmrtm2_bp\n')
+        for row in sorted(rows, key=lambda row: row[:4]):
+            f.write('%s\t%s\t%s\t%d\t%s\t%g\t%g\t%g\t%g\n' % row)
+    return os.path.abspath(out_file)
+
+
+def read_cohort_rows(table_file, acquisitions):
+    """
+        Rows of a cohort table belonging to some acquisitions
+
+        Parameters
+        ----------
+        table_file : str
+            cohort_mrtm.tsv written by cohort_kinetic_modelling
+        acquisitions : set of (str, str)
+            (subject_id, session_id) pairs
+
+        Returns
+        -------
+        rows : list of dict
+            empty when the table does not exist
+    """
+    if not os.path.isfile(table_file):
+        return []
+    with open(table_file, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        rows = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f if line.strip()]
+    return [row for row in rows if (row['subject_id'], row['session_id']) in acquisitions]
+
+
+def add_cohort_rows(table_file, rows):
+    """
+        Add rows to a cohort table for the acquisitions it does not
+        hold, e.g. the up to date acquisitions of an incremental run
+        whose cohort fit only covered the stale ones
+
+        Parameters
+        ----------
+        table_file : str
+            cohort_mrtm.tsv written by cohort_kinetic_modelling
+        rows : list of dict
+            rows read by read_cohort_rows
+
+        Returns
+        -------
+        n_added : int
+            number of rows added
+    """
+    if not rows or not os.path.isfile(table_file):
+        return 0
+    with open(table_file, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        current = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f if line.strip()]
+
+    present = {(row['subject_id'], row['session_id']) for row in current}
+    added = [row for row in rows if (row['subject_id'], row['session_id']) not in present]
+    merged = sorted(current + added, key=lambda row: (row['subject_id'], row['session_id'],
+                                                      row.get('run', ''), int(row['segid'])))
+    tmp_file = table_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in merged:
+            f.write('\t'.join(row.get(column, '') for column in header) + '\n')
+    os.replace(tmp_file, table_file)
+    return len(added)
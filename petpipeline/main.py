@@ -5,24 +5,54 @@ import argparse
 import yaml
 import os
 from PETPipeline import PETPipeline
+from sharding import parse_shard, merge_shards
 from config import _EnvConfig, \
                    _MotionCorrectionConfig, \
                    _PartialVolumeCorrectionConfig, \
+                   _PVCEngineConfig, \
                    _ReconAllConfig, \
-                   _CoregistrationConfig \
+                   _CoregistrationConfig, \
+                   _SchedulerConfig, \
+                   _ReconAllCacheConfig, \
+                   _KineticModellingConfig, \
+                   _ParallelMotionCorrectionConfig, \
+                   _ProfilingConfig, \
+                   _IncrementalConfig, \
+                   _ImageFormatConfig, \
+                   _DataSinkConfig, \
+                   _CleanupConfig, \
+                   _RetryConfig, \
+                   _PreflightConfig, \
+                   _ResultsStoreConfig, \
+                   _WatchConfig, \
+                   _SweepConfig
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "plan", "merge", "watch", "aggregate"],
+                        help="'run' the pipeline, 'plan' (print the work a run would do), "
+                             "'merge' the outputs of a sharded run, 'watch' the data directory "
+                             "and process new acquisitions as they arrive or 'aggregate' the "
+                             "results of all acquisitions into the results store")
     path = os.path.join(os.getcwd(),"petpipeline/config.yaml")
     parser.add_argument("-c", "--config", default=path)
-    parser.add_argument("-e", "--experiment_dir", default="/home/avneet/Desktop/PETWorkflow_",
+    # the environment options override the 'environment' section of the config
+    parser.add_argument("-e", "--experiment_dir", default=None,
                         help="The experiment directory")
-    parser.add_argument("-o", "--output_dir", default="output_dir/",
+    parser.add_argument("-o", "--output_dir", default=None,
                         help="The output directory (relative to the experiment directory)")
-    parser.add_argument("-w", "--working_dir", default="working_dir/",
+    parser.add_argument("-w", "--working_dir", default=None,
                         help="The working directory (relative to the experiment directory)")
-    parser.add_argument("-d", "--data_dir", default="data/",
-                        help="The data directory containing the bids dataset (relative to the experiment directory)")                        
+    parser.add_argument("-d", "--data_dir", default=None,
+                        help="The data directory containing the bids dataset (relative to the experiment directory)")
+    parser.add_argument("--shard", default=None, type=parse_shard,
+                        help="Only process shard k of N of the acquisitions, given as k/N")
+    parser.add_argument("--shard-strategy", default="hash", choices=["hash", "balanced"],
+                        help="Assign acquisitions to shards by a stable hash or by balanced PET data size")
+    parser.add_argument("--shards", default=None, type=int,
+                        help="Number of shards expected by 'merge' (default: read from the shard markers)")
+    parser.add_argument("--once", action="store_true",
+                        help="With 'watch', exit once no acquisition is ready or running")
     return parser.parse_args()
 
 def parse_yaml(file_path):
@@ -35,32 +65,101 @@ def parse_yaml(file_path):
             print(exc)
     return config
    
+def load_configs(config):
+    """
+        Build the configuration objects of the pipeline 
+        from a parsed yaml config
+
+        Parameters
+        ----------
+        config : dict
+            parsed yaml config
+
+        Returns
+        -------
+        configs : dict
+            keyword arguments for PETPipeline
+    """
+    return dict(env_config = _EnvConfig(**config['environment']),
+                motion_correction_config = _MotionCorrectionConfig(**config['motion_correction']),
+                parallel_motion_correction_config = _ParallelMotionCorrectionConfig(**config.get('parallel_motion_correction', {})),
+                coregistration_config = _CoregistrationConfig(**config['coregistration']),
+                reconall_config = _ReconAllConfig(**config['reconall']),
+                reconall_cache_config = _ReconAllCacheConfig(**config.get('reconall_cache', {})),
+                pvc_config = _PartialVolumeCorrectionConfig(**config['partial_volume_correction']),
+                pvc_engine_config = _PVCEngineConfig(**config.get('pvc_engine', {})),
+                kinetic_modelling_config = _KineticModellingConfig(**config.get('kinetic_modelling', {})),
+                scheduler_config = _SchedulerConfig(**config.get('scheduler', {})),
+                profiling_config = _ProfilingConfig(**config.get('profiling', {})),
+                incremental_config = _IncrementalConfig(**config.get('incremental', {})),
+                image_format_config = _ImageFormatConfig(**config.get('image_format', {})),
+                datasink_config = _DataSinkConfig(**config.get('datasink', {})),
+                cleanup_config = _CleanupConfig(**config.get('cleanup', {})),
+                retry_config = _RetryConfig(**config.get('retry', {})),
+                preflight_config = _PreflightConfig(**config.get('preflight', {})),
+                results_store_config = _ResultsStoreConfig(**config.get('results_store', {})),
+                sweep_config = _SweepConfig(**(config.get('sweep') or {})))
+   
+def print_plan(plan):
+    """
+        Print the work a run would do, as returned by PETPipeline.plan
+    """
+    acquisitions = plan['acquisitions']
+    print("Acquisitions: %d to process (%d discovered)" % (len(acquisitions), plan['discovered']))
+    for subject_id, session_id in acquisitions:
+        runs = [run for run in plan['runs'][(subject_id, session_id)] if run]
+        print("  sub-%s ses-%s%s" % (subject_id, session_id, " (runs: %s)" % ', '.join(runs) if runs else ""))
+    print("Nodes per acquisition (%d): %s" % (len(plan['branch_nodes']), ', '.join(plan['branch_nodes'])))
+    if plan['variants']:
+        print("Sweep variants (%d): %s" % (len(plan['variants']), ', '.join(plan['variants'])))
+    if plan['joined_nodes']:
+        print("Joined nodes (%d): %s" % (len(plan['joined_nodes']), ', '.join(plan['joined_nodes'])))
+    print("Node runs: %d" % plan['node_runs'])
+
 def main(argv):
     args = parse_args(argv)
 
-    if args.config:
-        config = parse_yaml(args.config)
-        env_config = _EnvConfig(**config['environment'])
-        motion_correction_config = _MotionCorrectionConfig(**config['motion_correction']) 
-        coregistration_config = _CoregistrationConfig(**config['coregistration'])
-        reconall_config = _ReconAllConfig(**config['reconall'])
-        pvc_config = _PartialVolumeCorrectionConfig(**config['partial_volume_correction'])
+    config = parse_yaml(args.config)
+    config['environment'].update({key: getattr(args, key)
+                                  for key in ('experiment_dir', 'output_dir', 'working_dir', 'data_dir')
+                                  if getattr(args, key) is not None})
+    configs = load_configs(config)
 
-    else:
-        env_config = _EnvConfig(experiment_dir=args.experiment_dir, \
-                        output_dir=args.output_dir, \
-                        working_dir=args.working_dir, \
-                        data_dir=args.data_dir)
-    
+    if args.command == "merge":
+        derivatives = os.path.join(configs['env_config'].experiment_dir, 'derivatives')
+        manifest_dir = os.path.join(derivatives, 'manifests') if configs['incremental_config'].enabled else None
+        pipeline = PETPipeline(**configs)
+        merged, problems = merge_shards(derivatives, args.shards, manifest_dir, pipeline.sharded_tables())
+        for problem in problems:
+            print("INCOMPLETE: " + problem)
+        print("Merge summary written to %s" % merged)
+        # the merged cohort tables
+        pipeline.update_results([])
+        return 1 if problems else 0
+
+    if args.command == "watch":
+        from watch import WatchService
+        watch_config = _WatchConfig(**config.get('watch', {}))
+        service = WatchService(configs, 
+                               os.path.join(configs['env_config'].experiment_dir, watch_config.state_file),
+                               watch_config.poll_s, watch_config.settle_s, watch_config.n_workers)
+        service.serve(once=args.once)
+        return 0
+
+    pipeline = PETPipeline(**configs, shard=args.shard, shard_strategy=args.shard_strategy)
+    if args.command == "plan":
+        print_plan(pipeline.plan())
+        return 0
+
+    if args.command == "aggregate":
+        units = pipeline.update_results(pipeline.get_acquisitions())
+        print("Results store updated with %d acquisitions / cohort tables" % len(units))
+        return 0
 
-    pipeline = PETPipeline(env_config=env_config,
-                           motion_correction_config = motion_correction_config, \
-                           coregistration_config = coregistration_config, \
-                           reconall_config = reconall_config, \
-                           pvc_config = pvc_config)
     pipeline.PETWorkflow()
     pipeline.run()
-    
+    return 0
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
     print(os.getcwd())
@@ -0,0 +1,194 @@
+import os
+import json
+import hashlib
+
+# Config sections whose values change the derivatives of an acquisition
+MANIFEST_SECTIONS = ['motion_correction', 'parallel_motion_correction', 'coregistration',
+                     'reconall', 'partial_volume_correction', 'kinetic_modelling', 'image_format']
+
+
+def file_fingerprint(path, previous=None):
+    """
+        Size, mtime and sha256 of a file. The hash of a previous
+        fingerprint is reused when size and mtime did not change,
+        so unchanged inputs are not read again
+
+        Parameters
+        ----------
+        path : str
+            path to the file
+        previous : dict
+            fingerprint recorded earlier for the same path
+
+        Returns
+        -------
+        fingerprint : dict
+            'path', 'size', 'mtime_ns' and 'sha256'
+    """
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and \
+       previous.get('mtime_ns') == stat.st_mtime_ns:
+        digest = previous['sha256']
+    else:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+    return {'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+
+
+def tool_versions():
+    """
+        Versions of the external tools used by the pipeline
+
+        Returns
+        -------
+        versions : dict
+            FSL and FreeSurfer versions, None when not installed
+    """
+    from nipype.interfaces import fsl, freesurfer
+
+    versions = {}
+    for name, info in [('fsl', fsl.Info), ('freesurfer', freesurfer.Info)]:
+        try:
+            versions[name] = info.version()
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+def normalize(configs):
+    """
+        Json round trip of the config sections, so that values
+        read back from a manifest compare equal (tuples -> lists)
+    """
+    return json.loads(json.dumps(configs, sort_keys=True, default=str))
+
+
+def manifest_file(manifest_dir, subject_id, session_id):
+    """
+        Path of the manifest of an acquisition
+
+        Parameters
+        ----------
+        manifest_dir : str
+            directory holding the manifests
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+
+        Returns
+        -------
+        path : str
+            <manifest_dir>/sub-<subject_id>_ses-<session_id>.json
+    """
+    return os.path.join(manifest_dir, 'sub-%s_ses-%s.json' % (subject_id, session_id))
+
+
+def load_manifest(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def is_stale(path, inputs, configs, versions):
+    """
+        Check whether the derivatives recorded by a manifest are
+        out of date with respect to the inputs, config and tools
+
+        Parameters
+        ----------
+        path : str
+            path to the manifest
+        inputs : dict
+            mapping of input name ('anat', 'pet', 'json') to lists of paths
+        configs : dict
+            current config sections (see MANIFEST_SECTIONS)
+        versions : dict
+            current tool versions
+
+        Returns
+        -------
+        stale : bool
+            True when the manifest is missing or any recorded
+            input hash, config value or tool version differs
+    """
+    manifest = load_manifest(path)
+    if manifest is None:
+        return True
+    if manifest.get('configs') != normalize(configs) or manifest.get('versions') != versions:
+        return True
+
+    recorded = manifest.get('inputs', {})
+    for name, paths in inputs.items():
+        previous = {entry['path']: entry for entry in recorded.get(name, [])}
+        if sorted(previous) != sorted(os.path.abspath(path) for path in paths):
+            return True
+        for input_path in paths:
+            entry = previous[os.path.abspath(input_path)]
+            if not os.path.isfile(input_path) or \
+               file_fingerprint(input_path, entry)['sha256'] != entry['sha256']:
+                return True
+    return False
+
+
+def write_manifest(subject_id, session_id, anat, pet, json_file, configs, manifest_dir,
+                   datasink_out=None, kinetic_modelling_out=None):
+    """
+        Record the input hashes, config sections and tool versions
+        of an acquisition once all its derivatives are written
+
+        Parameters
+        ----------
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+        anat, pet, json_file : str or list of str
+            input files of the acquisition
+        configs : dict
+            config sections the derivatives depend on
+        manifest_dir : str
+            directory holding the manifests
+        datasink_out, kinetic_modelling_out :
+            outputs of the last nodes of the branch, only used to
+            run this node after them
+
+        Returns
+        -------
+        manifest : str
+            path to the manifest
+    """
+    import os
+    import json
+    import datetime
+    from manifest import file_fingerprint, load_manifest, manifest_file, \
+                         normalize, tool_versions
+
+    path = manifest_file(manifest_dir, subject_id, session_id)
+    previous = load_manifest(path) or {}
+
+    inputs = {}
+    for name, paths in [('anat', anat), ('pet', pet), ('json', json_file)]:
+        recorded = {entry['path']: entry for entry in previous.get('inputs', {}).get(name, [])}
+        paths = [paths] if isinstance(paths, str) else paths
+        inputs[name] = [file_fingerprint(p, recorded.get(os.path.abspath(p))) for p in sorted(paths)]
+
+    os.makedirs(manifest_dir, exist_ok=True)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump({'subject_id': subject_id,
+                   'session_id': session_id,
+                   'inputs': inputs,
+                   'configs': normalize(configs),
+                   'versions': tool_versions(),
+                   'written': datetime.datetime.now().isoformat()}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    return os.path.abspath(path)
@@ -0,0 +1,190 @@
+def split_frames(in_file, n_chunks, out_ext='.nii.gz'):
+    """
+        Split a 4D series into consecutive frame chunks, reading
+        each chunk through the nibabel array proxy
+
+        Parameters
+        ----------
+        in_file : str
+            path to the 4D PET series
+        n_chunks : int
+            number of chunks
+        out_ext : str
+            '.nii' or '.nii.gz' extension of the chunk images
+
+        Returns
+        -------
+        chunk_files : list of str
+            paths to the chunk images, in frame order
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    from nipype.utils.filemanip import split_filename
+
+    img = nib.load(in_file, keep_file_open=True)
+    n_frames = img.shape[3]
+    _, fname, _ = split_filename(in_file)
+    # chunks are float, an integer source dtype would be scaled back
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+
+    chunk_files = []
+    for index, frames in enumerate(np.array_split(np.arange(n_frames), min(n_chunks, n_frames))):
+        chunk = np.asarray(img.dataobj[..., frames[0]:frames[-1] + 1], dtype=np.float32)
+        chunk_file = os.path.abspath("{}_chunk{:03d}{}".format(fname, index, out_ext))
+        nib.Nifti1Image(chunk, img.affine, header).to_filename(chunk_file)
+        chunk_files.append(chunk_file)
+    return chunk_files
+
+
+def merge_frames(chunk_files, out_file):
+    """
+        Concatenate motion corrected chunks back into one 4D series
+
+        Parameters
+        ----------
+        chunk_files : list of str
+            paths to the corrected chunk images, in frame order
+        out_file : str
+            output file path
+
+        Returns
+        -------
+        out_file : str
+            path to the merged 4D series
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+
+    imgs = [nib.load(chunk_file) for chunk_file in chunk_files]
+    n_frames = sum(img.shape[3] if len(img.shape) > 3 else 1 for img in imgs)
+    data = np.zeros(imgs[0].shape[:3] + (n_frames,), dtype=np.float32)
+
+    start = 0
+    for img in imgs:
+        chunk = np.asarray(img.dataobj, dtype=np.float32)
+        if chunk.ndim == 3:
+            chunk = chunk[..., np.newaxis]
+        data[..., start:start + chunk.shape[3]] = chunk
+        start += chunk.shape[3]
+
+    header = imgs[0].header.copy()
+    header.set_data_dtype(np.float32)
+    nib.Nifti1Image(data, imgs[0].affine, header).to_filename(out_file)
+    return os.path.abspath(out_file)
+
+
+def merge_mats(chunk_mats, mat_dir):
+    """
+        Collect the per-frame transforms of the chunks into one
+        directory, numbered in frame order like MCFLIRT -mats
+
+        Parameters
+        ----------
+        chunk_mats : list of list of str
+            MAT_* files of every chunk, in frame order
+        mat_dir : str
+            output directory
+
+        Returns
+        -------
+        mat_files : list of str
+            paths to MAT_0000, MAT_0001, ...
+    """
+    import os
+    import shutil
+
+    mat_files = []
+    if not any(chunk_mats):
+        return mat_files
+    os.makedirs(mat_dir, exist_ok=True)
+    for mat_file in [mat_file for mats in chunk_mats for mat_file in sorted(mats)]:
+        mat_files.append(os.path.abspath(os.path.join(mat_dir, 'MAT_%04d' % len(mat_files))))
+        shutil.move(mat_file, mat_files[-1])
+    return mat_files
+
+
+def parallel_motion_correction(in_file, json_file, mcflirt_args, n_chunks=4, n_procs=4,
+                               output_type='NIFTI_GZ'):
+    """
+        Frame-parallel motion correction: the series is split into
+        frame chunks that are registered with MCFLIRT to a shared
+        reference (the time weighted average of the series) in
+        parallel, then the resliced frames and motion parameters
+        are merged back into one 4D file, one parameter file and,
+        with save_mats, one directory of per-frame transforms
+
+        Parameters
+        ----------
+        in_file : str
+            path to the 4D PET series
+        json_file : str
+            path to BIDS json PET file containing 'FrameDuration'
+        mcflirt_args : dict
+            MCFLIRT options from the motion correction config
+        n_chunks : int
+            number of frame chunks
+        n_procs : int
+            number of MCFLIRT processes run at once
+        output_type : str
+            'NIFTI' or 'NIFTI_GZ' format of the chunks and outputs
+
+        Returns
+        -------
+        out_file : str
+            motion corrected 4D series
+        par_file : str
+            motion parameters of every frame
+        mat_file : list of str
+            transform of every frame, empty without save_mats
+    """
+    import os
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    from nipype.interfaces import fsl
+    from nipype.utils.filemanip import split_filename
+    from utils import compute_weighted_average, image_extension
+    from motion_correction import split_frames, merge_frames, merge_mats
+
+    ext = image_extension(output_type)
+    ref_file = compute_weighted_average(in_file, json_file, out_ext=ext)
+    chunk_files = split_frames(in_file, n_chunks, out_ext=ext)
+
+    # the shared reference replaces any per-run reference options
+    args = {key: value for key, value in mcflirt_args.items()
+            if key not in ('in_file', 'out_file', 'ref_file', 'ref_vol', 'mean_vol')}
+    args['save_plots'] = True
+    args['output_type'] = output_type
+
+    def register(chunk_file):
+        _, fname, _ = split_filename(chunk_file)
+        return fsl.MCFLIRT(in_file=chunk_file,
+                           ref_file=ref_file,
+                           out_file=os.path.abspath(fname + '_mcf' + ext),
+                           **args).run().outputs
+
+    with ThreadPoolExecutor(max_workers=max(1, n_procs)) as pool:
+        results = list(pool.map(register, chunk_files))
+
+    _, fname, _ = split_filename(in_file)
+    out_file = merge_frames([result.out_file for result in results],
+                            "{}_mcf{}".format(fname, ext))
+
+    par_file = os.path.abspath("{}_mcf{}.par".format(fname, ext))
+    with open(par_file, 'w') as out:
+        for result in results:
+            with open(result.par_file, 'r') as f:
+                out.write(f.read())
+
+    mat_file = merge_mats([result.mat_file if isinstance(result.mat_file, list) else []
+                           for result in results], os.path.abspath("{}_mcf{}.mat".format(fname, ext)))
+
+    # chunks and their registrations
+    for chunk_file, result in zip(chunk_files, results):
+        for path in [chunk_file, result.out_file, result.par_file]:
+            if os.path.isfile(path):
+                os.remove(path)
+        shutil.rmtree(result.out_file + '.mat', ignore_errors=True)
+    return out_file, par_file, mat_file
@@ -0,0 +1,179 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from bidsindex import pet_runs
+
+
+def check_image(path, ndim):
+    """
+        Check an image from its header only
+
+        Parameters
+        ----------
+        path : str
+            NIfTI image
+        ndim : tuple of int
+            accepted numbers of dimensions
+
+        Returns
+        -------
+        (shape, problems) : (tuple, list of str)
+            image shape (None when unreadable) and the problems found
+    """
+    import numpy as np
+    import nibabel as nib
+
+    try:
+        img = nib.load(path)
+    except Exception as error:
+        return None, ['%s: unreadable header (%s)' % (os.path.basename(path), error)]
+
+    shape = img.shape
+    problems = []
+    if len(shape) not in ndim:
+        problems.append('%s: %dD image, expected %s' % (os.path.basename(path), len(shape),
+                                                         ' or '.join('%dD' % n for n in ndim)))
+    if path.endswith('.nii'):
+        # a truncated transfer is visible from the file size alone
+        expected = int(img.header.get_data_offset()) + int(np.prod(shape)) * img.get_data_dtype().itemsize
+        size = os.path.getsize(path)
+        if size < expected:
+            problems.append('%s: truncated, %d bytes instead of %d' % (os.path.basename(path), size, expected))
+    return shape, problems
+
+
+def check_sidecar(json_file, n_frames):
+    """
+        Check the frame timing of a PET sidecar, as read by
+        create_mid_frame_dat and compute_weighted_average
+
+        Parameters
+        ----------
+        json_file : str
+            BIDS PET json sidecar
+        n_frames : int
+            number of frames of the PET image, None when unknown
+
+        Returns
+        -------
+        problems : list of str
+    """
+    name = os.path.basename(json_file)
+    try:
+        with open(json_file, 'r') as f:
+            info = json.load(f)
+    except (OSError, ValueError) as error:
+        return ['%s: unreadable (%s)' % (name, error)]
+
+    problems = []
+    timing = {}
+    for key in ['FrameTimesStart', 'FrameDuration']:
+        values = info.get(key)
+        if not isinstance(values, list) or not values:
+            problems.append('%s: missing %s' % (name, key))
+        elif not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            problems.append('%s: non-numeric %s' % (name, key))
+        else:
+            timing[key] = values
+    if problems:
+        return problems
+
+    starts, durations = timing['FrameTimesStart'], timing['FrameDuration']
+    if len(starts) != len(durations):
+        problems.append('%s: %d FrameTimesStart but %d FrameDuration'
+                        % (name, len(starts), len(durations)))
+    if n_frames is not None and len(durations) != n_frames:
+        problems.append('%s: %d frames in the sidecar, %d in the image' % (name, len(durations), n_frames))
+    if any(duration <= 0 for duration in durations):
+        problems.append('%s: non-positive FrameDuration' % name)
+    if any(later < earlier for earlier, later in zip(starts, starts[1:])):
+        problems.append('%s: FrameTimesStart not increasing' % name)
+    return problems
+
+
+def check_acquisition(files):
+    """
+        Check the inputs of an acquisition before a run, from the
+        NIfTI headers and the json sidecar only
+
+        Parameters
+        ----------
+        files : dict
+            'anat', 'pet' and 'json' lists of paths, see BIDSIndex.files
+
+        Returns
+        -------
+        problems : list of str
+            empty when the acquisition can be processed
+    """
+    problems = []
+    if not files['anat']:
+        problems.append('no T1w image')
+    for anat in files['anat'][:1]:
+        problems.extend(check_image(anat, (3,))[1])
+
+    if not files['pet']:
+        problems.append('no PET image')
+    for run, (pet, json_file) in sorted(pet_runs(files).items()):
+        prefix = 'run %s: ' % run if run else ''
+        if json_file is None:
+            problems.append('%s%s: no json sidecar' % (prefix, os.path.basename(pet)))
+            continue
+        shape, pet_problems = check_image(pet, (3, 4))
+        n_frames = None if shape is None else (shape[3] if len(shape) > 3 else 1)
+        problems.extend(prefix + problem for problem in pet_problems + check_sidecar(json_file, n_frames))
+    return problems
+
+
+def validate_acquisitions(index, acquisitions, anat_all_sessions=False, n_workers=8):
+    """
+        Check every acquisition in parallel
+
+        Parameters
+        ----------
+        index : BIDSIndex
+            up to date index of the dataset
+        acquisitions : list of (str, str)
+            (subject_id, session_id) pairs
+        anat_all_sessions : bool
+            the T1w may come from any session of the subject
+        n_workers : int
+            number of threads reading headers
+
+        Returns
+        -------
+        problems : dict
+            mapping of (subject_id, session_id) to its problems, for
+            the invalid acquisitions only
+    """
+    def check(acquisition):
+        subject_id, session_id = acquisition
+        files = index.files(subject_id, session_id)
+        if anat_all_sessions:
+            files['anat'] = index.files(subject_id)['anat']
+        return check_acquisition(files)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        results = pool.map(check, acquisitions)
+    return {acquisition: problems for acquisition, problems in zip(acquisitions, results) if problems}
+
+
+def write_report(problems, n_checked, policy, out_dir):
+    """
+        Write the pre-flight report, report.json in out_dir
+
+        Returns
+        -------
+        report_file : str
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    report_file = os.path.join(out_dir, 'report.json')
+    with open(report_file, 'w') as f:
+        json.dump({'checked': n_checked,
+                   'invalid': len(problems),
+                   'policy': policy,
+                   'acquisitions': [{'subject_id': subject_id, 'session_id': session_id, 'problems': found}
+                                    for (subject_id, session_id), found in sorted(problems.items())]},
+                  f, indent=2)
+    return report_file
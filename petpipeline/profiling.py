@@ -0,0 +1,250 @@
+import os
+import re
+import json
+
+import numpy as np
+
+# Branch folder name of an acquisition, e.g. '_session_id_01_subject_id_001'
+_ACQUISITION = re.compile(r'_session_id_(?P<session_id>[^_/]+)_subject_id_(?P<subject_id>[^_/]+)')
+
+# Branch folder name of a PET run, e.g. '_run_trc-FDG' ('_run_' for single-run sessions)
+_RUN = re.compile(r'^_run_(?P<run>[^/]*)$')
+
+# Branch folder name of a parameter sweep variant, e.g. '_variant_psf-6'
+_VARIANT = re.compile(r'^_variant_(?P<variant>[^/]*)$')
+
+_COLUMNS = ['node', 'itername', 'subject_id', 'session_id', 'run', 'status', 'start', 'finish',
+            'duration_s', 'cpu_time_s', 'peak_rss_gb', 'io_read_bytes', 'io_write_bytes',
+            'n_procs', 'mem_gb']
+
+
+def acquisition_of(node):
+    """
+        Subject and session of the branch a node belongs to
+
+        Parameters
+        ----------
+        node : nipype Node
+            node of the expanded workflow graph
+
+        Returns
+        -------
+        (subject_id, session_id) : (str, str)
+            empty strings for nodes outside the per-acquisition
+            branches (e.g. join nodes)
+    """
+    for parameterization in node.parameterization or []:
+        match = _ACQUISITION.search(str(parameterization))
+        if match:
+            return match.group('subject_id'), match.group('session_id')
+    return '', ''
+
+
+def run_of(node):
+    """
+        PET run label of the branch a node belongs to, '' for
+        single-run sessions and for the per-session nodes
+    """
+    for parameterization in node.parameterization or []:
+        match = _RUN.match(str(parameterization))
+        if match:
+            return match.group('run')
+    return ''
+
+
+def variant_of(node):
+    """
+        Parameter sweep variant of the branch a node belongs to, ''
+        outside a sweep and for the nodes above the swept ones
+    """
+    for parameterization in node.parameterization or []:
+        match = _VARIANT.match(str(parameterization))
+        if match:
+            return match.group('variant')
+    return ''
+
+
+def _file_bytes(value):
+    """
+        Total size of the existing files referenced by a node
+        input or output value (str, list or dict of paths),
+        directories are not walked
+    """
+    if isinstance(value, str):
+        return os.path.getsize(value) if os.path.isfile(value) else 0
+    if isinstance(value, (list, tuple)):
+        return sum(_file_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_file_bytes(item) for item in value.values())
+    return 0
+
+
+def _is_file_trait(trait_type):
+    """
+        Whether an input trait type holds file paths: File and
+        ImageFile, alone, in a list or in an Either
+    """
+    from nipype.interfaces.base.traits_extension import File
+
+    if isinstance(trait_type, File):
+        return True
+    handlers = getattr(trait_type, 'handlers', None) or []
+    inner = getattr(trait_type, 'inner_traits', ())
+    inner = [trait.trait_type for trait in (inner() if callable(inner) else inner)]
+    return any(_is_file_trait(handler) for handler in list(handlers) + inner)
+
+
+def _input_bytes(inputs):
+    """
+        Total size of the files passed to the File inputs of a node;
+        untyped inputs (Function nodes) and directories (e.g. the
+        FreeSurfer subjects dir) are not counted
+    """
+    total = 0
+    for name, value in inputs.get_traitsfree().items():
+        trait = inputs.trait(name)
+        if trait is not None and _is_file_trait(trait.handler):
+            total += _file_bytes(value)
+    return total
+
+
+class NodeProfiler:
+
+    """
+        A nipype status callback recording wall time, CPU time,
+        peak RSS and I/O volume of every executed node.
+
+        CPU time and peak RSS come from the nipype resource monitor
+        (config.enable_resource_monitor()); I/O volume is the size of
+        the files passed to the File inputs of a node and of the
+        files in its output directory.
+
+        Attributes
+        ----------
+        records : dict
+            one record per node itername
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            return
+        runtime = getattr(getattr(node, 'result', None), 'runtime', None)
+        duration = getattr(runtime, 'duration', None) or 0.
+        cpu_percent = getattr(runtime, 'cpu_percent', None)
+        subject_id, session_id = acquisition_of(node)
+
+        try:
+            io_read = _input_bytes(node.inputs)
+            io_write = _file_bytes(node.output_dir())
+        except Exception:
+            io_read = io_write = 0
+
+        self.records[node.itername] = {
+            'node': node.name,
+            'itername': node.itername,
+            'subject_id': subject_id,
+            'session_id': session_id,
+            'run': run_of(node),
+            'status': status,
+            'start': str(getattr(runtime, 'startTime', '')),
+            'finish': str(getattr(runtime, 'endTime', '')),
+            'duration_s': duration,
+            'cpu_time_s': duration * cpu_percent / 100. if cpu_percent is not None else np.nan,
+            'peak_rss_gb': getattr(runtime, 'mem_peak_gb', None) or np.nan,
+            'io_read_bytes': io_read,
+            'io_write_bytes': io_write,
+            'n_procs': node.n_procs,
+            'mem_gb': node.mem_gb}
+
+
+def critical_path(graph, records):
+    """
+        Longest chain of dependent nodes of an executed graph,
+        weighted by measured wall time
+
+        Parameters
+        ----------
+        graph : networkx DiGraph
+            expanded execution graph returned by Workflow.run
+        records : dict
+            NodeProfiler records keyed by itername
+
+        Returns
+        -------
+        (length, path) : (float, list of str)
+            total wall time and iternames along the critical path
+    """
+    import networkx as nx
+
+    best = {}
+    for node in nx.topological_sort(graph):
+        duration = records.get(node.itername, {}).get('duration_s', 0.)
+        previous = max((best[parent] for parent in graph.predecessors(node)),
+                       key=lambda item: item[0], default=(0., []))
+        best[node] = (previous[0] + duration, previous[1] + [node.itername])
+    return max(best.values(), key=lambda item: item[0], default=(0., []))
+
+
+def write_report(records, graph, out_dir, n_slowest=10):
+    """
+        Write the per-node profile table and a summary with the
+        slowest nodes, the critical path and per-stage percentiles
+
+        Parameters
+        ----------
+        records : dict
+            NodeProfiler records keyed by itername
+        graph : networkx DiGraph
+            expanded execution graph returned by Workflow.run
+        out_dir : str
+            output directory
+        n_slowest : int
+            number of slowest nodes listed in the summary
+
+        Returns
+        -------
+        (table_file, summary_file) : (str, str)
+            paths to node_profile.tsv and summary.json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rows = sorted(records.values(), key=lambda record: (record['subject_id'],
+                                                        record['session_id'], record['run'],
+                                                        record['start']))
+
+    table_file = os.path.join(out_dir, 'node_profile.tsv')
+    with open(table_file, 'w') as f:
+        f.write('\t'.join(_COLUMNS) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(row[column]) for column in _COLUMNS) + '\n')
+
+    stages = {}
+    for row in rows:
+        stages.setdefault(row['node'], []).append(row)
+    percentiles = {}
+    for stage, stage_rows in sorted(stages.items()):
+        summary = {'count': len(stage_rows)}
+        for column in ['duration_s', 'cpu_time_s', 'peak_rss_gb']:
+            values = np.array([row[column] for row in stage_rows], dtype=float)
+            values = values[~np.isnan(values)]
+            if values.size:
+                summary[column] = dict(zip(['p50', 'p90', 'p99', 'max'],
+                                           np.percentile(values, [50, 90, 99, 100]).tolist()))
+        percentiles[stage] = summary
+
+    length, path = critical_path(graph, records) if graph is not None else (0., [])
+    slowest = sorted(rows, key=lambda row: row['duration_s'], reverse=True)[:n_slowest]
+
+    summary_file = os.path.join(out_dir, 'summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump({'n_nodes': len(rows),
+                   'total_duration_s': float(sum(row['duration_s'] for row in rows)),
+                   'failed': [row['itername'] for row in rows if row['status'] == 'exception'],
+                   'slowest_nodes': [{key: row[key] for key in ['itername', 'subject_id',
+                                                                'session_id', 'run', 'duration_s']}
+                                     for row in slowest],
+                   'critical_path': {'duration_s': length, 'nodes': path},
+                   'stages': percentiles}, f, indent=2, default=str)
+    return table_file, summary_file
@@ -0,0 +1,249 @@
+import os
+import json
+import hashlib
+
+# Index of cached recon-all subjects, stored in the freesurfer subjects dir
+_INDEX_FILE = '.reconall_cache.json'
+
+# Directory holding one lock file per cache key
+_LOCK_DIR = '.reconall_locks'
+
+# Lock file of the index, shared by all cache keys
+_INDEX_LOCK = 'index.lock'
+
+
+def reconall_digest(t1_files, reconall_args):
+    """
+        Content hash identifying a recon-all run: the bytes of
+        every T1w input plus the recon-all configuration
+
+        Parameters
+        ----------
+        t1_files : list of str
+            paths to the T1w images passed to recon-all
+        reconall_args : dict
+            recon-all options (directive, flags, ...)
+
+        Returns
+        -------
+        digest : str
+            sha256 hex digest
+    """
+    sha = hashlib.sha256()
+    for t1_file in sorted(t1_files):
+        with open(t1_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    sha.update(json.dumps(reconall_args, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def is_complete(subjects_dir, subject_id):
+    """
+        Check whether recon-all finished successfully for a subject
+
+        Parameters
+        ----------
+        subjects_dir : str
+            freesurfer subjects directory
+        subject_id : str
+            freesurfer subject identifier
+
+        Returns
+        -------
+        complete : bool
+            True if 'scripts/recon-all.done' exists and recon-all
+            did not leave an error marker
+    """
+    scripts = os.path.join(subjects_dir, subject_id, 'scripts')
+    return os.path.isfile(os.path.join(scripts, 'recon-all.done')) and \
+           not os.path.isfile(os.path.join(scripts, 'recon-all.error'))
+
+
+def load_index(subjects_dir):
+    """
+        Read the recon-all cache index of a subjects directory
+
+        Parameters
+        ----------
+        subjects_dir : str
+            freesurfer subjects directory
+
+        Returns
+        -------
+        index : dict
+            mapping of digest to cache entry
+    """
+    index_file = os.path.join(subjects_dir, _INDEX_FILE)
+    if not os.path.isfile(index_file):
+        return {}
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def save_index(subjects_dir, index):
+    """
+        Atomically write the recon-all cache index of a subjects directory
+
+        Parameters
+        ----------
+        subjects_dir : str
+            freesurfer subjects directory
+        index : dict
+            mapping of digest to cache entry
+    """
+    index_file = os.path.join(subjects_dir, _INDEX_FILE)
+    tmp_file = index_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, index_file)
+
+
+def update_index(subjects_dir, digest, entry):
+    """
+        Add an entry to the recon-all cache index, under a lock
+        shared by all cache keys so that concurrent updates are
+        not lost
+
+        Parameters
+        ----------
+        subjects_dir : str
+            freesurfer subjects directory
+        digest : str
+            cache key computed by reconall_digest
+        entry : dict
+            cache entry
+    """
+    import fcntl
+
+    lock_dir = os.path.join(subjects_dir, _LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, _INDEX_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index = load_index(subjects_dir)
+            index[digest] = entry
+            save_index(subjects_dir, index)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def lookup(subjects_dir, digest, cache_id, legacy_ids=()):
+    """
+        Find a completed recon-all subject for a cache key
+
+        Parameters
+        ----------
+        subjects_dir : str
+            freesurfer subjects directory
+        digest : str
+            cache key computed by reconall_digest
+        cache_id : str
+            content-addressed subject id of the cache key, found
+            even when the index lost its entry
+        legacy_ids : list of str
+            subject ids of earlier, non-cached runs that were built
+            from the same input (e.g. 'session_subject')
+
+        Returns
+        -------
+        subject_id : str or None
+            subject id of a completed run, None on a cache miss
+    """
+    if is_complete(subjects_dir, cache_id):
+        return cache_id
+    entry = load_index(subjects_dir).get(digest)
+    if entry and is_complete(subjects_dir, entry['subject_id']):
+        return entry['subject_id']
+    for legacy_id in legacy_ids:
+        if is_complete(subjects_dir, legacy_id):
+            return legacy_id
+    return None
+
+
+def cached_reconall(T1_files, subject_id, session_id, subjects_dir,
+                    reconall_args, share_across_sessions=False, adopt_legacy=False):
+    """
+        Run recon-all through a content-addressed cache. The cache key
+        is a hash of the T1w content and the recon-all configuration;
+        on a hit the existing subject directory is reused (symlinked
+        under the cache id) and recon-all is not run again. A lock per
+        key makes concurrent branches with the same anatomical wait
+        for a single recon-all run.
+
+        Parameters
+        ----------
+        T1_files : str or list of str
+            T1w image(s) of the subject
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+        subjects_dir : str
+            freesurfer subjects directory
+        reconall_args : dict
+            recon-all options (directive, flags, ...)
+        share_across_sessions : bool
+            key the cache on the subject only, so every session of a
+            subject reuses a single recon-all
+        adopt_legacy : bool
+            accept a completed '<session>_<subject>' directory of an
+            earlier non-cached run as a hit, without checking its T1w
+
+        Returns
+        -------
+        subject_id : str
+            freesurfer subject id holding the recon-all output
+        subjects_dir : str
+            freesurfer subjects directory
+        T1 : str
+            path to the subject's mri/T1.mgz
+    """
+    import os
+    import fcntl
+    import shutil
+    from nipype.interfaces.freesurfer import ReconAll
+    from reconall_cache import reconall_digest, lookup, update_index, \
+                               is_complete, _LOCK_DIR
+
+    if isinstance(T1_files, str):
+        T1_files = [T1_files]
+    T1_files = [os.path.abspath(t1_file) for t1_file in T1_files]
+
+    digest = reconall_digest(T1_files, reconall_args)
+    if share_across_sessions:
+        cache_id = "sub-{}_{}".format(subject_id, digest[:12])
+    else:
+        cache_id = "sub-{}_ses-{}_{}".format(subject_id, session_id, digest[:12])
+    # legacy directories cannot be matched to the T1w content
+    legacy_ids = [session_id + "_" + subject_id] if adopt_legacy else []
+
+    lock_dir = os.path.join(subjects_dir, _LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, digest + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            hit = lookup(subjects_dir, digest, cache_id, legacy_ids)
+            if hit is None:
+                # partial output of an interrupted run
+                subject_dir = os.path.join(subjects_dir, cache_id)
+                if os.path.islink(subject_dir):
+                    os.unlink(subject_dir)
+                elif os.path.isdir(subject_dir):
+                    shutil.rmtree(subject_dir)
+                ReconAll(subject_id=cache_id,
+                         T1_files=T1_files,
+                         subjects_dir=subjects_dir,
+                         **reconall_args).run()
+                if not is_complete(subjects_dir, cache_id):
+                    raise RuntimeError("recon-all did not complete for %s" % cache_id)
+            elif hit != cache_id and not os.path.lexists(os.path.join(subjects_dir, cache_id)):
+                os.symlink(hit, os.path.join(subjects_dir, cache_id))
+
+            update_index(subjects_dir, digest, {'subject_id': hit or cache_id,
+                                                'T1_files': T1_files,
+                                                'reconall_args': reconall_args})
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return cache_id, subjects_dir, os.path.join(subjects_dir, cache_id, 'mri', 'T1.mgz')
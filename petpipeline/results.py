@@ -0,0 +1,404 @@
+import os
+import re
+import json
+import glob
+import shutil
+
+import numpy as np
+
+# Columns of every table; string columns are dictionary encoded
+TABLES = {'gtm': ['unit', 'subject_id', 'session_id', 'run', 'variant', 'segid', 'region', 'frame', 'value'],
+          'kinetics': ['unit', 'subject_id', 'session_id', 'run', 'variant', 'segid', 'region', 'model',
+                       'k2p', 'bp'],
+          'motion': ['unit', 'subject_id', 'session_id', 'run', 'n_frames', 'mean_fd', 'max_fd',
+                     'max_translation', 'max_rotation']}
+
+STRING_COLUMNS = ['unit', 'subject_id', 'session_id', 'run', 'variant', 'region', 'model']
+
+_DTYPES = {'segid': np.int32, 'frame': np.int32, 'n_frames': np.int32}
+
+# Segid / name of the high-binding TAC fitted per acquisition
+HB_SEGID, HB_REGION = -1, 'km_hb'
+
+# Radius (mm) converting rotations to displacements (Power et al. 2012)
+_FD_RADIUS = 50.
+
+_PARTITION = re.compile(r'^(shard-\d+-of-\d+|wave-\d+)$')
+
+
+def _variant_dirs(directory, subject_id, session_id):
+    """
+        (variant, run, path) of every output dir of an acquisition
+        below pvc, km, km2 or motion_correction; variant is '' outside
+        a parameter sweep and run is '' for single-run sessions
+    """
+    acquisition = os.path.join('sub-%s' % subject_id, 'ses-%s' % session_id)
+    found = [('', os.path.join(directory, acquisition))]
+    found.extend((path.split(os.sep)[-3], path)
+                 for path in glob.glob(os.path.join(directory, '*', acquisition)))
+    dirs = []
+    for variant, path in found:
+        if not os.path.isdir(path):
+            continue
+        dirs.append((variant, '', path))
+        # runs of a multi-run session are one folder down
+        dirs.extend((variant, name, os.path.join(path, name)) for name in sorted(os.listdir(path))
+                    if os.path.isdir(os.path.join(path, name)))
+    return dirs
+
+
+def acquisition_sources(derivatives, subject_id, session_id):
+    """
+        Derivative files the results of an acquisition are read from
+    """
+    sources = []
+    for directory, names in [('pvc', ['gtm.nii.gz', 'gtm.stats.dat']),
+                             ('km', ['k2prime.dat', 'bp.nii.gz']),
+                             ('km2', ['bp.nii.gz'])]:
+        for _, _, path in _variant_dirs(os.path.join(derivatives, directory), subject_id, session_id):
+            sources.extend(os.path.join(path, name) for name in names)
+    for _, _, path in _variant_dirs(os.path.join(derivatives, 'motion_correction'), subject_id, session_id):
+        sources.extend(glob.glob(os.path.join(path, '*.par')))
+    return sorted(path for path in sources if os.path.isfile(path))
+
+
+def cohort_sources(derivatives):
+    """
+        Cohort tables of a run, without the per-shard / per-wave
+        parts that are merged into them
+    """
+    tables = glob.glob(os.path.join(derivatives, 'km_cohort', 'cohort_mrtm.tsv'))
+    tables.extend(path for path in glob.glob(os.path.join(derivatives, 'km_cohort', '*', 'cohort_mrtm.tsv'))
+                  if not _PARTITION.match(os.path.basename(os.path.dirname(path))))
+    return sorted(tables)
+
+
+def signature(paths):
+    """
+        Cheap change signature of a set of files (path, size, mtime)
+    """
+    return ';'.join('%s:%d:%d' % (path, os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                    for path in paths)
+
+
+def framewise_displacement(par_file):
+    """
+        Motion summary of an MCFLIRT .par file (rotations in
+        radians, then translations in mm)
+
+        Returns
+        -------
+        summary : dict
+            n_frames, mean_fd and max_fd (mm), max_translation (mm)
+            and max_rotation (degrees) relative to the reference frame
+    """
+    params = np.loadtxt(par_file, ndmin=2)
+    rotations, translations = params[:, :3], params[:, 3:6]
+    fd = np.abs(np.diff(translations, axis=0)).sum(axis=1) \
+         + _FD_RADIUS * np.abs(np.diff(rotations, axis=0)).sum(axis=1)
+    return {'n_frames': len(params),
+            'mean_fd': float(fd.mean()) if fd.size else 0.,
+            'max_fd': float(fd.max()) if fd.size else 0.,
+            'max_translation': float(np.abs(translations).max()),
+            'max_rotation': float(np.degrees(np.abs(rotations).max()))}
+
+
+def read_acquisition(derivatives, subject_id, session_id):
+    """
+        Rows of every table for the results of one acquisition
+
+        Returns
+        -------
+        rows : dict
+            mapping of table name to a list of row dicts
+    """
+    import nibabel as nib
+    from kinetics import read_gtm_regions
+
+    key = {'subject_id': subject_id, 'session_id': session_id}
+    rows = {table: [] for table in TABLES}
+
+    for variant, run, path in _variant_dirs(os.path.join(derivatives, 'pvc'), subject_id, session_id):
+        gtm_file = os.path.join(path, 'gtm.nii.gz')
+        if not os.path.isfile(gtm_file):
+            continue
+        tacs = np.asarray(nib.load(gtm_file).dataobj, dtype=np.float64)
+        tacs = tacs.reshape(-1, tacs.shape[-1])
+        regions = read_gtm_regions(os.path.join(path, 'gtm.stats.dat'), tacs.shape[0])
+        for (segid, name), tac in zip(regions, tacs):
+            rows['gtm'].extend(dict(key, run=run, variant=variant, segid=segid, region=name, frame=frame, value=value)
+                               for frame, value in enumerate(tac))
+
+    k2p = {}
+    for directory, model in [('km', 'mrtm'), ('km2', 'mrtm2')]:
+        for variant, run, path in _variant_dirs(os.path.join(derivatives, directory), subject_id, session_id):
+            bp_file = os.path.join(path, 'bp.nii.gz')
+            k2p_file = os.path.join(path, 'k2prime.dat')
+            if os.path.isfile(k2p_file):
+                k2p[(variant, run)] = float(np.loadtxt(k2p_file, ndmin=1)[0])
+            if not os.path.isfile(bp_file):
+                continue
+            # MRTM / MRTM2 of the high-binding TAC, k2' is fixed for MRTM2
+            rows['kinetics'].append(dict(key, run=run, variant=variant, segid=HB_SEGID, region=HB_REGION,
+                                         model=model, k2p=k2p.get((variant, run), np.nan),
+                                         bp=float(np.asarray(nib.load(bp_file).dataobj).mean())))
+
+    for _, run, path in _variant_dirs(os.path.join(derivatives, 'motion_correction'), subject_id, session_id):
+        for par_file in sorted(glob.glob(os.path.join(path, '*.par')))[:1]:
+            rows['motion'].append(dict(key, run=run, **framewise_displacement(par_file)))
+    return rows
+
+
+def read_cohort(table_file):
+    """
+        Rows of the kinetics table for a cohort_mrtm.tsv table
+    """
+    variant = os.path.basename(os.path.dirname(table_file))
+    variant = '' if variant == 'km_cohort' else variant
+    rows = {table: [] for table in TABLES}
+    with open(table_file, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            for model in ['mrtm', 'mrtm2']:
+                rows['kinetics'].append({'subject_id': row['subject_id'], 'session_id': row['session_id'],
+                                         'run': row.get('run', ''), 'variant': variant, 'segid': int(row['segid']),
+                                         'region': row['region'], 'model': model,
+                                         'k2p': float(row['%s_k2p' % model]),
+                                         'bp': float(row['%s_bp' % model])})
+    return rows
+
+
+class ResultsStore:
+
+    """
+        Columnar store of the regional results of all acquisitions,
+        for group-level queries without crawling derivatives.
+
+        Every table is a set of segments, one folder of .npy
+        columns per update; string columns hold int32 codes into
+        an append-only dictionary. Rows belong to a unit (an
+        acquisition or a cohort table); a catalog records the
+        segment holding the current rows and the signature of the
+        source files of every unit, so an update only reads the
+        units whose files changed and their older rows are masked.
+        Segments are compacted into one once there are too many.
+
+        Parameters
+        ----------
+        root : str
+            store directory, e.g. derivatives/results_store
+        compact_segments : int
+            number of segments that triggers a compaction
+    """
+
+    def __init__(self, root, compact_segments=16):
+        self.root = root
+        self.compact_segments = compact_segments
+        self._columns = {}
+        self._load_catalog()
+
+    def _load_catalog(self):
+        catalog_file = os.path.join(self.root, 'catalog.json')
+        if os.path.isfile(catalog_file):
+            with open(catalog_file, 'r') as f:
+                catalog = json.load(f)
+        else:
+            catalog = {'units': {}, 'segments': [], 'dictionary': {}}
+        for column in STRING_COLUMNS:
+            catalog['dictionary'].setdefault(column, [])
+        self.catalog = catalog
+        self.codes = {column: {value: code for code, value in enumerate(values)}
+                      for column, values in catalog['dictionary'].items()}
+        self._columns = {}
+
+    def _save_catalog(self):
+        tmp_file = os.path.join(self.root, 'catalog.json.%d.tmp' % os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self.catalog, f)
+        os.replace(tmp_file, os.path.join(self.root, 'catalog.json'))
+
+    def _lock(self):
+        import fcntl
+
+        os.makedirs(self.root, exist_ok=True)
+        lock = open(os.path.join(self.root, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _encode(self, column, values):
+        codes = self.codes[column]
+        for value in values:
+            if value not in codes:
+                codes[value] = len(codes)
+                self.catalog['dictionary'][column].append(value)
+        return np.array([codes[value] for value in values], dtype=np.int32)
+
+    def _write_segment(self, segment, rows):
+        for table, columns in TABLES.items():
+            directory = os.path.join(self.root, table, 'seg-%06d' % segment)
+            tmp_dir = directory + '.tmp'
+            # leftovers of an interrupted update were never cataloged
+            for path in (directory, tmp_dir):
+                shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            for column in columns:
+                values = [row[column] for row in rows[table]]
+                if column in STRING_COLUMNS:
+                    array = self._encode(column, values)
+                else:
+                    array = np.array(values, dtype=_DTYPES.get(column, np.float64))
+                np.save(os.path.join(tmp_dir, column + '.npy'), array)
+            os.rename(tmp_dir, directory)
+
+    def update(self, derivatives, acquisitions):
+        """
+            Ingest the results of acquisitions and the cohort tables
+            whose files changed since the last update
+
+            Parameters
+            ----------
+            derivatives : str
+                derivatives directory of the pipeline
+            acquisitions : list of (str, str)
+                (subject_id, session_id) pairs to check
+
+            Returns
+            -------
+            units : list of str
+                units (re)ingested
+        """
+        lock = self._lock()
+        try:
+            self._load_catalog()
+            units = {}
+            for subject_id, session_id in acquisitions:
+                unit = 'sub-%s_ses-%s' % (subject_id, session_id)
+                units[unit] = (acquisition_sources(derivatives, subject_id, session_id),
+                               lambda subject_id=subject_id, session_id=session_id:
+                               read_acquisition(derivatives, subject_id, session_id))
+            for table_file in cohort_sources(derivatives):
+                unit = 'cohort:' + os.path.relpath(table_file, derivatives)
+                units[unit] = ([table_file], lambda table_file=table_file: read_cohort(table_file))
+
+            changed = {}
+            for unit, (sources, read) in units.items():
+                entry = self.catalog['units'].get(unit)
+                current = signature(sources)
+                if sources and (entry is None or entry['signature'] != current):
+                    changed[unit] = (current, read())
+            if not changed:
+                return []
+
+            segment = max(self.catalog['segments'], default=0) + 1
+            rows = {table: [] for table in TABLES}
+            for unit, (_, unit_rows) in changed.items():
+                for table in TABLES:
+                    rows[table].extend(dict(row, unit=unit) for row in unit_rows[table])
+            self._write_segment(segment, rows)
+
+            self.catalog['segments'].append(segment)
+            for unit, (current, _) in changed.items():
+                self.catalog['units'][unit] = {'segment': segment, 'signature': current}
+            self._save_catalog()
+
+            if len(self.catalog['segments']) > self.compact_segments:
+                self._compact()
+            return sorted(changed)
+        finally:
+            lock.close()
+
+    def _compact(self):
+        """
+            Rewrite the current rows of all segments as one segment
+        """
+        segment = max(self.catalog['segments']) + 1
+        for table, columns in TABLES.items():
+            current = self._read_table(table, columns)
+            directory = os.path.join(self.root, table, 'seg-%06d' % segment)
+            os.makedirs(directory + '.tmp', exist_ok=True)
+            for column in columns:
+                np.save(os.path.join(directory + '.tmp', column + '.npy'), current[column])
+            os.rename(directory + '.tmp', directory)
+
+        old = self.catalog['segments']
+        self.catalog['segments'] = [segment]
+        for entry in self.catalog['units'].values():
+            entry['segment'] = segment
+        self._save_catalog()
+        for table in TABLES:
+            for previous in old:
+                shutil.rmtree(os.path.join(self.root, table, 'seg-%06d' % previous), ignore_errors=True)
+        self._columns = {}
+
+    def _read_table(self, table, columns):
+        """
+            Current rows of a table as encoded columns
+        """
+        units = self.catalog['dictionary']['unit']
+        live = np.array([self.catalog['units'].get(unit, {}).get('segment', -1) for unit in units],
+                        dtype=np.int64)
+        parts = {column: [] for column in columns}
+        for segment in self.catalog['segments']:
+            directory = os.path.join(self.root, table, 'seg-%06d' % segment)
+            unit = np.load(os.path.join(directory, 'unit.npy'), mmap_mode='r')
+            keep = live[unit] == segment
+            for column in columns:
+                column_file = os.path.join(directory, column + '.npy')
+                if not os.path.isfile(column_file):
+                    # segments written before the column existed (run)
+                    parts[column].append(np.full(int(keep.sum()), self._encode(column, [''])[0]))
+                    continue
+                parts[column].append(np.load(column_file, mmap_mode='r')[keep])
+        return {column: np.concatenate(values) if values else
+                        np.zeros(0, dtype=np.int32 if column in STRING_COLUMNS else
+                                 _DTYPES.get(column, np.float64))
+                for column, values in parts.items()}
+
+    def table(self, table):
+        """
+            Current rows of a table as encoded columns, cached
+        """
+        if table not in TABLES:
+            raise ValueError("Unknown table '%s', expected one of %s" % (table, ', '.join(TABLES)))
+        if table not in self._columns:
+            self._columns[table] = self._read_table(table, TABLES[table])
+        return self._columns[table]
+
+    def query(self, table, columns=None, **filters):
+        """
+            Select rows of a table
+
+            Parameters
+            ----------
+            table : str
+                'gtm', 'kinetics' or 'motion'
+            columns : list of str
+                columns returned, all by default
+            filters :
+                column=value or column=[values], e.g. subject_id='01',
+                region=['Left-Putamen', 'Right-Putamen'], variant='psf-6'
+
+            Returns
+            -------
+            result : dict
+                mapping of column name to a numpy array, string
+                columns decoded
+        """
+        data = self.table(table)
+        mask = np.ones(len(data['unit']), dtype=bool)
+        for column, values in filters.items():
+            if column not in data:
+                raise ValueError("Unknown column '%s' of table '%s'" % (column, table))
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            if column in STRING_COLUMNS:
+                values = [self.codes[column][value] for value in values if value in self.codes[column]]
+            mask &= np.isin(data[column], values)
+
+        result = {}
+        for column in columns or [column for column in TABLES[table] if column != 'unit']:
+            values = data[column][mask]
+            if column in STRING_COLUMNS:
+                values = np.array(self.catalog['dictionary'][column], dtype=object)[values]
+            result[column] = values
+        return result
@@ -0,0 +1,95 @@
+import os
+import csv
+
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+# Default runtime estimates (seconds) per node name, for nodes
+# without history; recon-all dominates every branch
+DEFAULT_ESTIMATES = {'reconall': 6 * 3600.,
+                     'gtmseg': 1800.,
+                     'partial_volume_correction': 900.,
+                     'motion_correction': 600.,
+                     'coregistration': 300.,
+                     'kinetic_modelling': 120.,
+                     'kinetic_modelling_': 120.,
+                     'cohort_kinetic_modelling': 120.,
+                     'time_weighted_average': 30.,
+                     'compress_outputs': 30.,
+                     'datasink': 10.}
+
+# Estimate for nodes not listed above (small python nodes)
+DEFAULT_ESTIMATE = 1.
+
+
+def load_estimates(profile_file=None, estimates=None, percentile=90):
+    """
+        Runtime estimates per node name, from configured values
+        and the node profile table of a previous profiled run
+
+        Parameters
+        ----------
+        profile_file : str
+            node_profile.tsv written by profiling.write_report
+        estimates : dict
+            configured estimates (seconds), override the defaults
+        percentile : float
+            percentile of the recorded durations used per node, high
+            enough that recon-all cache hits do not hide its cost
+
+        Returns
+        -------
+        estimates : dict
+            mapping of node name to estimated seconds
+    """
+    import numpy as np
+
+    merged = dict(DEFAULT_ESTIMATES)
+    if profile_file and os.path.isfile(profile_file):
+        durations = {}
+        with open(profile_file, 'r') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                if row['status'] == 'end':
+                    durations.setdefault(row['node'], []).append(float(row['duration_s']))
+        merged.update({node: float(np.percentile(values, percentile))
+                       for node, values in durations.items()})
+    merged.update(estimates or {})
+    return merged
+
+
+class CriticalPathPlugin(MultiProcPlugin):
+
+    """
+        MultiProc execution that dispatches ready nodes by their
+        estimated remaining critical path: the runtime of the node
+        plus the longest chain of estimated runtimes below it.
+
+        recon-all and gtmseg of every acquisition therefore start
+        as soon as their inputs exist, and the short PET nodes fill
+        the slots they leave free (MultiProc skips jobs that do not
+        fit the free cores / memory and tries the next one).
+
+        Plugin args
+        -----------
+        estimates : dict
+            mapping of node name to estimated seconds (see
+            load_estimates), plus all MultiProc arguments
+    """
+
+    def __init__(self, plugin_args=None):
+        super(CriticalPathPlugin, self).__init__(plugin_args=plugin_args)
+        self.estimates = dict(DEFAULT_ESTIMATES)
+        self.estimates.update((plugin_args or {}).get('estimates', {}))
+        self.ranks = []
+
+    def _generate_dependency_list(self, graph):
+        super(CriticalPathPlugin, self)._generate_dependency_list(graph)
+
+        remaining = {}
+        for node in reversed(self.procs):
+            below = max((remaining[child] for child in graph.successors(node)), default=0.)
+            remaining[node] = self.estimates.get(node.name, DEFAULT_ESTIMATE) + below
+        self.ranks = [remaining[node] for node in self.procs]
+
+    def _sort_jobs(self, jobids, scheduler=None):
+        return sorted(jobids, key=lambda jobid: (-self.ranks[jobid] if jobid < len(self.ranks) else 0.,
+                                                 jobid))
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import glob
+import hashlib
+
+_MARKER = re.compile(r'shard-(\d+)-of-(\d+)\.json$')
+
+
+def parse_shard(spec):
+    """
+        Parse a shard spec such as '3/16'
+
+        Parameters
+        ----------
+        spec : str
+            'k/N' with 1 <= k <= N, e.g. a job array index
+
+        Returns
+        -------
+        (index, count) : (int, int)
+            1-based shard index and number of shards
+    """
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard spec '%s', expected k/N" % spec)
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard spec '%s', expected 1 <= k <= N" % spec)
+    return index, count
+
+
+def shard_label(index, count):
+    """
+        Folder / file label of a shard, e.g. 'shard-03-of-16'
+    """
+    width = len(str(count))
+    return 'shard-%0*d-of-%0*d' % (width, index, width, count)
+
+
+def stable_hash(subject_id, session_id):
+    """
+        Hash of an acquisition that does not depend on the python
+        process (unlike hash()), so every shard agrees on it
+    """
+    key = ('%s/%s' % (subject_id, session_id)).encode()
+    return int(hashlib.sha1(key).hexdigest(), 16)
+
+
+def shard_acquisitions(acquisitions, index, count, strategy='hash', costs=None):
+    """
+        Deterministically select the acquisitions of one shard
+
+        Parameters
+        ----------
+        acquisitions : list of (str, str)
+            all discovered (subject_id, session_id) pairs
+        index : int
+            1-based shard index
+        count : int
+            number of shards
+        strategy : str
+            'hash' assigns each pair by a stable hash, 'balanced'
+            spreads the estimated cost evenly (longest first)
+        costs : dict
+            estimated cost of each pair, required for 'balanced'
+
+        Returns
+        -------
+        acquisitions : list of (str, str)
+            sorted pairs assigned to the shard
+    """
+    if strategy == 'hash':
+        return sorted(acquisition for acquisition in acquisitions
+                      if stable_hash(*acquisition) % count == index - 1)
+    if strategy != 'balanced':
+        raise ValueError("Unknown shard strategy '%s', expected 'hash' or 'balanced'" % strategy)
+
+    loads = [0.] * count
+    assignment = {}
+    for acquisition in sorted(acquisitions, key=lambda item: (-costs.get(item, 0.), item)):
+        shard = min(range(count), key=lambda shard: (loads[shard], shard))
+        loads[shard] += costs.get(acquisition, 0.)
+        assignment[acquisition] = shard
+    return sorted(acquisition for acquisition, shard in assignment.items() if shard == index - 1)
+
+
+def sharded_tables(variants=(), profiling_dir='profiling'):
+    """
+        Per-shard tables concatenated by the merge step
+
+        Parameters
+        ----------
+        variants : list of str
+            labels of the parameter sweep variants, each with its
+            own cohort table
+        profiling_dir : str
+            output directory of the node profiles
+
+        Returns
+        -------
+        tables : list of (str, str)
+            directory relative to the derivatives dir, holding one
+            folder per shard, and path of the table in those folders
+    """
+    return [('km_cohort', os.path.join(variant, 'cohort_mrtm.tsv')) for variant in (sorted(variants) or [''])] + \
+           [(profiling_dir, 'node_profile.tsv')]
+
+
+def write_marker(shard_dir, index, count, acquisitions, status):
+    """
+        Record the outcome of a shard run
+
+        Parameters
+        ----------
+        shard_dir : str
+            directory holding the shard markers
+        index : int
+            1-based shard index
+        count : int
+            number of shards
+        acquisitions : list of (str, str)
+            pairs processed by the shard
+        status : str
+            'complete' or 'failed'
+
+        Returns
+        -------
+        marker : str
+            path to the marker file
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    marker = os.path.join(shard_dir, shard_label(index, count) + '.json')
+    tmp_file = marker + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'w') as f:
+        json.dump({'index': index, 'count': count, 'status': status,
+                   'acquisitions': [list(acquisition) for acquisition in acquisitions]},
+                  f, indent=2)
+    os.replace(tmp_file, marker)
+    return marker
+
+
+def concatenate_tables(in_files, out_file):
+    """
+        Concatenate tsv tables sharing a header line
+    """
+    with open(out_file, 'w') as out:
+        for position, in_file in enumerate(sorted(in_files)):
+            with open(in_file, 'r') as f:
+                header = f.readline()
+                if position == 0:
+                    out.write(header)
+                out.write(f.read())
+    return out_file
+
+
+def merge_shards(derivatives, count=None, manifest_dir=None, tables=None):
+    """
+        Verify that every shard of a run completed and consolidate
+        the per-shard tables into the derivatives dir
+
+        Parameters
+        ----------
+        derivatives : str
+            derivatives directory shared by all shards
+        count : int
+            expected number of shards, taken from the markers if None
+        manifest_dir : str
+            when given, every acquisition of a completed shard must
+            also have a derivative manifest
+        tables : list of (str, str)
+            per-shard tables to concatenate, see sharded_tables
+
+        Returns
+        -------
+        (merged, problems) : (str, list of str)
+            path to the merged summary and a description of every
+            missing or failed shard (empty when all completed)
+    """
+    shard_dir = os.path.join(derivatives, 'shards')
+    markers = {}
+    for marker in glob.glob(os.path.join(shard_dir, 'shard-*-of-*.json')):
+        match = _MARKER.search(marker)
+        with open(marker, 'r') as f:
+            markers[(int(match.group(1)), int(match.group(2)))] = json.load(f)
+
+    counts = {shard_count for _, shard_count in markers}
+    if count is None:
+        if len(counts) != 1:
+            raise ValueError("Found markers for %s shard counts in %s, pass the count explicitly"
+                             % (sorted(counts) or 'no', shard_dir))
+        count = counts.pop()
+
+    problems = []
+    acquisitions = []
+    for index in range(1, count + 1):
+        marker = markers.get((index, count))
+        if marker is None:
+            problems.append('%s: missing' % shard_label(index, count))
+        elif marker['status'] != 'complete':
+            problems.append('%s: %s' % (shard_label(index, count), marker['status']))
+        else:
+            acquisitions.extend(tuple(acquisition) for acquisition in marker['acquisitions'])
+
+    if manifest_dir is not None:
+        from manifest import manifest_file
+        problems.extend('sub-%s ses-%s: missing manifest' % (subject_id, session_id)
+                        for subject_id, session_id in acquisitions
+                        if not os.path.isfile(manifest_file(manifest_dir, subject_id, session_id)))
+
+    for directory, name in (sharded_tables() if tables is None else tables):
+        directory = os.path.join(derivatives, directory)
+        parts = glob.glob(os.path.join(directory, 'shard-*-of-%0*d' % (len(str(count)), count), name))
+        if parts:
+            os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+            concatenate_tables(parts, os.path.join(directory, name))
+
+    merged = os.path.join(shard_dir, 'merged.json')
+    with open(merged, 'w') as f:
+        json.dump({'count': count, 'complete': not problems, 'problems': problems,
+                   'acquisitions': sorted(acquisitions)}, f, indent=2)
+    return merged, problems
@@ -33,11 +33,49 @@ def create_mid_frame_dat(json_file):
     return os.path.abspath(fout)
 
 
-def compute_average(in_file, out_file=None):
+def iter_frame_chunks(img, frames_per_chunk=1):
+
+    """
+        A generator that reads a 4D volume a few frames at a time
+        through the nibabel array proxy, so that the full series
+        is never held in memory. For compressed images, load them 
+        with keep_file_open=True so that consecutive chunks are read
+        from a single gzip stream instead of decompressing from the
+        start of the file for every chunk
+
+        Parameters
+        ----------
+        img : nibabel image
+            4D image loaded with nib.load (data not yet read)
+        frames_per_chunk : int
+            number of frames read per chunk
+
+        Yields
+        ------
+        (start, chunk) : (int, ndarray)
+            index of the first frame in the chunk and the float32
+            frame data with shape (x, y, z, n)
+    """
+
+    import numpy as np
+
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+    frames_per_chunk = max(1, int(frames_per_chunk))
+    for start in range(0, n_frames, frames_per_chunk):
+        stop = min(start + frames_per_chunk, n_frames)
+        if len(img.shape) > 3:
+            chunk = img.dataobj[..., start:stop]
+        else:
+            chunk = img.dataobj[...][..., np.newaxis]
+        yield start, np.asarray(chunk, dtype=np.float32)
+
+
+def compute_average(in_file, out_file=None, frames_per_chunk=1, out_ext='.nii.gz'):
 
     """
         A function to compute tehe average over all time frames
-        for a given pet volume
+        for a given pet volume, streaming the frames so that peak 
+        memory stays at about one 3D volume
         
         Parameters
         ----------
@@ -45,6 +83,10 @@ def compute_average(in_file, out_file=None):
             input file path (str) for pet volume
         out_file : str 
             output file path (str) computed average
+        frames_per_chunk : int
+            number of frames read from disk at a time
+        out_ext : str
+            '.nii' or '.nii.gz', see the image_format config
 
         Returns
         -------
@@ -56,31 +98,44 @@ def compute_average(in_file, out_file=None):
     import nibabel as nib
     import numpy as np
     from nipype.utils.filemanip import split_filename
+    from utils import iter_frame_chunks
+
+    pet_brain = nib.load(in_file, mmap=True, keep_file_open=True)
+    n_frames = pet_brain.shape[3] if len(pet_brain.shape) > 3 else 1
 
-    pet_brain = nib.load(in_file)
-    pet_brain_img = pet_brain.get_fdata()
-    avg = np.mean(pet_brain_img, axis=3)
+    avg = np.zeros(pet_brain.shape[:3], dtype=np.float32)
+    for _, chunk in iter_frame_chunks(pet_brain, frames_per_chunk):
+        avg += chunk.sum(axis=3)
+    avg /= n_frames
     pet_brain_frame = nib.Nifti1Image(avg, pet_brain.affine)
         
     new_pth = os.getcwd()
     pth, fname, ext = split_filename(in_file)
-    pet_brain_filename = "{}_mean.nii.gz".format(fname)
+    pet_brain_filename = "{}_mean{}".format(fname, out_ext)
     pet_brain_frame.to_filename(pet_brain_filename)
 
     return os.path.abspath(pet_brain_filename)
 
-def compute_weighted_average(in_file, json_file, out_file=None): 
+def compute_weighted_average(in_file, json_file, out_file=None, frames_per_chunk=1, out_ext='.nii.gz'): 
 
     """
         A function to compute a time weighted average over
-        the time frames for a given pet volume
+        the time frames for a given pet volume. Frames are read 
+        through the nibabel proxy and accumulated into a single 
+        float32 buffer, so peak memory stays at about one 3D volume
 
         Parameters
         ----------
         in_file : str 
             input file path (str) for pet volume
+        json_file : str
+            path to BIDS json PET file containing 'FrameDuration'
         out_file : str 
             output file path (str) computed average
+        frames_per_chunk : int
+            number of frames read from disk at a time
+        out_ext : str
+            '.nii' or '.nii.gz', see the image_format config
 
         Returns
         -------
@@ -94,26 +149,136 @@ def compute_weighted_average(in_file, json_file, out_file=None):
     import nibabel as nib
     import json
     from nipype.utils.filemanip import split_filename
+    from utils import iter_frame_chunks
 
 
-    img = nib.load(in_file)        
-    data = np.float32(img.get_fdata())
+    img = nib.load(in_file, mmap=True, keep_file_open=True)
 
     with open(json_file, 'r') as f:
         desc = json.load(f)
         frames = np.float32(np.array(desc['FrameDuration'], dtype=float))
 
-    data = np.sum(np.float32(data * frames),axis=3) / np.sum(frames)
+    data = np.zeros(img.shape[:3], dtype=np.float32)
+    for start, chunk in iter_frame_chunks(img, frames_per_chunk):
+        weights = frames[start:start + chunk.shape[3]]
+        data += np.tensordot(chunk, weights, axes=([3], [0]))
+    data /= np.sum(frames)
       
     img_ = nib.Nifti1Image(data, img.affine)
             
     new_pth = os.getcwd()
     pth, fname, ext = split_filename(in_file)
-    out_file = "{}_twa.nii.gz".format(fname)
+    out_file = "{}_twa{}".format(fname, out_ext)
     img_.to_filename(out_file)
     return os.path.abspath(out_file)    
 
 
+def image_extension(output_type):
+    """
+        File extension of a FSL output type ('NIFTI' or 'NIFTI_GZ')
+    """
+    return {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}[output_type]
+
+
+def parallel_gzip(in_file, out_file, level=6, n_threads=4, block_size=16 << 20):
+    """
+        Gzip a file on several cores: with pigz when it is on the
+        PATH, otherwise as a multi-member gzip stream whose blocks
+        are compressed by a thread pool (zlib releases the GIL).
+        Both are read by nibabel, FSL and FreeSurfer like any gzip
+
+        Parameters
+        ----------
+        in_file : str
+            file to compress
+        out_file : str
+            path of the compressed file
+        level : int
+            gzip compression level
+        n_threads : int
+            number of compression threads
+        block_size : int
+            bytes per gzip member, n_threads blocks are held in memory
+
+        Returns
+        -------
+        out_file : str
+            path of the compressed file
+    """
+    import gzip
+    import shutil
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    pigz = shutil.which('pigz')
+    if pigz:
+        with open(out_file, 'wb') as out:
+            subprocess.run([pigz, '-%d' % level, '-p', str(n_threads), '-c', in_file], 
+                           stdout=out, check=True)
+        return out_file
+
+    with open(in_file, 'rb') as f, open(out_file, 'wb') as out, \
+         ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+        while True:
+            blocks = [block for block in (f.read(block_size) for _ in range(max(1, n_threads))) if block]
+            if not blocks:
+                break
+            for member in pool.map(lambda block: gzip.compress(block, compresslevel=level), blocks):
+                out.write(member)
+    return out_file
+
+
+def compress_image(in_file, level=6, n_threads=4):
+    """
+        Compress an uncompressed intermediate image before it is 
+        handed to the DataSink
+
+        Parameters
+        ----------
+        in_file : str
+            path to a .nii (returned unchanged when already compressed)
+        level : int
+            gzip compression level
+        n_threads : int
+            number of compression threads
+
+        Returns
+        -------
+        out_file : str
+            path to the .nii.gz image
+    """
+    import os
+    from utils import parallel_gzip
+
+    if in_file.endswith('.gz'):
+        return in_file
+    out_file = os.path.abspath(os.path.basename(in_file) + '.gz')
+    return parallel_gzip(in_file, out_file, level, n_threads)
+
+
+def select_variant(variant, variants, keys):
+    """
+        Parameter values of a sweep variant, in the order of the
+        output names of the node
+
+        Parameters
+        ----------
+        variant : str
+            label of the variant
+        variants : dict
+            mapping of variant label to parameter values
+        keys : list of str
+            swept parameter names
+
+        Returns
+        -------
+        values : value or tuple
+            one value per swept parameter
+    """
+    values = tuple(variants[variant][key] for key in keys)
+    return values[0] if len(values) == 1 else values
+
+
 def combine_file_paths(time_file, ref_file):
 
     """
@@ -168,6 +333,28 @@ def combine_(ref_file, time_file, k2p_file):
 
     return [(os.path.abspath(ref_file),os.path.abspath(time_file), k2p)]
 
+def first_anatomical(anat_files):
+
+    """
+        A function that picks a single anatomical image when
+        a file template matches several (e.g. the T1w images of 
+        all sessions of a subject)
+
+        Parameters
+        ----------
+        anat_files : str or list of str
+            path(s) to the anatomical image(s)
+
+        Returns
+        -------
+        anat_file : str
+            first path in sorted order
+    """
+
+    if isinstance(anat_files, str):
+        return anat_files
+    return sorted(anat_files)[0]
+
 def listify(*args):
 
     """
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import datetime
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
+
+from bidsindex import BIDSIndex, acquisition_key
+
+# Status of an acquisition in the watch state file
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+def process_acquisition(configs, subject_id, session_id):
+    """
+        Build and run the PETWorkflow branch of one acquisition,
+        in its own working dir, inside a worker process
+
+        Parameters
+        ----------
+        configs : dict
+            keyword arguments for PETPipeline (see main.load_configs)
+        subject_id : str
+            unique subject identifier
+        session_id : str
+            session identifier
+
+        Returns
+        -------
+        (subject_id, session_id) : (str, str)
+            the processed acquisition
+    """
+    from PETPipeline import PETPipeline
+
+    # own working dir and reports, workers run concurrently
+    pipeline = PETPipeline(**configs, output_label=acquisition_key(subject_id, session_id))
+    pipeline.base_dir = os.path.join(pipeline.base_dir, 'watch', acquisition_key(subject_id, session_id))
+    # invalid inputs fail the acquisition before recon-all starts
+    pipeline.PETWorkflow(pipeline.preflight([(subject_id, session_id)], policy='fail'))
+    pipeline.run()
+    return subject_id, session_id
+
+
+class WatchService:
+
+    """
+        Long-running service processing acquisitions as they
+        arrive in the BIDS data dir.
+
+        The data dir is polled through the persistent BIDSIndex. An
+        acquisition is ready once its PET image, PET sidecar and a
+        T1w are present and none of them changed for 'settle_s'
+        seconds (i.e. the transfer is complete). Ready acquisitions
+        are run by a pool of at most 'n_workers' processes, each
+        building the PETWorkflow branch of a single acquisition.
+
+        The status of every acquisition is persisted in a json state
+        file, so a restarted service resumes the acquisitions that
+        were pending or running and skips the ones already done.
+        Acquisitions whose files change are processed again, after
+        the running worker finishes if they change while running.
+
+        Parameters
+        ----------
+        configs : dict
+            keyword arguments for PETPipeline (see main.load_configs)
+        state_file : str
+            path to the json state file
+        poll_s : float
+            seconds between two polls of the data dir
+        settle_s : float
+            seconds an acquisition must stay unchanged before it runs
+        n_workers : int
+            maximum number of acquisitions processed at once
+    """
+
+    def __init__(self, configs, state_file, poll_s=60., settle_s=300., n_workers=2):
+        env_config = configs['env_config']
+        self.configs = dict(configs)
+        if 'kinetic_modelling_config' in configs:
+            # a cohort table of a single acquisition would overwrite the batch one
+            self.configs['kinetic_modelling_config'] = dataclasses.replace(
+                                                    configs['kinetic_modelling_config'], cohort=False)
+        self.state_file = state_file
+        self.poll_s = poll_s
+        self.settle_s = settle_s
+        self.n_workers = n_workers
+        self.index = BIDSIndex(os.path.join(env_config.experiment_dir, env_config.data_dir),
+                               os.path.join(env_config.experiment_dir, 'bids_index.json'))
+        self.state = self.load_state()
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+        # acquisitions interrupted by a restart are run again
+        for entry in state.values():
+            if entry['status'] == RUNNING:
+                entry['status'] = PENDING
+        return state
+
+    def save_state(self):
+        """
+            Atomically write the state file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        tmp_file = self.state_file + '.%d.tmp' % os.getpid()
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+    def set_status(self, subject_id, session_id, status, error=None):
+        entry = {'subject_id': subject_id, 'session_id': session_id, 'status': status,
+                 'updated': datetime.datetime.now().isoformat()}
+        if error is not None:
+            entry['error'] = error
+        self.state[acquisition_key(subject_id, session_id)] = entry
+
+    def finish(self, subject_id, session_id, error=None):
+        """
+            Record the outcome of a worker, an acquisition whose
+            inputs changed while it was running is pending again
+        """
+        if self.state[acquisition_key(subject_id, session_id)].get('dirty'):
+            self.set_status(subject_id, session_id, PENDING)
+        else:
+            self.set_status(subject_id, session_id, FAILED if error else DONE,
+                            '%s: %s' % (type(error).__name__, error) if error else None)
+
+    def discover(self):
+        """
+            Refresh the index and mark new or modified acquisitions
+            as pending
+        """
+        changed = set(self.index.refresh())
+        if changed:
+            self.index.save()
+        for subject_id, session_id in self.index.acquisitions():
+            entry = self.state.get(acquisition_key(subject_id, session_id))
+            if entry is not None and (subject_id, session_id) in changed and entry['status'] == RUNNING:
+                # processed again once the running worker finishes
+                entry['dirty'] = True
+            elif entry is None or (subject_id, session_id) in changed:
+                self.set_status(subject_id, session_id, PENDING)
+
+    def is_ready(self, subject_id, session_id):
+        """
+            Whether all inputs of an acquisition are present and
+            unchanged for settle_s seconds
+        """
+        files = self.index.files(subject_id, session_id)
+        if not (files['pet'] and files['json'] and files['anat']):
+            return False
+        try:
+            latest = max(os.stat(path).st_mtime for paths in files.values() for path in paths)
+        except FileNotFoundError:
+            return False
+        return time.time() - latest >= self.settle_s
+
+    def ready(self):
+        return [(entry['subject_id'], entry['session_id'])
+                for _, entry in sorted(self.state.items())
+                if entry['status'] == PENDING and self.is_ready(entry['subject_id'], entry['session_id'])]
+
+    def serve(self, once=False):
+        """
+            Poll the data dir and process acquisitions until
+            interrupted
+
+            Parameters
+            ----------
+            once : bool
+                return once no acquisition is ready or running,
+                instead of polling forever
+        """
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            try:
+                while True:
+                    self.discover()
+
+                    for future in [future for future in running if future.done()]:
+                        self.finish(*running.pop(future), future.exception())
+
+                    for subject_id, session_id in self.ready()[:self.n_workers - len(running)]:
+                        future = pool.submit(process_acquisition, self.configs, subject_id, session_id)
+                        running[future] = (subject_id, session_id)
+                        self.set_status(subject_id, session_id, RUNNING)
+
+                    self.save_state()
+                    if once and not running and not self.ready():
+                        return
+                    time.sleep(self.poll_s)
+            finally:
+                self.save_state()
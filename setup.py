@@ -18,6 +18,7 @@ setup(
           'config',
           'nibabel',
           'numpy',
+          'scipy',
           'argparse',
       ],
   classifiers=[
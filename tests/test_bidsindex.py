@@ -0,0 +1,22 @@
+from bidsindex import run_label, pet_runs
+
+
+def test_run_label():
+    assert run_label('/data/sub-01/ses-a/pet/sub-01_ses-a_trc-raclopride_run-1_pet.nii.gz') == \
+        'trc-raclopride_run-1'
+    assert run_label('sub-01_ses-a_trc-raclopride_run-1_pet.json') == 'trc-raclopride_run-1'
+    assert run_label('sub-01_ses-a_pet.nii') == ''
+
+
+def test_pet_runs_single_run():
+    files = {'pet': ['sub-01_ses-a_trc-fdg_pet.nii.gz'], 'json': ['sub-01_ses-a_pet.json']}
+
+    assert pet_runs(files) == {'': ('sub-01_ses-a_trc-fdg_pet.nii.gz', 'sub-01_ses-a_pet.json')}
+
+
+def test_pet_runs_pairs_sidecars():
+    files = {'pet': ['sub-01_ses-a_run-1_pet.nii.gz', 'sub-01_ses-a_run-2_pet.nii.gz'],
+             'json': ['sub-01_ses-a_run-2_pet.json']}
+
+    assert pet_runs(files) == {'run-1': ('sub-01_ses-a_run-1_pet.nii.gz', None),
+                               'run-2': ('sub-01_ses-a_run-2_pet.nii.gz', 'sub-01_ses-a_run-2_pet.json')}
@@ -0,0 +1,80 @@
+import os
+import glob
+
+import pytest
+
+pytest.importorskip('nipype')
+
+from cleanup import IntermediateCleaner, plan_waves
+
+
+def make_image(subject_id):
+    import os
+    out_file = os.path.abspath('img.nii')
+    with open(out_file, 'w') as f:
+        f.write('x' * 1000)
+    return out_file
+
+
+def correct(in_file, variant):
+    import os
+    assert os.path.exists(in_file), in_file
+    out_file = os.path.abspath('pvc.nii')
+    with open(out_file, 'w') as f:
+        f.write('y' * 1000)
+    return out_file
+
+
+def fit(in_file):
+    import os
+    assert os.path.exists(in_file), in_file
+    return os.path.getsize(in_file)
+
+
+def sweep_workflow(base_dir, variants):
+    from nipype import Node, Function, Workflow
+    from nipype.interfaces.utility import IdentityInterface
+
+    workflow = Workflow('preprocessing', base_dir=base_dir)
+    workflow.config['execution']['crashdump_dir'] = base_dir
+    infosource = Node(IdentityInterface(fields=['subject_id', 'session_id']), name='infosource')
+    infosource.iterables = [('subject_id', ['01', '02']), ('session_id', ['a', 'a'])]
+    infosource.synchronize = True
+    sweepsource = Node(IdentityInterface(fields=['variant']), name='sweepsource')
+    sweepsource.iterables = ('variant', variants)
+    motion_correction = Node(Function(input_names=['subject_id'], output_names=['out'],
+                                      function=make_image), name='motion_correction')
+    pvc = Node(Function(input_names=['in_file', 'variant'], output_names=['out'],
+                        function=correct), name='partial_volume_correction')
+    km = Node(Function(input_names=['in_file'], output_names=['out'], function=fit),
+              name='kinetic_modelling')
+    workflow.connect([(infosource, motion_correction, [('subject_id', 'subject_id')]),
+                      (motion_correction, pvc, [('out', 'in_file')]),
+                      (sweepsource, pvc, [('variant', 'variant')]),
+                      (pvc, km, [('out', 'in_file')])])
+    return workflow
+
+
+def test_cleaned_nodes_rerun(tmp_path, monkeypatch):
+    from nipype.pipeline.engine import Workflow
+    monkeypatch.setattr(Workflow, 'write_graph', lambda *args, **kwargs: None)
+    base_dir = str(tmp_path)
+
+    workflow = sweep_workflow(base_dir, ['psf-4', 'psf-6'])
+    cleaner = IntermediateCleaner(workflow, ['motion_correction', 'partial_volume_correction'], ['*.nii'])
+    workflow.run(plugin='Linear', plugin_args={'status_callback': cleaner})
+    assert cleaner.freed == 6000
+    assert not glob.glob(os.path.join(base_dir, '**', '*.nii'), recursive=True)
+
+    # a new variant needs the cleaned motion corrected image again
+    sweep_workflow(base_dir, ['psf-4', 'psf-6', 'psf-8']).run(plugin='Linear')
+    assert len(glob.glob(os.path.join(base_dir, '**', 'motion_correction', 'img.nii'), recursive=True)) == 2
+
+
+def test_plan_waves_fits_budget():
+    acquisitions = [('01', 'a'), ('02', 'a'), ('03', 'a'), ('04', 'a')]
+    costs = dict(zip(acquisitions, [4., 4., 9., 1.]))
+
+    assert plan_waves(acquisitions, costs, 10.) == [[('01', 'a'), ('02', 'a')], [('03', 'a'), ('04', 'a')]]
+    assert plan_waves(acquisitions, costs, 10., used=5.) == [[('01', 'a')], [('02', 'a')], [('03', 'a')],
+                                                             [('04', 'a')]]
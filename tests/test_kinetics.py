@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from kinetics import mrtm, mrtm2, native_mrtm, native_mrtm2
+
+# one-tissue kinetics (1/min) driven by a gamma variate input
+K1_REF, K2_REF = 0.3, 0.15
+R1, K2A = 1.2, 0.06
+BP = R1 * K2_REF / K2A - 1.
+RATE = 0.5
+
+
+def response(times, k):
+    """
+        Closed form of int_0^T s exp(-RATE s) exp(-k (T - s)) ds
+    """
+    d = RATE - k
+    return np.exp(-k * times) * (1. - np.exp(-d * times) * (1. + d * times)) / d ** 2
+
+
+@pytest.fixture
+def tacs():
+    times = np.arange(0.05, 90., 0.05)
+    ref = K1_REF * response(times, K2_REF)
+    target = R1 * K1_REF * response(times, K2A)
+    return times, ref, target
+
+
+def test_mrtm_closed_form(tacs):
+    times, ref, target = tacs
+    beta, bp, k2p = mrtm(target[np.newaxis], ref, times)
+
+    np.testing.assert_allclose(beta[0], [R1 * K2_REF, -K2A, R1], rtol=1e-2)
+    np.testing.assert_allclose(k2p, K2_REF, rtol=1e-2)
+    np.testing.assert_allclose(bp, BP, rtol=1e-2)
+
+
+def test_mrtm2_closed_form(tacs):
+    times, ref, target = tacs
+    beta, bp = mrtm2(np.stack([target, ref]), ref, times, K2_REF)
+
+    np.testing.assert_allclose(beta[0], [R1 * K2_REF, -K2A], rtol=1e-2)
+    np.testing.assert_allclose(bp, [BP, 0.], atol=1e-2)
+
+
+def test_mrtm2_zero_k2p(tacs):
+    times, ref, target = tacs
+    with np.errstate(all='raise'):
+        beta, bp = mrtm2(np.stack([target, target]), ref, times, [0., K2_REF])
+
+    np.testing.assert_array_equal(beta[0], 0.)
+    assert bp[0] == 0.
+    np.testing.assert_allclose(bp[1], BP, rtol=1e-2)
+
+
+def test_native_time_unit(tacs, tmp_path):
+    nib = pytest.importorskip('nibabel')
+    times, ref, target = tacs
+    # mri_glmfit inputs: mid-frame times in seconds, TACs as an image
+    time_file, ref_file, in_file = tmp_path / 'time.dat', tmp_path / 'ref.dat', tmp_path / 'tac.nii.gz'
+    np.savetxt(time_file, times * 60.)
+    np.savetxt(ref_file, ref)
+    nib.Nifti1Image(target.reshape(1, 1, 1, -1).astype(np.float32), np.eye(4)).to_filename(str(in_file))
+
+    _, k2p_file, _ = native_mrtm(str(in_file), str(time_file), str(ref_file), str(tmp_path / 'mrtm'))
+    np.testing.assert_allclose(np.loadtxt(k2p_file), K2_REF / 60., rtol=1e-2)
+
+    _, bp_file = native_mrtm2(str(in_file), str(time_file), str(ref_file), k2p_file, str(tmp_path / 'mrtm2'))
+    np.testing.assert_allclose(np.asarray(nib.load(bp_file).dataobj).ravel(), BP, rtol=1e-2)
+
+    np.savetxt(k2p_file, [0.])
+    with pytest.raises(ValueError):
+        native_mrtm2(str(in_file), str(time_file), str(ref_file), k2p_file, str(tmp_path / 'mrtm2'))
@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip('nipype')
+
+from manifest import is_stale, tool_versions, write_manifest
+
+
+def test_is_stale(tmp_path):
+    inputs = {}
+    for name in ['anat', 'pet', 'json']:
+        path = tmp_path / ('%s.dat' % name)
+        path.write_text(name)
+        inputs[name] = [str(path)]
+    configs = {'environment': {'name': 'petpipeline'}, 'gtm': {'psf': 4}}
+    manifest_dir = str(tmp_path / 'manifests')
+
+    path = write_manifest('01', 'a', inputs['anat'], inputs['pet'][0], inputs['json'][0], configs, manifest_dir)
+    versions = tool_versions()
+
+    assert not is_stale(path, inputs, configs, versions)
+    assert is_stale(str(tmp_path / 'missing.json'), inputs, configs, versions)
+    assert is_stale(path, inputs, dict(configs, gtm={'psf': 6}), versions)
+    assert is_stale(path, inputs, configs, dict(versions, fsl='0.0'))
+    assert is_stale(path, dict(inputs, pet=inputs['pet'] + inputs['anat']), configs, versions)
+
+    (tmp_path / 'pet.dat').write_text('changed')
+    assert is_stale(path, inputs, configs, versions)
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+from motion_correction import split_frames, merge_frames, merge_mats
+
+
+def test_split_merge_keeps_float_values(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = np.arange(2 * 3 * 4 * 7, dtype=np.int16).reshape(2, 3, 4, 7)
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_slope_inter(0.37, 0)
+    img.to_filename('pet.nii.gz')
+    expected = np.asarray(nib.load('pet.nii.gz').dataobj, dtype=np.float32)
+
+    chunk_files = split_frames('pet.nii.gz', 3)
+    assert [nib.load(chunk_file).shape[3] for chunk_file in chunk_files] == [3, 2, 2]
+    # registered frames are not on the integer grid of the source
+    for chunk_file in chunk_files:
+        chunk = nib.load(chunk_file)
+        assert chunk.get_data_dtype() == np.float32
+        nib.Nifti1Image(np.asarray(chunk.dataobj) + 0.25, chunk.affine, chunk.header).to_filename(chunk_file)
+
+    merged = nib.load(merge_frames(chunk_files, 'merged.nii.gz'))
+    assert merged.get_data_dtype() == np.float32
+    np.testing.assert_array_equal(np.asarray(merged.dataobj), expected + 0.25)
+
+
+def test_merge_mats_frame_order(tmp_path):
+    chunk_mats = []
+    for chunk, n_frames in enumerate([3, 2]):
+        mat_dir = tmp_path / ('chunk%d.nii.gz.mat' % chunk)
+        mat_dir.mkdir()
+        chunk_mats.append([])
+        for frame in range(n_frames):
+            (mat_dir / ('MAT_%04d' % frame)).write_text('%d %d' % (chunk, frame))
+            chunk_mats[-1].append(str(mat_dir / ('MAT_%04d' % frame)))
+
+    mat_files = merge_mats(chunk_mats, str(tmp_path / 'pet_mcf.nii.gz.mat'))
+
+    assert [os.path.basename(mat_file) for mat_file in mat_files] == ['MAT_%04d' % frame for frame in range(5)]
+    assert [open(mat_file).read() for mat_file in mat_files] == ['0 0', '0 1', '0 2', '1 0', '1 1']
+    assert merge_mats([[], []], str(tmp_path / 'none')) == []
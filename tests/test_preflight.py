@@ -0,0 +1,43 @@
+import json
+
+from preflight import check_sidecar
+
+
+def write_sidecar(tmp_path, info):
+    json_file = str(tmp_path / 'sub-01_ses-a_pet.json')
+    with open(json_file, 'w') as f:
+        json.dump(info, f)
+    return json_file
+
+
+def test_valid_sidecar(tmp_path):
+    json_file = write_sidecar(tmp_path, {'FrameTimesStart': [0, 60, 120], 'FrameDuration': [60, 60, 120]})
+
+    assert check_sidecar(json_file, 3) == []
+    assert check_sidecar(json_file, None) == []
+
+
+def test_missing_and_non_numeric_timing(tmp_path):
+    json_file = write_sidecar(tmp_path, {'FrameDuration': [60, 'x']})
+
+    assert check_sidecar(json_file, 2) == ['sub-01_ses-a_pet.json: missing FrameTimesStart',
+                                           'sub-01_ses-a_pet.json: non-numeric FrameDuration']
+
+
+def test_inconsistent_timing(tmp_path):
+    json_file = write_sidecar(tmp_path, {'FrameTimesStart': [0, 120, 60], 'FrameDuration': [60, 0]})
+
+    assert check_sidecar(json_file, 4) == ['sub-01_ses-a_pet.json: 3 FrameTimesStart but 2 FrameDuration',
+                                           'sub-01_ses-a_pet.json: 2 frames in the sidecar, 4 in the image',
+                                           'sub-01_ses-a_pet.json: non-positive FrameDuration',
+                                           'sub-01_ses-a_pet.json: FrameTimesStart not increasing']
+
+
+def test_unreadable_sidecar(tmp_path):
+    json_file = str(tmp_path / 'sub-01_ses-a_pet.json')
+    with open(json_file, 'w') as f:
+        f.write('{')
+
+    problems = check_sidecar(json_file, 3)
+
+    assert len(problems) == 1 and problems[0].startswith('sub-01_ses-a_pet.json: unreadable')
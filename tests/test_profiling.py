@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip('nipype')
+
+from profiling import _input_bytes
+
+
+def test_input_bytes_counts_file_inputs_only(tmp_path):
+    from nipype.interfaces.freesurfer import MRICoreg
+    from nipype.interfaces.utility import IdentityInterface
+
+    source, reference = tmp_path / 'source.nii', tmp_path / 'reference.mgz'
+    source.write_bytes(b'x' * 100)
+    reference.write_bytes(b'x' * 10)
+    subjects_dir = tmp_path / 'subjects'
+    subjects_dir.mkdir()
+    (subjects_dir / 'large.mgz').write_bytes(b'x' * 1000)
+
+    coreg = MRICoreg(source_file=str(source), reference_file=str(reference), subjects_dir=str(subjects_dir))
+    assert _input_bytes(coreg.inputs) == 110
+
+    identity = IdentityInterface(fields=['files'])
+    identity.inputs.files = [str(source), str(reference)]
+    assert _input_bytes(identity.inputs) == 0
@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from reconall_cache import lookup, load_index, update_index
+
+
+def complete(subjects_dir, subject_id):
+    scripts = os.path.join(subjects_dir, subject_id, 'scripts')
+    os.makedirs(scripts)
+    open(os.path.join(scripts, 'recon-all.done'), 'w').close()
+
+
+def test_lookup_without_index_entry(tmp_path):
+    subjects_dir = str(tmp_path)
+    assert lookup(subjects_dir, 'abc', 'sub-01_abc') is None
+    complete(subjects_dir, 'sub-01_abc')
+    assert lookup(subjects_dir, 'abc', 'sub-01_abc') == 'sub-01_abc'
+
+
+def test_lookup_legacy(tmp_path):
+    subjects_dir = str(tmp_path)
+    complete(subjects_dir, 'a_01')
+    assert lookup(subjects_dir, 'abc', 'sub-01_abc') is None
+    assert lookup(subjects_dir, 'abc', 'sub-01_abc', ['a_01']) == 'a_01'
+
+
+def test_concurrent_index_updates(tmp_path):
+    subjects_dir = str(tmp_path)
+    digests = ['%04d' % index for index in range(32)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda digest: update_index(subjects_dir, digest, {'subject_id': digest}), digests))
+    assert sorted(load_index(subjects_dir)) == digests
@@ -0,0 +1,44 @@
+import os
+
+from results import ResultsStore
+
+
+def write_cohort(derivatives, variant, bp):
+    table_file = os.path.join(derivatives, 'km_cohort', variant, 'cohort_mrtm.tsv')
+    os.makedirs(os.path.dirname(table_file), exist_ok=True)
+    with open(table_file, 'w') as f:
+        f.write('subject_id\tsession_id\trun\tsegid\tregion\tmrtm_k2p\tmrtm_bp\tmrtm2_k2p\tmrtm2_bp\n')
+        f.write('01\ta\t\t12\tLeft-Putamen\t0.1\t%s\t0.1\t%s\n' % (bp, bp))
+    return table_file
+
+
+def test_update_only_changed_units(tmp_path):
+    derivatives = str(tmp_path)
+    write_cohort(derivatives, 'psf-4', 2.)
+    table_file = write_cohort(derivatives, 'psf-6', 3.)
+    store = ResultsStore(os.path.join(derivatives, 'results_store'))
+
+    assert store.update(derivatives, []) == ['cohort:km_cohort/psf-4/cohort_mrtm.tsv',
+                                             'cohort:km_cohort/psf-6/cohort_mrtm.tsv']
+    assert store.update(derivatives, []) == []
+
+    write_cohort(derivatives, 'psf-6', 4.)
+    os.utime(table_file, ns=(0, 10 ** 9))
+    assert store.update(derivatives, []) == ['cohort:km_cohort/psf-6/cohort_mrtm.tsv']
+
+    result = ResultsStore(store.root).query('kinetics', ['variant', 'bp'], model='mrtm')
+    assert sorted(zip(result['variant'], result['bp'])) == [('psf-4', 2.), ('psf-6', 4.)]
+
+
+def test_compaction_keeps_current_rows(tmp_path):
+    derivatives = str(tmp_path)
+    store = ResultsStore(os.path.join(derivatives, 'results_store'), compact_segments=2)
+    for update, bp in enumerate([1., 2., 3.]):
+        table_file = write_cohort(derivatives, '', bp)
+        os.utime(table_file, ns=(0, (update + 1) * 10 ** 9))
+        store.update(derivatives, [])
+
+    assert store.catalog['segments'] == [4]
+    assert sorted(os.listdir(os.path.join(store.root, 'kinetics'))) == ['seg-000004']
+    result = ResultsStore(store.root).query('kinetics', ['model', 'bp'])
+    assert sorted(zip(result['model'], result['bp'])) == [('mrtm', 3.), ('mrtm2', 3.)]
@@ -0,0 +1,64 @@
+import os
+import json
+
+import pytest
+
+from sharding import shard_acquisitions, sharded_tables, write_marker, merge_shards
+
+
+def write_table(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('subject_id\tvalue\n')
+        f.writelines('%s\t%s\n' % row for row in rows)
+
+
+def test_merge_sweep_and_profiling_tables(tmp_path):
+    derivatives = str(tmp_path)
+    shard_dir = os.path.join(derivatives, 'shards')
+    tables = sharded_tables({'psf-4': {}, 'psf-6': {}}, 'profiles')
+    for index in (1, 2):
+        shard = 'shard-%d-of-2' % index
+        write_marker(shard_dir, index, 2, [('%02d' % index, 'a')], 'complete')
+        for variant in ('psf-4', 'psf-6'):
+            write_table(os.path.join(derivatives, 'km_cohort', shard, variant, 'cohort_mrtm.tsv'),
+                        [('%02d' % index, variant)])
+        write_table(os.path.join(derivatives, 'profiles', shard, 'node_profile.tsv'), [('%02d' % index, 1)])
+
+    merged, problems = merge_shards(derivatives, tables=tables)
+
+    assert problems == []
+    with open(merged) as f:
+        assert json.load(f)['acquisitions'] == [['01', 'a'], ['02', 'a']]
+    for variant in ('psf-4', 'psf-6'):
+        with open(os.path.join(derivatives, 'km_cohort', variant, 'cohort_mrtm.tsv')) as f:
+            assert f.read() == 'subject_id\tvalue\n01\t%s\n02\t%s\n' % (variant, variant)
+    with open(os.path.join(derivatives, 'profiles', 'node_profile.tsv')) as f:
+        assert len(f.readlines()) == 3
+    assert not [name for name in os.listdir(shard_dir) if name.endswith('.tmp')]
+
+
+def test_merge_reports_missing_shard(tmp_path):
+    write_marker(os.path.join(str(tmp_path), 'shards'), 1, 2, [], 'complete')
+    _, problems = merge_shards(str(tmp_path))
+    assert problems == ['shard-2-of-2: missing']
+
+
+def test_shard_by_hash_partitions_acquisitions():
+    acquisitions = [('%02d' % subject, session) for subject in range(1, 21) for session in 'ab']
+    shards = [shard_acquisitions(acquisitions, index, 3) for index in (1, 2, 3)]
+
+    assert sorted(sum(shards, [])) == sorted(acquisitions)
+    assert shards == [shard_acquisitions(list(reversed(acquisitions)), index, 3) for index in (1, 2, 3)]
+
+
+def test_shard_balanced_spreads_costs():
+    costs = {('01', 'a'): 8., ('02', 'a'): 5., ('03', 'a'): 4., ('04', 'a'): 3.}
+    shards = [shard_acquisitions(list(costs), index, 2, 'balanced', costs) for index in (1, 2)]
+
+    assert shards == [[('01', 'a'), ('04', 'a')], [('02', 'a'), ('03', 'a')]]
+
+
+def test_shard_unknown_strategy():
+    with pytest.raises(ValueError):
+        shard_acquisitions([('01', 'a')], 1, 2, 'random')
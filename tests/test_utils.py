@@ -0,0 +1,45 @@
+import os
+import gzip
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('nipype')
+
+from utils import parallel_gzip, compute_weighted_average
+
+
+def test_parallel_gzip_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, 'which', lambda name: None)
+    data = np.random.RandomState(0).bytes(10000)
+    in_file, out_file = str(tmp_path / 'img.nii'), str(tmp_path / 'img.nii.gz')
+    with open(in_file, 'wb') as f:
+        f.write(data)
+
+    assert parallel_gzip(in_file, out_file, n_threads=3, block_size=1000) == out_file
+    with open(out_file, 'rb') as f:
+        compressed = f.read()
+    assert compressed.count(b'\x1f\x8b\x08') >= 10
+    assert gzip.decompress(compressed) == data
+
+
+@pytest.mark.parametrize('frames_per_chunk', [1, 3])
+def test_weighted_average_matches_in_memory(tmp_path, monkeypatch, frames_per_chunk):
+    monkeypatch.chdir(tmp_path)
+    data = np.random.RandomState(0).rand(4, 5, 6, 7).astype(np.float32)
+    durations = [10., 10., 30., 30., 60., 120., 300.]
+    in_file, json_file = str(tmp_path / 'pet.nii.gz'), str(tmp_path / 'pet.json')
+    nib.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    with open(json_file, 'w') as f:
+        json.dump({'FrameDuration': durations}, f)
+
+    out_file = compute_weighted_average(in_file, json_file, frames_per_chunk=frames_per_chunk)
+
+    # in-memory weighted average the streaming version replaces
+    frames = np.float32(np.array(durations, dtype=float))
+    expected = np.sum(np.float32(data * frames), axis=3) / np.sum(frames)
+    assert os.path.basename(out_file) == 'pet_twa.nii.gz'
+    np.testing.assert_allclose(nib.load(out_file).get_fdata(), expected, rtol=1e-5)
@@ -0,0 +1,45 @@
+import os
+import time
+from types import SimpleNamespace
+
+from watch import WatchService, PENDING, RUNNING, DONE
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def make_session(data_dir, names):
+    for folder, name in names:
+        touch(os.path.join(data_dir, 'sub-01', 'ses-a', folder, name))
+
+
+def test_change_while_running_requeues(tmp_path):
+    data_dir = os.path.join(str(tmp_path), 'data')
+    make_session(data_dir, [('anat', 'sub-01_ses-a_T1w.nii.gz'),
+                            ('pet', 'sub-01_ses-a_pet.nii.gz'),
+                            ('pet', 'sub-01_ses-a_pet.json')])
+    env_config = SimpleNamespace(experiment_dir=str(tmp_path), data_dir='data')
+    service = WatchService({'env_config': env_config}, os.path.join(str(tmp_path), 'state.json'))
+
+    service.discover()
+    assert service.state['sub-01_ses-a']['status'] == PENDING
+    service.set_status('01', 'a', RUNNING)
+
+    # a new run arrives while the acquisition is processed
+    time.sleep(0.01)
+    make_session(data_dir, [('pet', 'sub-01_ses-a_run-2_pet.nii.gz')])
+    service.discover()
+    assert service.state['sub-01_ses-a']['status'] == RUNNING
+    assert service.state['sub-01_ses-a']['dirty']
+
+    service.finish('01', 'a')
+    assert service.state['sub-01_ses-a']['status'] == PENDING
+    assert 'dirty' not in service.state['sub-01_ses-a']
+
+    # unchanged acquisitions keep their outcome
+    service.set_status('01', 'a', RUNNING)
+    service.discover()
+    service.finish('01', 'a')
+    assert service.state['sub-01_ses-a']['status'] == DONE